@@ -1,49 +1,165 @@
 #!/usr/bin/python3
 
-import argparse, csv, os, os.path, tempfile
+#######################################################################
+# Builds or extends a lexicon from gold annotated files.              #
+# Map: input files are converted in a pool of worker processes, each  #
+#      writing its (lemma, pos, form) triples as sorted run files.    #
+#      A worker spills a run to disk whenever it holds more than      #
+#      --spill triples, so memory use doesn't grow with the corpus.   #
+# Reduce: the runs are merged in sorted order and grouped into        #
+#      lemma TAB pos TAB forms lines, so the output is deterministic. #
+#      At most FANIN runs are open at a time: more runs are first     #
+#      merged in passes into intermediate runs.                       #
+#######################################################################
+
+import argparse, heapq, multiprocessing, os, os.path, tempfile
 import scripts.convertfiles
 from lib.normalizers import Normalizer
+from lib.lexicon import Lexicon
+from lib.compression import compression, open_file
 
 opj = os.path.join
 
-def main(infiles, lexicon='out.tsv'):
-    forms_d = {}
-    if os.path.exists(os.path.abspath(lexicon)):
-        with open(lexicon, encoding='utf-8') as f:
-            for line in f:
-                l = line.rstrip().split('\t')
-                if len(l) < 3: continue
-                if '|' in l[0]: continue
-                forms_d[l[0] + '||' + l[1]] = set(l[2].split('|'))
-                
+SPILL = 1000000
+FANIN = 32 # runs merged at a time, well below the usual open file limits
+
+def write_run(triples, runfile):
+    with open(runfile, 'w', encoding='utf-8') as f:
+        for triple in sorted(triples):
+            f.write('\t'.join(triple) + '\n')
+
+def map_file(job):
+    # Worker: converts one input file and writes its triples to one or
+    # more sorted run files. Returns the list of run files.
+    i, fname, tmpdir, spill = job
     normalizer = Normalizer(pnc_in_tok=False, uppercase=False) #ignore case in form
+    convfile = opj(tmpdir, 'tmp' + str(i) + '.txt')
+    try:
+        scripts.convertfiles.convert_from_source(fname, convfile, conllu_xpos=True)
+    except scripts.convertfiles.UnknownFileType:
+        print(fname)
+        raise
+    runs, triples = [], set()
+    with open_file(convfile, 'r', encoding='utf-8') as f:
+        for line in f:
+            l = line.rstrip().split('\t')
+            if len(l) < 3: continue
+            if '|' in l[2] or not l[2] or l[2] == 'UNKNOWN' or not l[1]: continue
+            triples.add((l[2], l[1], normalizer.normalize_tok(l[0])))
+            if len(triples) >= spill: # spill to disk
+                runs.append(opj(tmpdir, 'run{}-{}.tsv'.format(i, len(runs))))
+                write_run(triples, runs[-1])
+                triples = set()
+    os.remove(convfile)
+    if triples:
+        runs.append(opj(tmpdir, 'run{}-{}.tsv'.format(i, len(runs))))
+        write_run(triples, runs[-1])
+    return runs
+
+def lexicon_run(lexicon, runfile, spill=SPILL):
+    # Explodes an existing lexicon into sorted runs of triples.
+    runs, triples = [], set()
+    with open_file(lexicon, encoding='utf-8') as f:
+        for line in f:
+            l = line.rstrip().split('\t')
+            if len(l) < 3: continue
+            if '|' in l[0]: continue
+            for form in l[2].split('|'):
+                triples.add((l[0], l[1], form))
+            if len(triples) >= spill:
+                runs.append(runfile + str(len(runs)))
+                write_run(triples, runs[-1])
+                triples = set()
+    if triples:
+        runs.append(runfile + str(len(runs)))
+        write_run(triples, runs[-1])
+    return runs
+
+def merge_lines(runs):
+    # Generator over the unique lines of the sorted runs, in sort order.
+    files = [open(run, 'r', encoding='utf-8') for run in runs]
+    try:
+        last = None
+        for line in heapq.merge(*files):
+            if line == last: continue
+            last = line
+            yield line
+    finally:
+        for f in files: f.close()
+
+def merge_passes(runs, fanin=FANIN):
+    # Merges groups of fanin runs into intermediate runs (next to the
+    # first run) until at most fanin are left. Returns the runs left.
+    n = 0
+    while len(runs) > fanin:
+        merged = []
+        for i in range(0, len(runs), fanin):
+            group = runs[i:i + fanin]
+            if len(group) == 1:
+                merged.extend(group)
+                continue
+            merged.append(opj(os.path.dirname(runs[0]), 'merge{}.tsv'.format(n)))
+            n += 1
+            with open(merged[-1], 'w', encoding='utf-8') as f:
+                f.writelines(merge_lines(group))
+            for run in group: os.remove(run)
+        runs = merged
+    return runs
+
+def merge_runs(runs, fanin=FANIN):
+    # Generator over the unique triples of the sorted runs, in sort order.
+    for line in merge_lines(merge_passes(runs, fanin)):
+        yield tuple(line.rstrip('\n').split('\t'))
+
+def read_corpus(infiles, tmpdir, processes=None, spill=SPILL):
+    # Map step. Returns the list of run files.
+    jobs = [(i, fname, tmpdir, spill) for i, fname in enumerate(infiles)]
+    if processes == 1 or len(jobs) < 2:
+        results = [map_file(job) for job in jobs]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(map_file, jobs, chunksize=1)
+    return [run for runs in results for run in runs]
+
+def extend_overlay(infiles, lexicon, overlay, processes=None, spill=SPILL):
+    # Appends only the analyses missing from the lexicon (and the overlay)
+    # to the overlay file. The base lexicon is left untouched.
+    lex = Lexicon(lexicon if os.path.exists(lexicon) else '', [overlay] if os.path.exists(overlay) else [])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        runs = read_corpus(infiles, tmpdir, processes, spill)
+        with open_file(overlay, 'a', encoding='utf-8') as f:
+            write_lexicon(
+                (x for x in merge_runs(runs) if not (x[0], x[1]) in lex.lookup(x[2])), f
+            )
+
+def write_lexicon(triples, f):
+    # Reduce step. Triples must be sorted: forms of each lemma and pos are
+    # adjacent.
+    key, forms = None, []
+    for lemma, pos, form in triples:
+        if (lemma, pos) != key:
+            if forms: f.write(key[0] + '\t' + key[1] + '\t' + '|'.join(forms) + '\n')
+            key, forms = (lemma, pos), []
+        forms.append(form)
+    if forms: f.write(key[0] + '\t' + key[1] + '\t' + '|'.join(forms) + '\n')
+
+def compact(lexicon, overlay):
+    # Merges the overlay into the lexicon and empties the overlay.
+    Lexicon(lexicon, [overlay]).compact()
+    open(overlay, 'w').close()
+
+def main(infiles, lexicon='out.tsv', overlay='', compact_overlay=False, processes=None, spill=SPILL):
+    if overlay:
+        if infiles: extend_overlay(infiles, lexicon, overlay, processes, spill)
+        if compact_overlay: compact(lexicon, overlay)
+        return
     with tempfile.TemporaryDirectory() as tmpdir:
-        for fname in infiles:
-            try:
-                scripts.convertfiles.convert_from_source(fname, opj(tmpdir, 'tmp.txt'), conllu_xpos=True)
-            except scripts.convertfiles.UnknownFileType:
-                print(fname)
-                raise
-            with open(opj(tmpdir, 'tmp.txt'), 'r', encoding='utf-8') as f:
-                for line in f:
-                    l = line.rstrip().split('\t')
-                    if len(l) < 3: continue
-                    if '|' in l[2] or not l[2] or l[2] == 'UNKNOWN' or not l[1]: continue
-                    key = l[2] + '||' + l[1]
-                    form = normalizer.normalize_tok(l[0])
-                    if key in forms_d:
-                        forms_d[key].add(form)
-                    else:
-                        forms_d[key] = set([form]) 
-                        
-    with open(lexicon, 'w', encoding='utf-8') as f:
-        for key, forms in forms_d.items():
-            l = key.split('||')
-            f.write(l[0] + '\t')
-            f.write(l[1] + '\t')
-            l = list(forms)
-            l.sort()
-            f.write('|'.join(l) + '\n')
+        runs = read_corpus(infiles, tmpdir, processes, spill)
+        if os.path.exists(os.path.abspath(lexicon)):
+            runs.extend(lexicon_run(lexicon, opj(tmpdir, 'lexicon.run'), spill))
+        with open_file(lexicon + '.tmp', 'w', encoding='utf-8', ext=compression(lexicon)) as f:
+            write_lexicon(merge_runs(runs), f)
+        os.replace(lexicon + '.tmp', lexicon)
 
 if __name__ == '__main__':
     script_path = os.path.dirname(__file__)
@@ -52,8 +168,17 @@ if __name__ == '__main__':
         description = \
         'Appends forms from input files to a lexicon.'
     )
-    parser.add_argument('infiles', nargs='+', help='Input files.')
+    parser.add_argument('infiles', nargs='*', help='Input files.')
     parser.add_argument('--lexicon', type=str, help='Lexicon file.', default='out.tsv')
+    parser.add_argument('--overlay', type=str, default='', help=\
+        'Overlay file. New forms are appended to the overlay instead of ' + \
+        'rewriting the lexicon.')
+    parser.add_argument('--compact', dest='compact_overlay', action='store_true',
+        help='Merge the overlay into the lexicon and empty it.')
+    parser.add_argument('--processes', type=int, default=None,
+        help='Number of worker processes (default: number of CPUs).')
+    parser.add_argument('--spill', type=int, default=SPILL,
+        help='Maximum number of forms a worker holds in memory before spilling to disk.')
     kwargs = vars(parser.parse_args())
     #print(kwargs)
     main(**kwargs)
@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+
+#######################################################################
+# Opens plain and compressed files alike. The compression is chosen   #
+# by the extension (.gz, .xz or .bz2), so compressed corpora,         #
+# lexicons and outputs are read and written as streams, without being #
+# decompressed to disk first.                                         #
+#                                                                     #
+#   with open_file('text.tsv.gz', 'r', encoding='utf-8') as f: ...    #
+#######################################################################
+
+import bz2, gzip, lzma, os.path, shutil
+
+OPENERS = {'.gz': gzip.open, '.xz': lzma.open, '.bz2': bz2.open}
+
+def compression(fname):
+    # The compression extension of fname, or '' if it is not compressed.
+    ext = os.path.splitext(fname)[1]
+    return ext if ext in OPENERS else ''
+
+def strip_compression(fname):
+    # fname without its compression extension, e.g. to find the format
+    # of a file from its extension.
+    ext = compression(fname)
+    return fname[:-len(ext)] if ext else fname
+
+def open_file(fname, mode='r', encoding=None, errors=None, newline=None, ext=None):
+    # As open(), for text and binary modes. ext overrides the compression
+    # given by the extension of fname, e.g. for a temporary file which
+    # is renamed once complete.
+    ext = compression(fname) if ext is None else ext
+    if not ext:
+        return open(fname, mode, encoding=encoding, errors=errors, newline=newline)
+    if 'b' in mode:
+        return OPENERS[ext](fname, mode)
+    return OPENERS[ext](fname, mode.replace('t', '') + 't', encoding=encoding, errors=errors, newline=newline)
+
+def copy_file(src, dst):
+    # As shutil.copy2, but (de)compresses if src and dst have different
+    # compression extensions.
+    if compression(src) == compression(dst):
+        return shutil.copy2(src, dst)
+    with open_file(src, 'rb') as fin:
+        with open_file(dst, 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+    return dst
@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 import os, os.path
+from lib.compression import compression, open_file, strip_compression
 
 class Concatenater():
     
@@ -8,9 +9,9 @@ class Concatenater():
         self.path_lines = []
         
     def concatenate(self, paths, outfile):
-        with open(outfile, 'w', encoding='utf-8') as fout:
+        with open_file(outfile, 'w', encoding='utf-8') as fout:
             for path in paths:
-                with open(path, 'r', encoding='utf-8') as fin:
+                with open_file(path, 'r', encoding='utf-8') as fin:
                     for i, line in enumerate(fin):
                         fout.write(line)
                     self.path_lines.append((path, i))
@@ -22,20 +23,20 @@ class Concatenater():
         # or rename the files with a .out.txt extension
         outfile, i, path_line, fout = '', 0, ('', -1), None
         path_lines = self.path_lines[:]
-        with open(infile, 'r', encoding='utf-8') as fin:
+        with open_file(infile, 'r', encoding='utf-8') as fin:
             for line in fin:
                 if i > path_line[1]:
                     i = 0
                     path_line = path_lines.pop(0)
                     if fout: fout.close()
                     if outdir:
-                        fout = open(
+                        fout = open_file(
                             os.path.join(outdir, os.path.basename(path_line[0])),
                             'w', encoding='utf-8'
                         )
                     else:
-                        l = os.path.splitext(path_line[0])
-                        fout = open(l[0] + '.out' + l[1], 'w', encoding = 'utf-8')
+                        l = os.path.splitext(strip_compression(path_line[0]))
+                        fout = open_file(l[0] + '.out' + l[1] + compression(path_line[0]), 'w', encoding = 'utf-8')
                 fout.write(line)
                 i += 1
         fout.close()
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+
+#######################################################################
+# Runs jobs on worker processes, possibly on other hosts, connected   #
+# to a coordinator over TCP or Unix sockets                           #
+# (multiprocessing.connection). Workers connect to the coordinator    #
+# and are sent one job at a time; jobs whose worker fails, hangs or   #
+# disconnects are handed out again (to another worker if there is    #
+# one), up to RETRIES times. Results are returned in job order.       #
+#                                                                     #
+#   Coordinator(address, authkey).run(jobs)   # on the coordinator    #
+#   serve(address, handler, authkey)          # on each worker        #
+#                                                                     #
+# Jobs and results are pickled, so an authkey is required: use the    #
+# same one on both sides, so that only trusted peers can connect.     #
+#######################################################################
+
+import queue, threading, time
+from multiprocessing.connection import Client, Listener
+
+RETRIES = 2 # times a failed job is handed out again
+TIMEOUT = 3600 # seconds a worker may take for a job
+WAIT = 60 # seconds a worker waits for the coordinator to start
+
+class Error(Exception):
+    pass
+
+class JobFailed(Error):
+    pass
+
+class NoAuthKey(Error):
+    pass
+
+def check_authkey(authkey):
+    # Without a key, Listener and Client don't authenticate the peer,
+    # whose pickled messages could run arbitrary code.
+    if not authkey:
+        raise NoAuthKey('An authkey is required to distribute jobs')
+
+def parse_address(address):
+    # 'host:port' is a TCP address, anything else the path of a Unix
+    # socket.
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host or 'localhost', int(port))
+    return address
+
+class Coordinator():
+
+    def __init__(self, address, authkey=None, retries=RETRIES, timeout=TIMEOUT):
+        self.address = address
+        self.authkey = authkey
+        self.retries = retries
+        self.timeout = timeout
+
+    def run(self, jobs):
+        # Returns the list of results of the jobs, in order. Raises
+        # JobFailed if a job fails more than retries times.
+        check_authkey(self.authkey)
+        self.jobs = list(jobs)
+        if not self.jobs: return []
+        self.results = {} # key = index of the job
+        self.attempts = [0] * len(self.jobs)
+        self.failed_on = [set() for job in self.jobs] # names of the workers
+        self.workers = set() # names of the connected workers
+        self.failure = None
+        self.pending = queue.Queue() # indices of the jobs to hand out
+        for i in range(len(self.jobs)): self.pending.put(i)
+        self.lock = threading.Condition()
+        listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self.accept, args=(listener,), daemon=True).start()
+        with self.lock:
+            while not self.finished():
+                self.lock.wait()
+        listener.close()
+        if self.failure: raise self.failure
+        return [self.results[i] for i in range(len(self.jobs))]
+
+    def finished(self):
+        return self.failure is not None or len(self.results) == len(self.jobs)
+
+    def accept(self, listener):
+        n = 0
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError: # listener closed
+                return
+            except Exception as e: # e.g. wrong authkey
+                print('Warning: worker refused: ' + repr(e))
+                continue
+            n += 1
+            name = 'worker {} ({})'.format(n, listener.last_accepted or 'local')
+            with self.lock:
+                self.workers.add(name)
+            threading.Thread(target=self.serve, args=(conn, name), daemon=True).start()
+
+    def serve(self, conn, name):
+        # Hands out jobs to one worker until all are done or the worker
+        # fails.
+        try:
+            while not self.finished():
+                try:
+                    i = self.pending.get(timeout=1)
+                except queue.Empty:
+                    continue
+                with self.lock:
+                    others = self.workers - self.failed_on[i]
+                if name in self.failed_on[i] and others:
+                    # Leave the job to a worker it has not failed on
+                    self.pending.put(i)
+                    time.sleep(0.1)
+                    continue
+                try:
+                    conn.send(self.jobs[i])
+                    if not conn.poll(self.timeout):
+                        raise TimeoutError('no result after {} s'.format(self.timeout))
+                    result, error = conn.recv()
+                except (OSError, EOFError, TimeoutError) as e:
+                    # The worker is lost; its job goes to another one.
+                    self.fail(i, name, repr(e))
+                    return
+                if error:
+                    self.fail(i, name, error)
+                else:
+                    with self.lock:
+                        self.results[i] = result
+                        self.lock.notify_all()
+        finally:
+            with self.lock:
+                self.workers.discard(name)
+            try:
+                conn.send(None) # no more jobs
+            except (OSError, ValueError):
+                pass
+            conn.close()
+
+    def fail(self, i, name, error):
+        with self.lock:
+            self.attempts[i] += 1
+            self.failed_on[i].add(name)
+            print('Warning: job {} failed on {}: {}'.format(i, name, error))
+            if self.attempts[i] > self.retries:
+                self.failure = JobFailed('Job {} failed {} times: {}'.format(i, self.attempts[i], error))
+                self.lock.notify_all()
+            else:
+                self.pending.put(i)
+
+def serve(address, handler, authkey=None, wait=WAIT):
+    # Worker loop: connects to the coordinator at address and replies to
+    # each job with (handler(job), None), or (None, repr(exception)) if
+    # the handler raises one, until the coordinator has no more jobs.
+    # Waits up to wait seconds for the coordinator to start listening.
+    check_authkey(authkey)
+    start = time.monotonic()
+    while True:
+        try:
+            conn = Client(address, authkey=authkey)
+            break
+        except (ConnectionRefusedError, FileNotFoundError):
+            if time.monotonic() - start > wait: raise
+            time.sleep(1)
+    with conn:
+        while True:
+            try:
+                job = conn.recv()
+            except EOFError:
+                return
+            if job is None: return
+            try:
+                reply = (handler(job), None)
+            except Exception as e:
+                reply = (None, repr(e))
+            conn.send(reply)
@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+
+#######################################################################
+# Layered lexicon.                                                    #
+# A large, read-only base lexicon (lemma TAB pos TAB form|form|...)   #
+# is compiled once into a cached lookup table. Small overlay files    #
+# with additions, deletions and corrections are applied on top of it  #
+# when the lexicon is loaded, so editing an overlay never requires    #
+# the base to be recompiled.                                          #
+#                                                                     #
+# Overlay files use the lexicon format with an optional 4th column:   #
+#   lemma TAB pos TAB forms             add the analysis (default)    #
+#   lemma TAB pos TAB forms TAB add     the same                      #
+#   lemma TAB pos TAB forms TAB delete  remove the analysis from the  #
+#                                       forms (forms = * for all)     #
+#   lemma TAB pos TAB forms TAB replace the analysis replaces every   #
+#                                       other analysis of the forms   #
+#######################################################################
+
+import os, os.path, pickle, tempfile
+from lib.compression import compression, open_file
+
+class Error(Exception):
+    pass
+
+class LexiconFormatError(Error):
+    pass
+
+COMPILED_EXT = '.lexc'
+COMPILED_VERSION = 1
+OPERATIONS = ['add', 'delete', 'replace']
+
+def strip_numbers(lemma):
+    # Removes homonym numbers from lemmas (e.g. ne1 > ne)
+    return ''.join([char for char in lemma if not char.isdigit()])
+
+def read_lexicon(fname):
+    # Generator over the entries of a lexicon or overlay file.
+    # Yields (lemma, pos, forms, operation) tuples.
+    with open_file(fname, 'r', encoding='utf-8') as f:
+        for line in f:
+            x = line.rstrip().split('\t')
+            if len(x) == 3:
+                yield x[0], x[1], x[2].split('|'), 'add'
+            elif len(x) == 4:
+                if not x[3] in OPERATIONS:
+                    raise LexiconFormatError(
+                        'Unknown operation "{}" in {}'.format(x[3], fname)
+                    )
+                yield x[0], x[1], x[2].split('|'), x[3]
+            # ignore malformed lines
+
+def source_stamp(fname):
+    st = os.stat(fname)
+    return (st.st_size, st.st_mtime_ns)
+
+def parse_base(fname):
+    # Parses a lexicon file into a dictionary with key = form and
+    # value = tuple of (lemma, pos) analyses, in file order.
+    entries = {}
+    for lemma, pos, forms, operation in read_lexicon(fname):
+        for form in forms:
+            analyses = entries.get(form, ())
+            if not (lemma, pos) in analyses:
+                entries[form] = analyses + ((lemma, pos),)
+    return entries
+
+def load_base(fname, cache=True):
+    # Loads the compiled base lexicon, (re)compiling it if the cache
+    # is missing or older than the .tsv file.
+    cachefile = fname + COMPILED_EXT
+    stamp = source_stamp(fname)
+    if cache and os.path.exists(cachefile):
+        try:
+            with open(cachefile, 'rb') as f:
+                d = pickle.load(f)
+            if d['version'] == COMPILED_VERSION and d['source'] == stamp:
+                return d['entries']
+        except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+            pass # recompile
+    entries = parse_base(fname)
+    if cache: save_compiled(cachefile, entries, stamp)
+    return entries
+
+def save_compiled(cachefile, entries, stamp):
+    save_cache(cachefile, {'version': COMPILED_VERSION, 'source': stamp, 'entries': entries})
+
+def save_cache(cachefile, d):
+    # Pickles d to cachefile through a unique temporary file, so that
+    # processes writing the same cache at once don't corrupt it.
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cachefile) or '.', suffix='.tmp')
+    except OSError: # e.g. read-only lexicon directory; run uncached.
+        return
+    try:
+        with open(fd, 'wb') as f:
+            pickle.dump(d, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cachefile)
+    except BaseException as e:
+        os.remove(tmp)
+        if not isinstance(e, OSError): raise
+
+class Lexicon():
+
+    def __init__(self, base='', overlays=[], cache=True):
+        self.base_file = base
+        self.overlay_files = list(overlays)
+        self.cache = cache
+        self.base = load_base(base, cache) if base else {}
+        self.load_overlays()
+
+    def load_overlays(self):
+        # (Re)reads the overlay files. Only the forms they touch are
+        # resolved and stored in self.patched, which shadows the base.
+        self.patched = {}
+        for overlay in self.overlay_files:
+            for lemma, pos, forms, operation in read_lexicon(overlay):
+                self.apply(lemma, pos, forms, operation)
+
+    def apply(self, lemma, pos, forms, operation='add'):
+        analysis = (lemma, pos)
+        if operation == 'delete' and forms == ['*']:
+            forms = [form for form in self.forms() if analysis in self.lookup(form)]
+        replaced = set()
+        for form in forms:
+            analyses = self.lookup(form)
+            if operation == 'add':
+                if analysis in analyses: continue
+                analyses = analyses + (analysis,)
+            elif operation == 'delete':
+                analyses = tuple([x for x in analyses if x != analysis])
+            elif operation == 'replace':
+                # Several replace lines for the same form accumulate.
+                if not form in replaced:
+                    analyses = ()
+                    replaced.add(form)
+                if not analysis in analyses:
+                    analyses = analyses + (analysis,)
+            self.patched[form] = analyses
+
+    def lookup(self, form, ignore_numbers=False):
+        # Returns a tuple of (lemma, pos) analyses for the form.
+        if form in self.patched:
+            analyses = self.patched[form]
+        else:
+            analyses = self.base.get(form, ())
+        if ignore_numbers:
+            # May create duplicates; dict.fromkeys removes them in order
+            analyses = tuple(dict.fromkeys([(strip_numbers(x[0]), x[1]) for x in analyses]))
+        return analyses
+
+    def __contains__(self, form):
+        return bool(self.lookup(form))
+
+    def forms(self):
+        for form in self.base:
+            if form in self.patched:
+                if self.patched[form]: yield form
+            else:
+                yield form
+        for form in self.patched:
+            if self.patched[form] and not form in self.base:
+                yield form
+
+    def lemmas(self, ignore_numbers=False):
+        aset = set()
+        for form in self.forms():
+            for lemma, pos in self.lookup(form, ignore_numbers):
+                aset.add(lemma)
+        return aset
+
+    def groups(self):
+        # Returns dictionary with key = (lemma, pos) and value = list
+        # of forms, i.e. the layout of the .tsv file.
+        d = {}
+        for form in self.forms():
+            for analysis in self.lookup(form):
+                if analysis in d:
+                    d[analysis].append(form)
+                else:
+                    d[analysis] = [form]
+        return d
+
+    def compact(self, outfile=''):
+        # Merges the overlays into the base and writes the result as a
+        # new base lexicon (by default, over the old one). The compiled
+        # cache is written directly from memory, so the new base doesn't
+        # need to be parsed again.
+        outfile = outfile or self.base_file
+        with open_file(outfile + '.tmp', 'w', encoding='utf-8', ext=compression(outfile)) as f:
+            for (lemma, pos), forms in self.groups().items():
+                f.write(lemma + '\t' + pos + '\t' + '|'.join(forms) + '\n')
+        os.replace(outfile + '.tmp', outfile)
+        entries = {}
+        for form in self.forms():
+            entries[form] = self.lookup(form)
+        if self.cache:
+            save_compiled(outfile + COMPILED_EXT, entries, source_stamp(outfile))
+        self.base_file, self.base, self.patched = outfile, entries, {}
+        self.overlay_files = []
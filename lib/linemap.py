@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+#######################################################################
+# Compact map from the lines of a converted file onto positions (line #
+# numbers or byte offsets) in the source file.                        #
+# Converted lines are always numbered 0, 1, 2..., so only the source  #
+# positions are stored, as gaps between consecutive positions. While  #
+# every gap is 1 (an identity or shifted identity map), nothing but   #
+# the first position and the length is kept. Otherwise the gaps go    #
+# into an array whose item size grows only as far as the largest gap. #
+#######################################################################
+
+from array import array
+
+TYPECODES = ['B', 'H', 'I', 'Q'] # 1, 2, 4 and 8 bytes on all supported platforms
+
+class LineMap():
+
+    def __init__(self):
+        self.start = 0 # first source position
+        self.length = 0
+        self.last = -1 # last source position
+        self.gaps = None # array of gaps, once the map isn't an identity
+
+    def append(self, tup):
+        # Takes a (source position, converted line) tuple, like the
+        # list-based linemaps this class replaces.
+        position, counter = tup
+        if counter != self.length:
+            raise ValueError('Converted lines must be appended in order.')
+        if self.length == 0:
+            self.start = position
+        elif self.gaps is None and position != self.last + 1:
+            # No longer an identity: store the gaps so far (all 1).
+            self.gaps = array('B', [1]) * (self.length - 1)
+        if self.gaps is not None and self.length > 0:
+            gap = position - self.last
+            if gap < 0:
+                raise ValueError('Source positions must increase.')
+            while gap >= 1 << (8 * self.gaps.itemsize):
+                self.gaps = array(TYPECODES[TYPECODES.index(self.gaps.typecode) + 1], self.gaps)
+            self.gaps.append(gap)
+        self.last = position
+        self.length += 1
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        # Yields (source position, converted line) tuples.
+        position = self.start
+        if self.gaps is None:
+            for counter in range(self.length):
+                yield position + counter, counter
+        elif self.length:
+            yield position, 0
+            for counter, gap in enumerate(self.gaps, 1):
+                position += gap
+                yield position, counter
+
+    def __repr__(self):
+        return 'LineMap(start={}, length={}, gaps={})'.format(
+            self.start, self.length,
+            self.gaps.typecode + str(len(self.gaps)) if self.gaps is not None else None
+        )
+
+    def to_dict(self):
+        # Metadata; the gaps are serialized separately by gap_bytes()
+        return {
+            'start': self.start, 'length': self.length, 'last': self.last,
+            'typecode': self.gaps.typecode if self.gaps is not None else ''
+        }
+
+    def gap_bytes(self):
+        return self.gaps.tobytes() if self.gaps is not None else b''
+
+    @classmethod
+    def from_dict(cls, d, gap_bytes=b''):
+        linemap = cls()
+        linemap.start, linemap.length, linemap.last = d['start'], d['length'], d['last']
+        if d['typecode']:
+            linemap.gaps = array(d['typecode'])
+            linemap.gaps.frombytes(gap_bytes)
+        return linemap
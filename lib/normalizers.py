@@ -88,3 +88,29 @@ class Normalizer():
             if not self.uppercase: char = char.lower()
             new_s += char
         return new_s
+
+def sniff_lexicon(s):
+    # Sniffs forms in the lexicon 
+    def get_pnc_in_tok(s):
+        pnc_set = set()
+        for i in range(3, len(s)):
+            aslice = s[i-3:i]
+            if aslice[1] == ' ': continue # Ignore slices between 2 tokens.
+            aslice = aslice.lstrip().rstrip() # Strip space
+            alnum_l = [x.isalnum() for x in aslice]
+            if alnum_l.count(False) == len(alnum_l):
+                continue # all pnc = pnc token
+            elif False in alnum_l:
+                pnc_set.add(aslice[alnum_l.index(False)])
+        return list(pnc_set)
+        
+    d = {
+        'uppercase': False,
+        'pnc_in_tok_except': [],
+        'is_ascii': False
+    }
+    
+    if not s.islower(): d['uppercase'] = True
+    d['pnc_in_tok_except'] = get_pnc_in_tok(s)
+    if s.isascii(): d['is_ascii'] = True
+    return d
@@ -0,0 +1,30 @@
+#!/usr/bin/python3
+
+#######################################################################
+# Runs independent jobs in a bounded pool of worker processes.        #
+#######################################################################
+
+import concurrent.futures
+
+def run_jobs(jobs, processes=None):
+    # jobs is a list of (function, args) tuples. Returns a list of
+    # (result, error) tuples in the same order as the jobs, so that
+    # an exception raised by one job doesn't abort the others.
+    # With processes == 1 (or a single job) everything runs in this
+    # process.
+    results = []
+    if processes == 1 or len(jobs) < 2:
+        for function, args in jobs:
+            try:
+                results.append((function(*args), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(function, *args) for function, args in jobs]
+        for future in futures:
+            try:
+                results.append((future.result(), None))
+            except Exception as e:
+                results.append((None, e))
+    return results
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+#######################################################################
+# SQLite store of lemmatization results, indexed on lemma, form and   #
+# score so that results can be looked up across texts without         #
+# reading the output files again. Each token is stored as (text,      #
+# position, form, pos, lemma, score); position is the line of the     #
+# token in the output of its text (0-based, counting the empty lines  #
+# between sentences). Lemmatizing a text again replaces its results.  #
+#                                                                     #
+#   with ResultStore('results.db') as store:                          #
+#       store.query(score=-10)                                        #
+#       store.counts('form', lemma='chevalier')                       #
+#######################################################################
+
+import sqlite3
+from lib.compression import open_file
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS texts (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tokens (
+    text INTEGER NOT NULL REFERENCES texts(id),
+    position INTEGER NOT NULL,
+    form TEXT NOT NULL,
+    pos TEXT NOT NULL,
+    lemma TEXT NOT NULL,
+    score INTEGER,
+    PRIMARY KEY (text, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tokens_lemma ON tokens(lemma);
+CREATE INDEX IF NOT EXISTS tokens_form ON tokens(form);
+CREATE INDEX IF NOT EXISTS tokens_score ON tokens(score);
+CREATE VIEW IF NOT EXISTS results AS
+    SELECT texts.name AS text, position, form, pos, lemma, score
+    FROM tokens JOIN texts ON tokens.text = texts.id;
+'''
+COLUMNS = ['text', 'position', 'form', 'pos', 'lemma', 'score']
+FILTERS = { # query() keyword > SQL condition on the results view
+    'text': 'text = ?', 'form': 'form = ?', 'pos': 'pos = ?', 'lemma': 'lemma = ?',
+    'score': 'score = ?', 'minscore': 'score >= ?', 'maxscore': 'score <= ?'
+}
+
+def read_tokens(f, lines):
+    # Generator over (position, form, pos, lemma, score) for the next
+    # lines lines of lemmatizer output; other lines are skipped.
+    for position in range(lines):
+        x = f.readline().rstrip('\n').split('\t')
+        if len(x) != 4: continue
+        score = int(x[3]) if x[3].lstrip('-').isdigit() else x[3]
+        yield (position, x[0], x[1], x[2], score)
+
+class ResultStore():
+
+    def __init__(self, fname, timeout=600):
+        # timeout: seconds to wait for another process writing to the
+        # store (e.g. in batch mode).
+        self.db = sqlite3.connect(fname, timeout=timeout)
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def add_text(self, name, tokens):
+        # Stores the (position, form, pos, lemma, score) tokens of a text,
+        # replacing those already stored for it.
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO texts (name) VALUES (?)', (name,))
+            text = self.db.execute('SELECT id FROM texts WHERE name = ?', (name,)).fetchone()[0]
+            self.db.execute('DELETE FROM tokens WHERE text = ?', (text,))
+            self.db.executemany(
+                'INSERT INTO tokens VALUES (?, ?, ?, ?, ?, ?)', ((text,) + x for x in tokens)
+            )
+
+    def add_file(self, fname, path_lines):
+        # Stores lemmatizer output (form TAB pos TAB lemma TAB score) for
+        # concatenated texts. path_lines is a list of (text, last line
+        # index), as Concatenater.path_lines.
+        with open_file(fname, 'r', encoding='utf-8') as f:
+            for name, last in path_lines:
+                self.add_text(name, read_tokens(f, last + 1))
+
+    def where(self, filters):
+        # SQL WHERE clause and its parameters for query() filters.
+        conditions, params = [], []
+        for key, value in filters.items():
+            if value is None: continue
+            if not key in FILTERS: raise TypeError('Unknown filter: ' + key)
+            conditions.append(FILTERS[key])
+            params.append(value)
+        return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), params
+
+    def query(self, limit=None, **filters):
+        # Returns a cursor over the (text, position, form, pos, lemma,
+        # score) results matching the filters (see FILTERS), in text
+        # order.
+        where, params = self.where(filters)
+        sql = 'SELECT * FROM results' + where + ' ORDER BY text, position'
+        if limit: sql += ' LIMIT ' + str(int(limit))
+        return self.db.execute(sql, params)
+
+    def counts(self, column, limit=None, **filters):
+        # Returns a cursor over (value, frequency) of a column in the
+        # results matching the filters, most frequent first.
+        if not column in COLUMNS: raise ValueError('Unknown column: ' + column)
+        where, params = self.where(filters)
+        sql = 'SELECT {0}, COUNT(*) AS n FROM results{1} GROUP BY {0} ORDER BY n DESC, {0}'.format(column, where)
+        if limit: sql += ' LIMIT ' + str(int(limit))
+        return self.db.execute(sql, params)
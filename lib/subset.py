@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+#######################################################################
+# Sentence masks: run the expensive stages of the pipeline on only    #
+# some of the sentences of a file and splice the results back in.     #
+# Sentences are blocks of lines separated by empty lines; an empty    #
+# line belongs to the sentence it ends. The mask stores one byte per  #
+# line, so the files themselves are never held in memory.             #
+#######################################################################
+
+from lib.compression import open_file
+
+class Error(Exception):
+    pass
+
+class NotAligned(Error):
+    pass
+
+class SentenceMask():
+
+    def __init__(self):
+        self.keep = bytearray() # 1 for each line in a kept sentence
+        self.sentences = 0
+        self.kept_sentences = 0
+
+    @classmethod
+    def from_file(cls, fname, needs_processing, *others):
+        # needs_processing is called with the columns of each non-empty
+        # line of fname, followed by the columns of the same line in each
+        # of the other (line-aligned) files; a sentence is kept if it
+        # returns True for any of its lines.
+        mask = cls()
+        start, keep = 0, False
+        files = [open_file(x, 'r', encoding='utf-8') for x in (fname,) + others]
+        try:
+            for lines in zip(*files):
+                x = lines[0].rstrip().split('\t')
+                mask.keep.append(0)
+                if x[0]:
+                    keep = keep or needs_processing(x, *[y.rstrip().split('\t') for y in lines[1:]])
+                else:
+                    mask.end_sentence(start, keep)
+                    start, keep = len(mask.keep), False
+        finally:
+            for f in files: f.close()
+        if start < len(mask.keep): mask.end_sentence(start, keep)
+        return mask
+
+    def end_sentence(self, start, keep):
+        self.sentences += 1
+        if keep:
+            self.kept_sentences += 1
+            self.keep[start:] = b'\x01' * (len(self.keep) - start)
+
+    def __len__(self):
+        return len(self.keep)
+
+    def kept(self):
+        # Number of lines kept
+        return self.keep.count(1)
+
+    def subset(self, infile, outfile):
+        # Writes the lines of the kept sentences. Raises NotAligned if
+        # infile doesn't have a line for each line of the mask (e.g. a
+        # tagger output left over from another input).
+        n = 0
+        with open_file(infile, 'r', encoding='utf-8') as fin:
+            with open_file(outfile, 'w', encoding='utf-8') as fout:
+                for n, line in enumerate(fin, 1):
+                    if n > len(self.keep): break
+                    if self.keep[n - 1]: fout.write(line)
+        if n != len(self.keep):
+            raise NotAligned('{} is not line-aligned with the input ({} lines expected).'.format(infile, len(self.keep)))
+
+    def splice(self, subsetfile, fillers, outfile):
+        # Writes the lines of the processed subset file for the kept
+        # sentences and the lines of the fillers iterable (one for every
+        # line, kept or not) for the others.
+        with open_file(subsetfile, 'r', encoding='utf-8') as fin:
+            with open_file(outfile, 'w', encoding='utf-8') as fout:
+                for keep, filler in zip(self.keep, fillers):
+                    fout.write(fin.readline() if keep else filler)
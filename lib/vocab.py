@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+
+#######################################################################
+# Vocabulary: maps values (forms, lemmas and tags, or tuples of them) #
+# to integer ids and back. Each value is stored once, so decoded      #
+# values are shared objects whose hashes are already computed, and    #
+# results can be cached under small tuples of ids. Ids are dense      #
+# (0, 1, 2...) and only mean something to the Vocab that gave them.   #
+#######################################################################
+
+class Vocab():
+
+    def __init__(self, values=[]):
+        self.ids = {} # key = value, value = id
+        self.values = [] # index = id
+        for value in values: self.encode(value)
+
+    def encode(self, value):
+        # Returns the id of value, adding it if it is new.
+        try:
+            return self.ids[value]
+        except KeyError:
+            self.ids[value] = len(self.values)
+            self.values.append(value)
+            return len(self.values) - 1
+
+    def decode(self, i):
+        return self.values[i]
+
+    def __contains__(self, value):
+        return value in self.ids
+
+    def __len__(self):
+        return len(self.values)
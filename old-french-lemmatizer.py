@@ -17,17 +17,32 @@ class Error(Exception):
 class SourceDataError(Error):
     pass
 
-import argparse, subprocess, os.path, tempfile, shutil, textwrap
+import argparse, contextlib, json, os, os.path, sys, tempfile, shutil, textwrap, time, traceback
 from lib.normalizers import Normalizer
 from lib.concat import Concatenater
+from lib.lexicon import source_stamp
+from lib.parallel import run_jobs
+from lib.compression import compression, copy_file, open_file, strip_compression
+import lib.distributed
+import lib.store
 import scripts.ofrpostprocess
 import scripts.standardizepos
 import scripts.lemmacompare
 import scripts.convertfiles
-import scripts.rnntag
+import scripts.taggers
+import scripts.lemmatizer
+import lib.subset
 
 opj = os.path.join
 
+SHARDSIZE = 1000 # sentences per shard in distributed mode
+BATCH_EXTS = ['.txt', '.tsv', '.csv', '.conllu', '.xml'] # input files in a batch directory
+BATCH_DIR = '.batch' # checkpoints, logs and report, in the batch output directory
+BATCH_OPTIONS = [ # main() arguments passed on in batch mode
+    'rnnpath', 'ttpath', 'lexicons', 'overlays', 'inputanno', 'exportpos', 'cachedir',
+    'skipgold', 'selective', 'bucket', 'rnnworkers', 'rnnthreads', 'standin', 'store'
+]
+
 
 def normalize_infile(infile, outfile):
     # Removes all annotation.
@@ -36,8 +51,8 @@ def normalize_infile(infile, outfile):
     # Return max number of columns.
     normalizer = Normalizer(pnc_in_tok=False)
     #normalizer.pnc_in_tok_except.extend(['@', '#']) # Used in MCVF
-    with open(infile, 'r', encoding='utf-8') as fin:
-        with open(outfile, 'w', encoding='utf-8') as fout:
+    with open_file(infile, 'r', encoding='utf-8') as fin:
+        with open_file(outfile, 'w', encoding='utf-8') as fout:
             l = []
             for line in fin:
                 x = line.rstrip().split('\t')
@@ -50,80 +65,88 @@ def normalize_infile(infile, outfile):
                     fout.write(x[0] + '\n')
     return max(l)
 
-def main(tmpdir, infiles=[], rnnpath='', ttpath='', lexicons=[], outfile='', outdir='', inputanno='gold', printunk=False, exportpos=False):
-    
-    script_path = os.path.dirname(__file__)
-    # -1. Run the converter and store converters
-    print('Converting and concatenating input files.')
-    converters, converted_infiles = [], []
-    for infile in infiles:
-        if os.path.splitext(infile)[1] not in ['', '.txt', '.tsv']:
-            converter = scripts.convertfiles.get_converter(infile)
-            converter.exportpos = exportpos
-            converters.append(converter)
-            converted_infiles.append(opj(tmpdir, os.path.basename(infile + '.txt')))
-            converter.from_source(converted_infiles[-1])
-        else:
-            converted_infiles.append(infile)
-            converters.append(None)
-    
-    # 0. Concatenate input files
-    catfile = opj(tmpdir, 'cat.txt')
-    concatenater = Concatenater()
-    concatenater.concatenate(converted_infiles, catfile)
-    max_cols = normalize_infile(catfile, opj(tmpdir, 'basefile.txt'))
-    # 1. Standardize gold pos tags from input file
-    if max_cols > 1:
-        print('Converting input part-of-speech tags to UD.')
-        try:
-            scripts.standardizepos.main(catfile, opj(tmpdir, 'infile_normed.txt'))
-        except scripts.standardizepos.MapNotFound:
-            print("Warning: Couldn't standardize pos. Assuming already in UD.")
-            shutil.copy(catfile, opj(tmpdir, 'infile_normed.txt'))
-    taggerouts = []
-    # 2. Call RNN tagger
-    for lang, fname in [('old-french', 'rnn_of.txt')]:#, ('middle-french', 'rnn_midf.txt')]:
-    # Updated for RNN Tagger v. 1.4.7
-    # Still performs better with just the Old French model.
-    #lang, fname = 'middle-french', 'rnn.txt'
-        if rnnpath: # Inherit venv; call script
-            print('Calling the RNN Tagger')
-            scripts.rnntag.main(rnnpath, lang, [opj(tmpdir, 'basefile.txt')],
-                outfile=opj(tmpdir, fname))
-            taggerouts.append(opj(tmpdir, fname))
-        elif os.path.exists(opj(tmpdir, fname)):
-            print('Using RNN tags from ' + opj(tmpdir, fname))
-            print("(Move this file or give --rnnpath to disable this.)")
-            taggerouts.append(opj(tmpdir, fname))
-            rnnpath = 'yes'
-    # 2b. Call the Tree Tagger
+def convert_infile(infile, outfile, exportpos=False, sidecar='', processes=1):
+    # Worker function: converts one input file. Returns the converter.
+    converter = scripts.convertfiles.get_converter(infile)
+    converter.exportpos = exportpos
+    converter.processes = processes
+    converter.convert(outfile, sidecar)
+    return converter
+
+def lookup(tmpdir, basefile, lemmatizer, suffix=''):
+    # Steps 4 and 5: looks up the tokens of basefile in the lexicons.
+    # Returns a list with the lookup file (form TAB pos TAB lemma TAB
+    # pos TAB lemma...) with standardized pos tags.
+    print('Lemmatizing using lexicon files and converting PoS tags to UD.')
+    lookupfile = opj(tmpdir, 'lookup_normed' + suffix + '.txt')
+    with open_file(basefile, 'r', encoding='utf-8') as fin:
+        with open_file(lookupfile, 'w', encoding='utf-8') as fout:
+            for line in fin:
+                form = line.rstrip()
+                analyses = lemmatizer.lookup(form) if form else []
+                fout.write('\t'.join([form] + [y for x in analyses for y in x]) + '\n')
+    return [lookupfile]
+
+def taggers(rnnpath='', ttpath='', lexicons=[], overlays=[], standin=None, bucket=False, rnnworkers=1, rnnthreads=None):
+    # Returns the list of (output file name, tagger backend) to run.
+    backends = []
+    if rnnpath:
+        # Updated for RNN Tagger v. 1.4.7
+        # Still performs better with just the Old French model.
+        backends.append(('rnn_of.txt', scripts.taggers.get_backend(
+            'rnn', rnnpath=rnnpath, lang='old-french',
+            bucket=bucket, workers=rnnworkers, threads=rnnthreads
+        )))
     if rnnpath and ttpath:
         print('WARNING: Tests suggest that better results are achieved with the RNN Tagger alone.')
     if ttpath:
         # BFM fro model
-        args = [
-            opj(script_path, 'tree-tag.py'),
-            ttpath, '--lang', 'old-french', '--infiles', opj(tmpdir, 'basefile.txt'),
-            '--outfile', opj(tmpdir, 'tt-fro.txt')
-        ]
-        print('Calling the TreeTagger (fro model).')
-        process = subprocess.run(args)
-        if process.returncode == 0:
-            taggerouts.append(opj(tmpdir, 'tt-fro.txt'))
+        backends.append(('tt-fro.txt', scripts.taggers.get_backend(
+            'treetagger', ttpath=ttpath, lang='old-french'
+        )))
         # Stein OF model (in TreeTagger root dir)
-        args = [
-            opj(script_path, 'tree-tag.py'),
-            ttpath, '--parpath', opj(ttpath, 'stein-oldfrench.par'),
-            '--infiles', opj(tmpdir, 'basefile.txt'),
-            '--outfile', opj(tmpdir, 'tt-stein.txt')
-        ]
-        print('Calling the TreeTagger (Stein model).')
-        process = subprocess.run(args)
-        if process.returncode == 0:
-            taggerouts.append(opj(tmpdir, 'tt-stein.txt'))
+        backends.append(('tt-stein.txt', scripts.taggers.get_backend(
+            'treetagger', ttpath=ttpath, parpath=opj(ttpath, 'stein-oldfrench.par')
+        )))
+    if standin is not None:
+        backends.append(('standin.txt', scripts.taggers.get_backend(
+            'lexicon', lexicons=lexicons, overlays=overlays, latency=standin
+        )))
+    return backends
+
+def reused_rnn(tmpdir, backends):
+    # True if RNN tags from an earlier run (tmpdir/rnn_of.txt) are used
+    # instead of running the RNN Tagger.
+    return not [x for x in backends if x[1].name == 'rnn'] and os.path.exists(opj(tmpdir, 'rnn_of.txt'))
+
+def annotate(tmpdir, basefile, normedfile, outfile, max_cols, lemmatizer, inputanno='gold', backends=[], lookupfiles=None, suffix=''):
+    # Steps 2 to 6: tags, looks up and scores the tokens of basefile
+    # (normedfile holds the input annotation, if max_cols > 1).
+    # backends is the list returned by taggers(); lemmatizer is the
+    # scripts.lemmatizer.Lemmatizer which looks up and scores the tokens.
+    # Lexicon lookups already run on basefile can be passed as lookupfiles.
+    # suffix is added to the names of the tagger outputs in tmpdir, which
+    # must be line-aligned with basefile (e.g. '-subset' for a subset of
+    # basefile.txt).
+    taggerouts = [] # (file, has lemmas)
+    # 2. Call the taggers
+    if reused_rnn(tmpdir, backends):
+        print('Using RNN tags from ' + opj(tmpdir, 'rnn_of.txt'))
+        print("(Move this file or give --rnnpath to disable this.)")
+        taggerouts.append((opj(tmpdir, 'rnn_of' + suffix + '.txt'), True))
+    for fname, backend in backends:
+        fname = fname[:-4] + suffix + '.txt'
+        print('Calling the ' + backend.name + ' tagger (' + fname + ').')
+        try:
+            backend.tag_file(basefile, opj(tmpdir, fname))
+        except Exception as e:
+            if not backend.optional: raise
+            print('Warning: ' + backend.name + ' tagger failed: ' + repr(e))
+            continue
+        taggerouts.append((opj(tmpdir, fname), backend.lemmas))
     # 3. Standardize pos tags
     print(taggerouts)
-    for i, taggerout in enumerate(taggerouts):
+    for i, (taggerout, lemmas) in enumerate(taggerouts):
         print('Converting part-of-speech tags from the tagger to UD.')
         new_taggerout = taggerout[:-4] + '_normed.txt'
         try:
@@ -131,86 +154,503 @@ def main(tmpdir, infiles=[], rnnpath='', ttpath='', lexicons=[], outfile='', out
         except scripts.standardizepos.MapNotFound:
             print("Warning: Couldn't standardize pos. Assuming already in UD.")
             shutil.copy(taggerout, new_taggerout)
-        taggerouts[i] = new_taggerout
+        taggerouts[i] = (new_taggerout, lemmas)
         
-    if lexicons:
-    #if False:
-        # 4. Call lemma lookup on each lexicon file
-        print('Lemmatizing using lexicon files and converting PoS tags to UD.')
-        for i, lexicon in enumerate(lexicons):
-            args = [
-                opj(script_path, 'lemma-lookup.py'), '--ignore_numbers',
-                lexicon, '--infiles', opj(tmpdir, 'basefile.txt'), 
-                '--outfile', opj(tmpdir, 'lookup' + str(i) + '.txt')
-            ]
-            subprocess.run(args)
-            # 5. Standardize pos tags
-            try:
-                scripts.standardizepos.main(
-                    opj(tmpdir, 'lookup' + str(i) + '.txt'),
-                    opj(tmpdir, 'lookup_normed' + str(i) + '.txt')
-                )
-            except scripts.standardizepos.MapNotFound:
-                print("Warning: Couldn't standardize pos. Assuming already in UD.")
-                shutil.copy(
-                    opj(tmpdir, 'lookup' + str(i) + '.txt'),
-                    opj(tmpdir, 'lookup_normed' + str(i) + '.txt')
-                )
-    # 6. Run lemma comparison
-    kwargs = {
-        'ignore_numbers': True,
-        'outfile': opj(tmpdir, 'out.txt')
-    }
-    if max_cols == 2 and inputanno == 'gold':
-        kwargs['goldpos'] = opj(tmpdir, 'infile_normed.txt')
-    if max_cols == 3 and inputanno == 'gold':
-        kwargs['goldposlemma'] = opj(tmpdir, 'infile_normed.txt')
-    if max_cols == 2 and inputanno == 'auto':
-        kwargs['autopos'] = [opj(tmpdir, 'infile_normed.txt')]
-    kwargs['autoposlemma'] = []
+    # 4.-6. Look up the tokens and score them. The sources are those
+    # lemmacompare.py takes.
+    autopos = [x for x, lemmas in taggerouts if not lemmas]
+    autoposlemma = [x for x, lemmas in taggerouts if lemmas]
+    if max_cols == 2 and inputanno == 'auto' and not autopos:
+        autopos = [normedfile]
     if max_cols == 3 and inputanno == 'auto':
-        kwargs['autoposlemma'].append(opj(tmpdir, 'infile_normed.txt'))
-    if rnnpath:
-        kwargs['autoposlemma'].append(taggerouts.pop(0))
-        #kwargs['autoposlemma'].append(taggerouts.pop(0)) # mf model
-    if ttpath and taggerouts:
-        kwargs['autopos'] = taggerouts[:]
-    if lexicons:
-    #if False:
-        kwargs['lookupposlemma'] = [opj(tmpdir, 'lookup_normed' + str(i) + '.txt') for i in range(len(lexicons))]
-        kwargs['lexicons'] = [x for x in lexicons]
+        autoposlemma.insert(0, normedfile)
+    gold = [normedfile] if max_cols in [2, 3] and inputanno == 'gold' else []
+    if not lemmatizer.lexicons and not autoposlemma:
+        raise SourceDataError('No source for lemmas provided.')
     print('Comparing results and scoring final lemmatization.')
-    #print(kwargs)
-    scripts.lemmacompare.main(**kwargs)
+    files = [basefile] + autopos + autoposlemma + gold + (lookupfiles or [])
+    # Columns of the files in x[1:n1], x[n1:n2], x[n2:n3] and x[n3:]
+    n1 = 1 + len(autopos)
+    n2 = n1 + len(autoposlemma)
+    n3 = n2 + len(gold)
+    fs = [open_file(x, 'r', encoding='utf-8') for x in files]
+    with open_file(outfile, 'w', encoding='utf-8') as fout:
+        for lines in zip(*fs):
+            x = [line.rstrip().split('\t') for line in lines]
+            # The form is that of the first pos source, if any
+            form = x[1 if n3 > 1 else 0][0]
+            if form == '':
+                fout.write('\n') # just write empty line
+                continue
+            goldpos, goldlemmas = '', []
+            if gold:
+                goldpos = scripts.lemmacompare.get_pos(x[n2])
+                if max_cols == 3 and len(x[n2]) > 2: goldlemmas = x[n2][2].split('|')
+            if n2 == 1 and not goldlemmas and lookupfiles is None:
+                # Lexicon-only: a single probe of the decision table
+                lemma, score = lemmatizer.decide(x[0][0], goldpos)
+                fout.write('\t'.join([form, goldpos, lemma, str(score)]) + '\n')
+                continue
+            if lookupfiles is None:
+                lookups = lemmatizer.lookup(x[0][0])
+            else:
+                lookups = [(y[i], y[i + 1]) for y in x[n3:] for i in range(1, len(y) - 1, 2)]
+            token = lemmatizer.score(
+                form, goldpos, goldlemmas,
+                [scripts.lemmacompare.get_pos(y) for y in x[1:n1]],
+                [scripts.lemmacompare.get_pos_lemma(y) for y in x[n1:n2]],
+                lookups
+            )
+            fout.write('\t'.join([token.form, token.pos, token.lemma, str(token.score)]) + '\n')
+    for f in fs: f.close()
+
+def gold_line(baseline, normedline, tagged=True):
+    # Output line for a token with gold annotation, as lemmacompare
+    # scores it: gold pos, gold lemma without homonym number, score 10.
+    # The form is taken from the tagger input if there is a tagger,
+    # otherwise from the input file. Returns '' for other tokens.
+    x = normedline.rstrip().split('\t')
+    if not x[0]: return '\n'
+    if scripts.lemmatizer.lacks_gold(x): return ''
+    form = baseline.rstrip('\n') if tagged else x[0]
+    lemmas = [y[:-1] if y and y[-1].isdigit() else y for y in x[2].split('|')]
+    return '\t'.join([form, x[1], '|'.join(lemmas), '10']) + '\n'
+
+def lexicon_analysis(form, lookups):
+    # Selective mode: returns the (pos, lemma) of a token if the lexicons
+    # give it a single lemma (pos tags of that lemma are joined with |),
+    # or if it is punctuation, else None.
+    # lookups are the columns of the token's lines in the lookup files.
+    if not any([char.isalnum() for char in form]):
+        return 'PUNCT', form
+    poss, lemmas = [], set()
+    for x in lookups:
+        for i in range(1, len(x) - 1, 2):
+            if not x[i + 1]: continue
+            lemmas.add(x[i + 1])
+            for pos in x[i].split('|'):
+                if not pos in poss: poss.append(pos)
+    if len(lemmas) != 1: return None
+    return '|'.join(poss), lemmas.pop()
+
+def selective_analysis(form, gold, lookups):
+    # Selective mode: the (pos, lemma) of a token resolved by the
+    # lexicons, or None. With gold pos (gold is the columns of the input
+    # annotation line, or None), the lexicon analysis must agree with it
+    # and the gold pos is kept.
+    analysis = lexicon_analysis(form, lookups)
+    if analysis is None or gold is None: return analysis
+    goldpos = scripts.lemmacompare.get_pos(gold)
+    if not goldpos: return analysis
+    if not set(goldpos.split('|')) & set(analysis[0].split('|')): return None
+    return goldpos, analysis[1]
+
+def resolved_line(x, others, skipgold=False, selective=False, goldpos=False):
+    # True if a token needs neither tagging nor lookup: it has gold
+    # annotation or, in selective mode, a single lexicon lemma. others
+    # are the columns of the input annotation line (if goldpos, i.e.
+    # there is gold annotation) followed by the lookup lines (if
+    # selective).
+    if skipgold and not scripts.lemmatizer.lacks_gold(others[0]): return True
+    if selective and selective_analysis(
+        x[0], others[0] if goldpos else None, others[1:] if goldpos else others
+    ): return True
+    return False
+
+def filler_line(lines, skipgold=False, selective=False, tagged=True, goldpos=False):
+    # Output line for a resolved token: lines are the basefile line and
+    # the lines of the other files passed to resolved_line. Lexicon-only
+    # lemmas get a score of 2, like an unverified single lookup lemma.
+    form = lines[0].rstrip('\n')
+    if not form: return '\n'
+    if skipgold:
+        line = gold_line(lines[0], lines[1], tagged)
+        if line: return line
+    if selective:
+        analysis = selective_analysis(
+            form, lines[1].rstrip().split('\t') if goldpos else None,
+            [x.rstrip().split('\t') for x in (lines[2:] if goldpos else lines[1:])]
+        )
+        if analysis: return '\t'.join([form, analysis[0], analysis[1], '2']) + '\n'
+    return ''
+
+def filter_main(rnnpath='', ttpath='', lexicons=[], overlays=[], inputanno='gold', bucket=False, rnnworkers=1, rnnthreads=None, standin=None, **kwargs):
+    # Filter mode: lemmatizes one-token-per-line text (optionally with
+    # UD pos tags and lemmas) from stdin and writes each sentence to
+    # stdout as soon as it is complete. Messages go to stderr. Options
+    # which only apply to files are ignored.
+    with contextlib.redirect_stdout(sys.stderr):
+        backends = taggers(rnnpath, ttpath, lexicons, overlays, standin, bucket, rnnworkers, rnnthreads)
+        lemmatizer = scripts.lemmatizer.Lemmatizer(
+            lexicons, overlays, [backend for fname, backend in backends], inputanno,
+            table=not backends and inputanno != 'auto'
+        )
+    sys.stdin.reconfigure(encoding='utf-8')
+    sys.stdout.reconfigure(encoding='utf-8')
+    run_filter(sys.stdin, sys.stdout, lemmatizer)
+
+def run_filter(fin, fout, lemmatizer):
+    # Output is line-aligned with the input; fout is flushed after each
+    # sentence.
+    def write(sentence):
+        with contextlib.redirect_stdout(sys.stderr):
+            tokens = lemmatizer.lemmatize(sentence)
+        for token in tokens:
+            fout.write('\t'.join([token.form, token.pos, token.lemma, str(token.score)]) + '\n')
+
+    sentence = []
+    for line in iter(fin.readline, ''): # doesn't wait for more input
+        x = line.rstrip().split('\t')
+        if x[0]:
+            sentence.append(x)
+            continue
+        if sentence: write(sentence)
+        fout.write('\n')
+        fout.flush()
+        sentence = []
+    if sentence: write(sentence)
+    fout.flush()
+
+def lemmatize_tmpdir(tmpdir, max_cols, backends, lemmatizer, inputanno='gold', skipgold=True, selective=False):
+    # Steps 1b.-6. of main(): tags, looks up and scores basefile.txt in
+    # tmpdir (with the input annotation in infile_normed.txt) to out.txt.
+    # 1b. Only tag and look up sentences with tokens lacking gold annotation
+    # (and, in selective mode, tokens without a single lexicon lemma)
+    basefile, normedfile, lookupfiles = opj(tmpdir, 'basefile.txt'), opj(tmpdir, 'infile_normed.txt'), None
+    tagged = backends or os.path.exists(opj(tmpdir, 'rnn_of.txt'))
+    skipgold = skipgold and max_cols == 3 and inputanno == 'gold'
+    if selective and not (tagged and lemmatizer.lexicons):
+        print('Warning: --selective needs a tagger and lexicons; ignored.')
+        selective = False
+    if selective:
+        lookupfiles = lookup(tmpdir, basefile, lemmatizer)
+    goldpos = max_cols > 1 and inputanno == 'gold' # gold pos in normedfile
+    others = ([normedfile] if goldpos else []) + (lookupfiles if selective else [])
+    mask = None
+    if skipgold or selective:
+        mask = lib.subset.SentenceMask.from_file(
+            basefile, lambda x, *y: not resolved_line(x, y, skipgold, selective, goldpos), *others
+        )
+        print('{} of {} sentences need tagging.'.format(mask.kept_sentences, mask.sentences))
+        reused = [opj(tmpdir, 'rnn_of.txt')] if reused_rnn(tmpdir, backends) else []
+        for fname in [basefile] + ([normedfile] if max_cols > 1 else []) + (lookupfiles or []) + reused:
+            mask.subset(fname, fname[:-4] + '-subset.txt')
+        basefile, normedfile = basefile[:-4] + '-subset.txt', normedfile[:-4] + '-subset.txt'
+        if selective: lookupfiles = [x[:-4] + '-subset.txt' for x in lookupfiles]
+    # 2.-6. Tag, look up and score
+    if mask is None:
+        annotate(
+            tmpdir, basefile, normedfile, opj(tmpdir, 'out.txt'), max_cols,
+            lemmatizer, inputanno, backends
+        )
+    else:
+        if mask.kept_sentences:
+            annotate(
+                tmpdir, basefile, normedfile, opj(tmpdir, 'out-subset.txt'), max_cols,
+                lemmatizer, inputanno, backends, lookupfiles, '-subset'
+            )
+        else:
+            open_file(opj(tmpdir, 'out-subset.txt'), 'w').close()
+        files = [open_file(x, 'r', encoding='utf-8') for x in [opj(tmpdir, 'basefile.txt')] + others]
+        mask.splice(
+            opj(tmpdir, 'out-subset.txt'),
+            (filler_line(lines, skipgold, selective, tagged, goldpos) for lines in zip(*files)),
+            opj(tmpdir, 'out.txt')
+        )
+        for f in files: f.close()
+
+def shard_ranges(basefile, path_lines, size=SHARDSIZE):
+    # Splits the concatenated input into shards of size sentences, as
+    # (first line, last line + 1) ranges of basefile. Shards end after an
+    # empty line: at the end of each input file that ends with one (as
+    # given by Concatenater.path_lines), or after size sentences.
+    ends, end = set(), 0
+    for path, i in path_lines:
+        end += i + 1
+        ends.add(end)
+    ranges, start, sentences, n = [], 0, 0, 0
+    with open_file(basefile, 'r', encoding='utf-8') as fin:
+        for n, line in enumerate(fin, 1):
+            if line.strip(): continue
+            sentences += 1
+            if sentences >= size or n in ends:
+                ranges.append((start, n))
+                start, sentences = n, 0
+    if start < n: ranges.append((start, n))
+    return ranges
+
+def distribute(tmpdir, path_lines, max_cols, address, authkey=None, shardsize=SHARDSIZE, options={}):
+    # Steps 1b.-6. of main() on workers (see worker_main()): sends shards
+    # of basefile.txt and infile_normed.txt in tmpdir to the workers
+    # which connect to address, and writes their output to out.txt in
+    # order. options are the arguments of lemmatize_tmpdir() for the
+    # job. Failed shards are sent again, to any worker.
+    with open_file(opj(tmpdir, 'basefile.txt'), 'r', encoding='utf-8') as f:
+        baselines = f.readlines()
+    normedlines = None
+    if max_cols > 1:
+        with open_file(opj(tmpdir, 'infile_normed.txt'), 'r', encoding='utf-8') as f:
+            normedlines = f.readlines()
+    jobs = [
+        (baselines[i:j], normedlines[i:j] if normedlines else None, max_cols, options)
+        for i, j in shard_ranges(opj(tmpdir, 'basefile.txt'), path_lines, shardsize)
+    ]
+    print('Waiting for workers on {} to lemmatize {} shards.'.format(address, len(jobs)))
+    coordinator = lib.distributed.Coordinator(lib.distributed.parse_address(address), authkey)
+    with open_file(opj(tmpdir, 'out.txt'), 'w', encoding='utf-8') as fout:
+        for lines in coordinator.run(jobs):
+            fout.writelines(lines)
+
+def worker_main(worker, rnnpath='', ttpath='', lexicons=[], overlays=[], bucket=False, rnnworkers=1, rnnthreads=None, standin=None, authkey=None, **kwargs):
+    # Worker mode: loads the taggers and lexicons once, then lemmatizes
+    # the shards sent by the coordinator at address worker (main() with
+    # coordinator) until it has no more.
+    backends = taggers(rnnpath, ttpath, lexicons, overlays, standin, bucket, rnnworkers, rnnthreads)
+    lemmatizer = scripts.lemmatizer.Lemmatizer(lexicons, overlays, table=not backends)
+    def lemmatize_shard(shard):
+        baselines, normedlines, max_cols, options = shard
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open_file(opj(tmpdir, 'basefile.txt'), 'w', encoding='utf-8') as f:
+                f.writelines(baselines)
+            if normedlines is not None:
+                with open_file(opj(tmpdir, 'infile_normed.txt'), 'w', encoding='utf-8') as f:
+                    f.writelines(normedlines)
+            lemmatize_tmpdir(tmpdir, max_cols, backends, lemmatizer, **options)
+            with open_file(opj(tmpdir, 'out.txt'), 'r', encoding='utf-8') as f:
+                return f.readlines()
+    print('Worker connecting to ' + worker)
+    lib.distributed.serve(lib.distributed.parse_address(worker), lemmatize_shard, authkey)
+
+def batch_files(batch, outdir=''):
+    # Input files of a batch: the files with a BATCH_EXTS extension in a
+    # directory tree (except hidden ones and outdir), or the files listed
+    # in a manifest (one path per line, relative to the manifest; lines
+    # starting with # are comments). Returns (root, paths): the outputs
+    # mirror the paths relative to root.
+    if os.path.isdir(batch):
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(batch):
+            dirnames[:] = sorted([
+                x for x in dirnames if not x.startswith('.') and \
+                not (outdir and os.path.abspath(opj(dirpath, x)) == os.path.abspath(outdir))
+            ])
+            paths.extend([
+                opj(dirpath, x) for x in sorted(filenames)
+                if not x.startswith('.') and os.path.splitext(strip_compression(x))[1] in BATCH_EXTS
+            ])
+        return os.path.abspath(batch), paths
+    with open_file(batch, 'r', encoding='utf-8') as f:
+        paths = [
+            opj(os.path.dirname(batch), line.strip()) for line in f
+            if line.strip() and not line.startswith('#')
+        ]
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(x)) for x in paths]) if paths else ''
+    return root, paths
+
+pipelines = {} # batch mode: key = options, value = (backends, lemmatizer) of this process
+
+def batch_pipeline(options):
+    # Taggers and lemmatizer for batch_file(), built once per process (as
+    # worker_main() does) and reused for the following files.
+    key = json.dumps(options, sort_keys=True)
+    if not key in pipelines:
+        backends = taggers(
+            options['rnnpath'], options['ttpath'], options['lexicons'], options['overlays'],
+            options['standin'], options['bucket'], options['rnnworkers'], options['rnnthreads']
+        )
+        pipelines[key] = (
+            backends, scripts.lemmatizer.Lemmatizer(options['lexicons'], options['overlays'], table=not backends)
+        )
+    return pipelines[key]
+
+def batch_done(infile, outfile, checkpoint, settings):
+    # True if the checkpoint says infile, unchanged since, was lemmatized
+    # with the same settings, and the output is still there.
+    try:
+        with open(checkpoint, 'r', encoding='utf-8') as f:
+            done = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return done.get('source') == list(source_stamp(infile)) and \
+        done.get('settings') == settings and os.path.exists(outfile)
+
+def batch_file(infile, outfile, checkpoint, options, settings):
+    # Worker function of batch_main(): lemmatizes infile to outfile,
+    # which only appears once it is complete, then writes the checkpoint.
+    # Messages go to a log next to the checkpoint. Returns the number of
+    # tokens.
+    start, stamp = time.time(), source_stamp(infile)
+    for dirname in set([os.path.dirname(outfile), os.path.dirname(checkpoint)]):
+        os.makedirs(dirname, exist_ok=True)
+    # Same extensions as outfile, for back-conversion and compression
+    partfile = '{0}.part{1}'.format(*os.path.splitext(strip_compression(outfile))) + compression(outfile)
+    with open(checkpoint[:-5] + '.log', 'w', encoding='utf-8') as log:
+        try:
+            with contextlib.redirect_stdout(log), tempfile.TemporaryDirectory() as tmpdir:
+                main(tmpdir, [infile], outfile=partfile, processes=1, pipeline=batch_pipeline(options), **options)
+                with open_file(opj(tmpdir, 'out-pp.txt'), 'r', encoding='utf-8') as f:
+                    tokens = sum([1 for line in f if line.strip()])
+            os.replace(partfile, outfile)
+        except BaseException: # also remove the partial output if interrupted
+            traceback.print_exc(file=log)
+            if os.path.exists(partfile): os.remove(partfile)
+            raise
+    seconds = time.time() - start
+    with open(checkpoint + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'source': list(stamp), 'settings': settings, 'tokens': tokens, 'seconds': seconds}, f)
+    os.replace(checkpoint + '.tmp', checkpoint)
+    print('Done {} ({} tokens, {:.1f} s)'.format(infile, tokens, seconds))
+    return tokens
+
+def batch_main(batch, outdir='', processes=None, **kwargs):
+    # Batch mode: lemmatizes each file of a directory tree or manifest
+    # separately (processes files at a time) to the same path under
+    # outdir. Completed files are checkpointed in outdir/BATCH_DIR and
+    # skipped when the batch is run again, so an interrupted batch can
+    # be resumed. Prints a report, also written to BATCH_DIR/report.tsv.
+    root, infiles = batch_files(batch, outdir)
+    options = {k: kwargs[k] for k in BATCH_OPTIONS}
+    settings = {k: v for k, v in options.items() if not k in ['cachedir', 'store']}
+    # Files are lemmatized again if a lexicon or overlay has changed
+    settings['lexicon_stamps'] = [list(source_stamp(x)) for x in options['lexicons'] + options['overlays']]
+    jobs, skipped = [], []
+    for infile in infiles:
+        rel = os.path.relpath(os.path.abspath(infile), root)
+        outfile, checkpoint = opj(outdir, rel), opj(outdir, BATCH_DIR, rel + '.done')
+        if batch_done(infile, outfile, checkpoint, settings):
+            skipped.append(infile)
+        else:
+            jobs.append((batch_file, (infile, outfile, checkpoint, options, settings)))
+    print('Batch of {} files, {} already done.'.format(len(infiles), len(skipped)))
+    start = time.time()
+    results = run_jobs(jobs, processes or 1)
+    seconds = time.time() - start
+    done = [(args[0], tokens) for (function, args), (tokens, error) in zip(jobs, results) if not error]
+    failed = [(args[0], error) for (function, args), (tokens, error) in zip(jobs, results) if error]
+    tokens = sum([x[1] for x in done])
+    print('Batch report')
+    print('Done: {} files, {} tokens in {:.1f} s ({:.1f} tokens/s, {:.2f} files/s)'.format(
+        len(done), tokens, seconds, tokens / seconds if seconds else 0, len(done) / seconds if seconds else 0
+    ))
+    print('Skipped (already done): {} files'.format(len(skipped)))
+    print('Failed: {} files'.format(len(failed)))
+    for infile, error in failed:
+        print('\t' + infile + ': ' + repr(error))
+    os.makedirs(opj(outdir, BATCH_DIR), exist_ok=True)
+    with open(opj(outdir, BATCH_DIR, 'report.tsv'), 'w', encoding='utf-8') as f:
+        f.write('file\tstatus\ttokens\terror\n')
+        for infile, n in done: f.write(infile + '\tdone\t' + str(n) + '\t\n')
+        for infile in skipped: f.write(infile + '\tskipped\t\t\n')
+        for infile, error in failed: f.write(infile + '\tfailed\t\t' + repr(error) + '\n')
+    return not failed
+
+def main(tmpdir, infiles=[], rnnpath='', ttpath='', lexicons=[], overlays=[], outfile='', outdir='', inputanno='gold', printunk=False, printunk_top=None, unkfile='', exportpos=False, cachedir='', processes=None, skipgold=True, selective=False, bucket=False, rnnworkers=1, rnnthreads=None, standin=None, coordinator='', shardsize=SHARDSIZE, authkey=None, store='', pipeline=None):
+    # pipeline: (backends, lemmatizer) built by the caller, to be reused
+    # for several calls (batch mode); by default they are built here.
+    
+    script_path = os.path.dirname(__file__)
+    # -1. Run the converters (in parallel) and store converters
+    print('Converting and concatenating input files.')
+    jobs, ixs = [], []
+    for i, infile in enumerate(infiles):
+        if os.path.splitext(strip_compression(infile))[1] not in ['', '.txt', '.tsv']:
+            sidecar = scripts.convertfiles.cache_sidecar(cachedir, infile) if cachedir else ''
+            jobs.append((convert_infile, (
+                infile, opj(tmpdir, os.path.basename(infile + '.txt')), exportpos, sidecar
+            )))
+            ixs.append(i)
+    if len(jobs) == 1: # a single file may be split up by its converter
+        jobs[0] = (convert_infile, jobs[0][1] + (processes,))
+    results = dict(zip(ixs, run_jobs(jobs, processes)))
+    converters, converted_infiles, converted = [], [], []
+    for i, infile in enumerate(infiles):
+        converter, error = results.get(i, (None, None))
+        if error: # Report and skip this file
+            print('Error converting ' + infile + ': ' + repr(error))
+            continue
+        converted.append(infile)
+        converters.append(converter)
+        converted_infiles.append(opj(tmpdir, os.path.basename(infile + '.txt')) if converter else infile)
+    if not converted:
+        raise SourceDataError('None of the input files could be converted.')
+    infiles = converted
+    
+    # 0. Concatenate input files
+    catfile = opj(tmpdir, 'cat.txt')
+    concatenater = Concatenater()
+    concatenater.concatenate(converted_infiles, catfile)
+    max_cols = normalize_infile(catfile, opj(tmpdir, 'basefile.txt'))
+    # 1. Standardize gold pos tags from input file
+    if max_cols > 1:
+        print('Converting input part-of-speech tags to UD.')
+        try:
+            scripts.standardizepos.main(catfile, opj(tmpdir, 'infile_normed.txt'))
+        except scripts.standardizepos.MapNotFound:
+            print("Warning: Couldn't standardize pos. Assuming already in UD.")
+            shutil.copy(catfile, opj(tmpdir, 'infile_normed.txt'))
+    # 1b.-6. Tag, look up and score, here or on the workers
+    if coordinator:
+        distribute(
+            tmpdir, concatenater.path_lines, max_cols, coordinator, authkey, shardsize,
+            {'inputanno': inputanno, 'skipgold': skipgold, 'selective': selective}
+        )
+        rules = scripts.ofrpostprocess.apply_rules
+    else:
+        if pipeline:
+            backends, lemmatizer = pipeline
+        else:
+            backends = taggers(rnnpath, ttpath, lexicons, overlays, standin, bucket, rnnworkers, rnnthreads)
+            tagged = backends or os.path.exists(opj(tmpdir, 'rnn_of.txt'))
+            lemmatizer = scripts.lemmatizer.Lemmatizer(
+                lexicons, overlays, table=not tagged and not (inputanno == 'auto' and max_cols > 1)
+            )
+        lemmatize_tmpdir(tmpdir, max_cols, backends, lemmatizer, inputanno, skipgold, selective)
+        rules = lemmatizer.apply_rules
     # 7. Post process
     print('Running post-processor.')
-    unks = scripts.ofrpostprocess.main(opj(tmpdir, 'out.txt'), opj(tmpdir, 'out-pp.txt'))
+    unknowns = scripts.ofrpostprocess.UnknownLemmas([
+        (infile, path_line[1]) for infile, path_line in zip(infiles, concatenater.path_lines)
+    ])
+    scripts.ofrpostprocess.main(opj(tmpdir, 'out.txt'), opj(tmpdir, 'out-pp.txt'), unknowns, rules)
     #shutil.copy2(opj(tmpdir, 'out.txt'), opj(tmpdir, 'out-pp.txt'))
-    if printunk:
-        unktups = [(unks.count(x), x) for x in list(set(unks))]
-        unktups.sort(key=lambda x: x[0], reverse=True)
-        print('Unknown lemmas')
-        for freq, lem in unktups:
-            print(str(freq) + '\t' + lem)
+    if printunk or printunk_top is not None:
+        unknowns.print_top(printunk_top)
+    if unkfile:
+        unknowns.write_tsv(unkfile)
+    if store:
+        print('Writing results to ' + store)
+        with lib.store.ResultStore(store) as results:
+            results.add_file(opj(tmpdir, 'out-pp.txt'), [
+                (infile, path_line[1]) for infile, path_line in zip(infiles, concatenater.path_lines)
+            ])
     if outdir or \
-    (outfile and len(infiles) == 1 and os.path.splitext(outfile)[1] == os.path.splitext(infiles[0])[1]):
+    (outfile and len(infiles) == 1 and os.path.splitext(strip_compression(outfile))[1] == os.path.splitext(strip_compression(infiles[0]))[1]):
         # Only reconverts files if an outdir is given, or one one infile
         # was given with an outfile with an identical extension.
         print('Splitting and back-converting output to original format.')
         concatenater.split(opj(tmpdir, 'out-pp.txt'), outdir=tmpdir) # overwrites converted infile.
+        if outdir and not os.path.exists(outdir):
+            os.makedirs(outdir)
+        jobs = []
         for converter, converted_infile in zip(converters, converted_infiles):
             if converter:
-                if not outfile: # single outfile case must be handled too
-                    outfile = opj(outdir, os.path.basename(converter.source_file))
-                converter.to_source(converted_infile, outfile)
-                outfile = ''
+                # single outfile case must be handled too
+                jobs.append((converter.to_source, (
+                    converted_infile,
+                    outfile or opj(outdir, os.path.basename(converter.source_file))
+                )))
             else:
-                outfile = outfile or opj(outdir, os.path.basename(converted_infile))
-                shutil.copy2(opj(tmpdir, 'out-pp.txt'), outfile)
+                jobs.append((copy_file, (
+                    opj(tmpdir, os.path.basename(converted_infile)),
+                    outfile or opj(outdir, os.path.basename(converted_infile))
+                )))
+        for (function, args), (result, error) in zip(jobs, run_jobs(jobs, processes)):
+            if error:
+                print('Error writing ' + args[1] + ': ' + repr(error))
     elif outfile:
-        shutil.copy2(opj(tmpdir, 'out-pp.txt'), outfile)
+        copy_file(opj(tmpdir, 'out-pp.txt'), outfile)
     else: # Nowhere else to dump the output, print it to stdout.
-        with open(opj(tmpdir, 'out-pp.txt'), 'r', encoding='utf-8') as f:
+        with open_file(opj(tmpdir, 'out-pp.txt'), 'r', encoding='utf-8') as f:
             for line in f:
                 print(line[:-1])
     
@@ -221,20 +661,17 @@ if __name__ == '__main__':
         description = \
         'Old French lemmatizer.'
     )
-    parser.add_argument('infiles', nargs='+', help='Input text files.')
+    parser.add_argument('infiles', nargs='*', help=\
+        'Input text files, or - to read one-token-per-line text from stdin and write ' + \
+        'each sentence to stdout as soon as it is lemmatized.')
     parser.add_argument('--rnnpath', type=str, help='Path to directory containing the RNN tagger.')
     parser.add_argument('--ttpath', type=str, help=\
         'Path to directory containing the TreeTagger. Directory should contain bin/tree-tagger, ' + \
         'lib/old-french.par and/or stein-oldfrench.par.')
-    parser.add_argument('--lexicons', nargs='*', help='Lexicon files (overrides supplied default lexicons)', 
-        default=[
-            opj(script_path, 'lexicons', 'old-french', 'lgerm', 'lgerm-medieval.tsv'),
-            opj(script_path, 'lexicons', 'old-french', 'lgerm-medieval-corrections.tsv'),
-            opj(script_path, 'lexicons', 'old-french', 'bfm', 'bfmgoldlem2022.tsv'),
-            opj(script_path, 'lexicons', 'old-french', 'cormetaf', 'cormetaf.tsv')
-            #opj(script_path, 'lexicons', 'punct.tsv')
-        ]
-    )
+    parser.add_argument('--lexicons', nargs='*', help='Lexicon files (overrides supplied default lexicons)')
+    parser.add_argument('--overlays', nargs='*', help=\
+        'Overlay files with additions, deletions and corrections applied to the first lexicon ' + \
+        '(overrides supplied default overlays)')
     parser.add_argument('--outdir', help='Output directory.', type=str, default='')
     parser.add_argument('--outfile', help='Output file.', type=str, default='')
     parser.add_argument('--tmpdir', help='Directory for temporary files, if you wish to keep them.', type=str, default='')
@@ -249,10 +686,81 @@ if __name__ == '__main__':
         )
     )
     parser.add_argument('--printunk', action='store_true', help='Print unknown lemmas to screen')
+    parser.add_argument('--printunk-top', type=int, default=None, metavar='K', help=\
+        'Print only the K most frequent unknown lemmas to screen.')
+    parser.add_argument('--unkfile', type=str, default='', help=\
+        'TSV report of unknown lemmas with their frequency per file, forms and example contexts.')
+    parser.add_argument('--cachedir', type=str, default='', help=\
+        'Directory for conversion sidecar files. Unchanged input files are not converted again.')
+    parser.add_argument('--processes', type=int, default=None, help=\
+        'Maximum number of files converted in parallel (default: number of CPUs).')
+    parser.add_argument('--no-skip-gold', dest='skipgold', action='store_false', help=\
+        'Tag and look up every sentence, even if all its tokens have a gold lemma and pos.')
+    parser.add_argument('--selective', action='store_true', help=\
+        'Only tag sentences containing a token with no or several lemmas in the lexicons. ' + \
+        'Tokens with a single lexicon lemma in the other sentences get a score of 2.')
+    parser.add_argument('--bucket', action='store_true', help=\
+        'Pass sentences to the RNN Tagger sorted by length (output order is restored).')
+    parser.add_argument('--rnnworkers', type=int, default=1, help=\
+        'Number of RNN Tagger processes, each tagging a shard of the input.')
+    parser.add_argument('--rnnthreads', type=int, default=None, help=\
+        'Number of CPU threads per RNN Tagger process.')
+    parser.add_argument('--standin', type=float, nargs='?', const=0.0, default=None, metavar='LATENCY',
+        help=\
+        'Add a deterministic stand-in tagger which tags each token with its first lexicon ' + \
+        'analysis, sleeping LATENCY seconds per sentence. For benchmarking without the real taggers.')
+    parser.add_argument('--batch', type=str, default='', metavar='PATH', help=\
+        'Batch mode: lemmatize each file in the directory tree PATH, or listed in the manifest ' + \
+        'PATH, to the same path under --outdir. Completed files are skipped when the batch is ' + \
+        'run again. --processes files are lemmatized at a time (default: 1).')
+    parser.add_argument('--coordinator', type=str, default='', metavar='ADDRESS', help=\
+        'Distributed mode: split the input into shards and send them to the workers ' + \
+        'which connect to ADDRESS (HOST:PORT or the path of a Unix socket).')
+    parser.add_argument('--worker', type=str, default='', metavar='ADDRESS', help=\
+        'Run as a worker of the coordinator at ADDRESS, with its own taggers and lexicons. ' + \
+        'Takes no input files.')
+    parser.add_argument('--shardsize', type=int, default=SHARDSIZE, help=\
+        'Sentences per shard in distributed mode (default: {}).'.format(SHARDSIZE))
+    parser.add_argument('--authkey', type=str, default=os.environ.get('LEMMATIZER_AUTHKEY', ''), help=\
+        'Key shared by the coordinator and its workers (default: $LEMMATIZER_AUTHKEY). ' + \
+        'Required with --coordinator and --worker.')
+    parser.add_argument('--store', type=str, default='', help=\
+        'Also write the results to this SQLite store, indexed by lemma, form and score ' + \
+        '(see query-store.py). Results of files lemmatized again are replaced.')
     parser.add_argument('--exportpos', action='store_true', help='Also export part-of-speech tags when converting back to original format.')
     kwargs = vars(parser.parse_args())
+    if not kwargs['infiles'] and not kwargs['worker'] and not kwargs['batch']:
+        parser.error('the following arguments are required: infiles')
+    if kwargs['batch'] and not kwargs['outdir']:
+        parser.error('--batch needs --outdir')
+    if kwargs['batch'] and kwargs['coordinator']:
+        parser.error('--batch and --coordinator cannot be combined')
+    if (kwargs['coordinator'] or kwargs['worker']) and not kwargs['authkey']:
+        parser.error('--coordinator and --worker need --authkey or $LEMMATIZER_AUTHKEY')
+    kwargs['authkey'] = kwargs['authkey'].encode() or None
+    worker, batch = kwargs.pop('worker'), kwargs.pop('batch')
+    if kwargs['lexicons'] is None:
+        kwargs['lexicons'] = [
+            opj(script_path, 'lexicons', 'old-french', 'lgerm', 'lgerm-medieval.tsv'),
+            opj(script_path, 'lexicons', 'old-french', 'bfm', 'bfmgoldlem2022.tsv'),
+            opj(script_path, 'lexicons', 'old-french', 'cormetaf', 'cormetaf.tsv')
+            #opj(script_path, 'lexicons', 'punct.tsv')
+        ]
+        if kwargs['overlays'] is None:
+            kwargs['overlays'] = [
+                opj(script_path, 'lexicons', 'old-french', 'lgerm-medieval-corrections.tsv')
+            ]
+    kwargs['overlays'] = kwargs['overlays'] or []
+    if kwargs['cachedir'] and not os.path.exists(kwargs['cachedir']):
+        os.makedirs(kwargs['cachedir'])
     #print(kwargs)
-    if kwargs['tmpdir']:
+    if worker:
+        worker_main(worker, **kwargs)
+    elif batch:
+        sys.exit(0 if batch_main(batch, **kwargs) else 1)
+    elif kwargs['infiles'] == ['-']:
+        filter_main(**kwargs)
+    elif kwargs['tmpdir']:
         main(**kwargs)
     else:
         with tempfile.TemporaryDirectory() as tmpdir:
@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+
+#######################################################################
+# Queries a result store written by old-french-lemmatizer.py --store. #
+# Prints the matching tokens (text, position, form, pos, lemma,       #
+# score), or with --group the frequency of each value of a column.    #
+#######################################################################
+
+import argparse, sys
+from lib.store import COLUMNS, ResultStore
+
+def main(store, group='', limit=None, **filters):
+    with ResultStore(store) as results:
+        if group:
+            for value, n in results.counts(group, limit, **filters):
+                print(str(value) + '\t' + str(n))
+        else:
+            print('\t'.join(COLUMNS))
+            for row in results.query(limit, **filters):
+                print('\t'.join([str(x) for x in row]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description = \
+        'Queries a result store written by old-french-lemmatizer.py --store.\n' + \
+        'e.g. all lemmas scored -10:     query-store.py results.db --score -10 --group lemma\n' + \
+        '     all forms of a lemma:      query-store.py results.db --lemma chevalier --group form'
+    )
+    parser.add_argument('store', help='Result store (SQLite database).')
+    parser.add_argument('--text', type=str, help='Only tokens of this text (input file as given to the lemmatizer).')
+    parser.add_argument('--form', type=str, help='Only tokens with this form.')
+    parser.add_argument('--pos', type=str, help='Only tokens with this pos tag.')
+    parser.add_argument('--lemma', type=str, help='Only tokens with this lemma.')
+    parser.add_argument('--score', type=int, help='Only tokens with this score.')
+    parser.add_argument('--minscore', type=int, help='Only tokens with at least this score.')
+    parser.add_argument('--maxscore', type=int, help='Only tokens with at most this score.')
+    parser.add_argument('--group', type=str, choices=COLUMNS, default='', help=\
+        'Print the frequency of each value of this column instead of the tokens.')
+    parser.add_argument('--limit', type=int, default=None, help='Maximum number of lines printed.')
+    kwargs = vars(parser.parse_args())
+    sys.stdout.reconfigure(encoding='utf-8')
+    main(**kwargs)
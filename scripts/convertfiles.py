@@ -1,6 +1,9 @@
 #!/usr/bin/python3
 
-import argparse, xml.parsers.expat, os.path, csv, pickle, re
+import argparse, xml.parsers.expat, os.path, csv, re, shutil, hashlib, json, struct, sys
+import itertools, multiprocessing, tempfile
+from lib.linemap import LineMap
+from lib.compression import open_file, strip_compression
 
 class Error(Exception):
     pass
@@ -8,32 +11,128 @@ class Error(Exception):
 class UnknownFileType(Error):
     pass
 
+class SourceDataError(Error):
+    pass
+
+class SidecarError(Error):
+    pass
+
+# Sidecar (.convert) file layout:
+#   SIDECAR_MAGIC, version (uint16), metadata length (uint32),
+#   metadata (JSON), gaps of each LineMap, converted text (utf-8).
+SIDECAR_MAGIC = b'OFLCONV\0'
+SIDECAR_VERSION = 2
+SIDECAR_HEADER = struct.Struct('<8sHI')
+
+def hash_file(fname):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def cache_sidecar(cachedir, fname):
+    # Sidecar of fname in a cache directory shared by several input
+    # directories: keyed on the absolute path, so that files with the
+    # same name don't evict each other.
+    key = hashlib.sha1(os.path.abspath(fname).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cachedir, os.path.basename(fname) + '.' + key + '.convert')
+
 class Converter():
     
+    # LineMap attributes stored in the sidecar.
+    SIDECAR_MAPS = ['linemap']
+    # Other (JSON serializable) attributes stored in the sidecar.
+    SIDECAR_ATTRIBUTES = []
+    # Attributes which change the output of from_source. A sidecar is
+    # only reused if they are the same.
+    SIDECAR_OPTIONS = []
+    
     def __init__(self, source_file, source_encoding='utf-8'):
-        self.linemap = []
+        self.linemap = LineMap()
         self.source_file = source_file
         self.source_encoding = source_encoding
         self.exportpos = False
         self.exportlemma = True
+        self.processes = 1 # used by converters which can split up a file
         
     def from_source(self, outfile):
         # Default method, does nothing
-        with open(self.source_file, 'r', encoding=self.source_encoding) as fin:
-            with open(outfile, 'w', encoding='utf-8') as fout:
+        with open_file(self.source_file, 'r', encoding=self.source_encoding) as fin:
+            with open_file(outfile, 'w', encoding='utf-8') as fout:
                 for i, line in enumerate(fin):
                     fout.write(line)
                     self.linemap.append((i, i))
                     
     def to_source(self, infile, outfile):
-        with open(infile, 'r', encoding='utf-8') as fin:
-            with open(outfile, 'w', encoding=self.source_encoding) as fout:
+        with open_file(infile, 'r', encoding='utf-8') as fin:
+            with open_file(outfile, 'w', encoding=self.source_encoding) as fout:
                 for line in fin:
                     fout.write(line)
                     
-    def pickle(self):
-        with open(self.source_file + '.convert', 'wb') as f:
-            pickle.dump(self, f)
+    def convert(self, outfile, sidecar=''):
+        # Runs from_source, unless a valid sidecar exists, in which case
+        # the converted file and linemap are restored from it. If
+        # sidecar is given, (re)writes it after conversion.
+        if sidecar:
+            source_hash = hash_file(self.source_file)
+            try:
+                self.read_sidecar(sidecar, outfile, source_hash)
+                return
+            except (OSError, SidecarError):
+                pass
+        self.from_source(outfile)
+        if sidecar:
+            self.write_sidecar(sidecar, outfile, source_hash)
+                    
+    def write_sidecar(self, sidecar, converted_file, source_hash=''):
+        meta = {
+            'class': type(self).__name__,
+            'source_hash': source_hash or hash_file(self.source_file),
+            'byteorder': sys.byteorder,
+            'source_encoding': self.source_encoding,
+            'options': {x: getattr(self, x) for x in self.SIDECAR_OPTIONS},
+            'attributes': {x: getattr(self, x) for x in self.SIDECAR_ATTRIBUTES},
+            'maps': [[x, getattr(self, x).to_dict()] for x in self.SIDECAR_MAPS]
+        }
+        meta = json.dumps(meta).encode('utf-8')
+        # Unique temporary name: several processes may write the same
+        # sidecar at once.
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(sidecar) or '.', prefix=os.path.basename(sidecar) + '.', suffix='.tmp'
+        )
+        try:
+            with open(fd, 'wb') as f:
+                f.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, SIDECAR_VERSION, len(meta)))
+                f.write(meta)
+                for x in self.SIDECAR_MAPS:
+                    f.write(getattr(self, x).gap_bytes())
+                with open(converted_file, 'rb') as fin:
+                    shutil.copyfileobj(fin, f)
+            os.replace(tmp, sidecar)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        
+    def read_sidecar(self, sidecar, converted_file='', source_hash=''):
+        # Restores the linemaps (and the converted file, if given) from
+        # a sidecar. Raises SidecarError if the sidecar is stale.
+        with open(sidecar, 'rb') as f:
+            meta = read_sidecar_meta(f)
+            if meta['class'] != type(self).__name__:
+                raise SidecarError('Sidecar was written by another converter.')
+            if meta['source_hash'] != (source_hash or hash_file(self.source_file)):
+                raise SidecarError('Source file has changed since conversion.')
+            if meta['options'] != {x: getattr(self, x) for x in self.SIDECAR_OPTIONS}:
+                raise SidecarError('Sidecar was written with other options.')
+            for key, d in meta['maps']:
+                itemsize = struct.calcsize(d['typecode']) if d['typecode'] else 0
+                setattr(self, key, LineMap.from_dict(d, f.read(itemsize * max(d['length'] - 1, 0))))
+            for key, value in meta['attributes'].items():
+                setattr(self, key, value)
+            if converted_file:
+                with open(converted_file, 'wb') as fout:
+                    shutil.copyfileobj(f, fout)
                     
 class CsvConverter(Converter):
     """
@@ -41,219 +140,360 @@ class CsvConverter(Converter):
     column or it will fail.
     """
     
+    POSTAGS = ['syntag', 'pos', 'cat', 'cattex-pos', 'ud-pos']
+    LEMMATAGS = ['lemma_dmf', 'lemma']
+    
     def from_source(self, outfile):
-        with open(self.source_file, newline='', encoding=self.source_encoding) as fin:
-            with open(outfile, 'w', encoding='utf-8') as fout:
-                reader = csv.DictReader(fin, restval='')
-                for i, row in enumerate(reader):
-                    try:
-                        word = row['word']
-                    except KeyError:
-                        raise UnknownFileType('CSV file must have a header and a "word" column.')
-                    fout.write(word)
-                    for postag in ['syntag', 'pos', 'cat', 'cattex-pos', 'ud-pos']:
-                        if postag in row: 
-                            fout.write('\t' + row[postag])
-                            break
-                    else:
-                        fout.write('\t')
-                    for lemmatag in ['lemma_dmf', 'lemma']:
-                        if lemmatag in row:
-                            fout.write('\t' + row[lemmatag])
+        # Column indices are looked up once from the header, so rows are
+        # read as plain lists.
+        with open_file(self.source_file, newline='', encoding=self.source_encoding) as fin:
+            with open_file(outfile, 'w', encoding='utf-8') as fout:
+                reader = csv.reader(fin)
+                header = next(reader, [])
+                ixs = [header.index('word') if 'word' in header else -1]
+                for tags in [self.POSTAGS, self.LEMMATAGS]:
+                    for tag in tags:
+                        if tag in header:
+                            ixs.append(header.index(tag))
                             break
                     else:
-                        fout.write('\t')
-                    fout.write('\n')
+                        ixs.append(-1)
+                width = len(header)
+                i = 0
+                for row in reader:
+                    if not row: continue # DictReader skips empty rows too
+                    if ixs[0] == -1:
+                        raise UnknownFileType('CSV file must have a header and a "word" column.')
+                    if len(row) < width: row.extend([''] * (width - len(row)))
+                    fout.write('\t'.join([row[ix] if ix > -1 else '' for ix in ixs]) + '\n')
                     self.linemap.append((i + 1, i))
+                    i += 1
                     
     def to_source(self, infile, outfile):
-        #print(self.source_file)
-        #print(infile)
-        #print(outfile)
-        with open(infile, encoding='utf-8') as fin:
-            with open(self.source_file, newline='', encoding=self.source_encoding) as source_file:
-                reader = csv.DictReader(source_file)
-                rows = []
-                header = reader.fieldnames
-                postag = 'pos_ofl' if 'pos' in header else 'pos'
-                lemmatag = 'lemma_ofl' if 'lemma' in header else 'lemma'
-                scoretag = 'lemma_score'
-                header.extend([postag, lemmatag, scoretag])
-                for row in reader:
-                    fin_line = fin.readline()
-                    try:
-                        word, pos, lemma, score = fin_line.rstrip().split('\t')
-                    except:
-                        print(row)
-                        print(fin_line)
-                        raise
-                    if self.exportlemma:
-                        row[lemmatag], row[scoretag] = lemma, score
-                    if self.exportpos:
-                        row[postag] = pos
-                    rows.append(row)
-                #print(rows[:10])
-            with open(outfile, 'w', newline='', encoding=self.source_encoding) as fout:
-                writer = csv.DictWriter(fout, fieldnames=header)
-                writer.writeheader()
-                writer.writerows(rows)
+        # Streams the source and the lemmatizer output in lockstep; each
+        # row is written as soon as it has been merged.
+        with open_file(infile, encoding='utf-8') as fin, \
+            open_file(self.source_file, newline='', encoding=self.source_encoding) as source_file, \
+            open_file(outfile, 'w', newline='', encoding=self.source_encoding) as fout:
+            reader = csv.reader(source_file)
+            writer = csv.writer(fout)
+            header = next(reader, [])
+            width = len(header)
+            postag = 'pos_ofl' if 'pos' in header else 'pos'
+            lemmatag = 'lemma_ofl' if 'lemma' in header else 'lemma'
+            scoretag = 'lemma_score'
+            writer.writerow(header + [postag, lemmatag, scoretag])
+            for row in reader:
+                if not row: continue
+                fin_line = fin.readline()
+                try:
+                    word, pos, lemma, score = fin_line.rstrip().split('\t')
+                except:
+                    print(row)
+                    print(fin_line)
+                    raise
+                if len(row) < width:
+                    row.extend([''] * (width - len(row)))
+                elif len(row) > width:
+                    del row[width:]
+                row.append(pos if self.exportpos else '')
+                row.extend([lemma, score] if self.exportlemma else ['', ''])
+                writer.writerow(row)
                 
 class ConlluConverter(Converter):
+    """
+    Converts CoNLL-U files. Sentence blocks (the lines up to and
+    including an empty line) are indexed by byte offset in self.blocks,
+    with their first source line in self.block_lines, so that chunks of
+    sentences can be converted and written back independently, in
+    in parallel unless self.processes == 1.
+    """
+    
+    SIDECAR_MAPS = ['linemap', 'blocks', 'block_lines']
+    SIDECAR_OPTIONS = ['xpos']
+    CHUNK = 1000 # sentences per job
     
     def __init__(self, source_file, source_encoding='utf-8'):
         Converter.__init__(self, source_file, source_encoding)
         self.xpos = False # If True, uses column 5 not column 4
+        self.blocks = LineMap()
+        self.block_lines = LineMap()
+        
+    def read_chunks(self, source_file):
+        # Generator over (bytes, first source line) for chunks of
+        # self.CHUNK sentences, using the block index.
+        chunk_offset, chunk_line = 0, 0
+        for (offset, k), (line, k) in zip(self.blocks, self.block_lines):
+            if k and k % self.CHUNK == 0:
+                yield source_file.read(offset - chunk_offset), chunk_line
+                chunk_offset, chunk_line = offset, line
+        data = source_file.read()
+        if data: yield data, chunk_line
+        
+    def map_chunks(self, function, jobs):
+        # Runs function over the jobs, in a pool unless self.processes == 1,
+        # and yields the results in order. Jobs are taken from the
+        # iterator a few at a time so that memory use stays bounded.
+        if self.processes == 1:
+            for job in jobs:
+                yield function(*job)
+            return
+        processes = self.processes or os.cpu_count()
+        with multiprocessing.Pool(processes) as pool:
+            while True:
+                window = list(itertools.islice(jobs, processes * 4))
+                if not window: break
+                for result in pool.starmap(function, window):
+                    yield result
     
     def from_source(self, outfile):
-        with open(self.source_file, newline='', encoding=self.source_encoding) as fin:
-            with open(outfile, 'w', encoding='utf-8') as fout:
-                counter = 0
-                for i, line in enumerate(fin):
-                    fields = line.rstrip().split('\t')
-                    if len(fields) == 10 or line == '\n': # only write these lines
-                        if len(fields) == 10: # line contains data
-                            fout.write(fields[1]) # write word
-                            if fields[3] not in ['_', ''] and fields[4] not in ['_', '']:
-                                if fields[3] not in ['_', ''] and not self.xpos: #upos tag
-                                    fout.write('\t' + fields[3])
-                                else: # xpos tag
-                                    fout.write('\t' + fields[4])
-                                if fields[2] not in ['_', '']: # lemma; only write if also pos
-                                    fout.write('\t' + fields[2])
-                        # write line end and increment counter
-                        fout.write('\n')
-                        self.linemap.append((i, counter))
-                        counter += 1
+        self.blocks, self.block_lines = LineMap(), LineMap()
+        
+        def index_chunks(fin):
+            # Splits the source into chunks of sentences and indexes the blocks
+            chunk, offset, i, new_block = [], 0, 0, True
+            chunk_line = 0
+            for line in fin:
+                if new_block:
+                    if len(self.blocks) and len(self.blocks) % self.CHUNK == 0:
+                        yield b''.join(chunk), self.source_encoding, self.xpos, chunk_line
+                        chunk, chunk_line = [], i
+                    self.blocks.append((offset, len(self.blocks)))
+                    self.block_lines.append((i, len(self.block_lines)))
+                chunk.append(line)
+                new_block = line == b'\n'
+                offset += len(line)
+                i += 1
+            if chunk: yield b''.join(chunk), self.source_encoding, self.xpos, chunk_line
+        
+        with open_file(self.source_file, 'rb') as fin, open_file(outfile, 'w', encoding='utf-8') as fout:
+            counter = 0
+            for text, positions in self.map_chunks(conllu_from_source, index_chunks(fin)):
+                fout.write(text)
+                for i in positions:
+                    self.linemap.append((i, counter))
+                    counter += 1
                         
     def to_source(self, infile, outfile):
-        with open(infile, encoding='utf-8') as fin:
-            with open(self.source_file, encoding=self.source_encoding) as source_file:
-                with open(outfile, 'w', encoding='utf-8') as fout:
-                    i = -1
-                    for maptuple in self.linemap:
-                        fin_line = fin.readline()
-                        source_line = source_file.readline()
-                        i += 1
-                        while i < maptuple[0]: # get right source line
-                            fout.write(source_line)
-                            source_line = source_file.readline()
-                            i += 1
-                        if fin_line == '\n': # write empty line and skip the rest
-                            fout.write(source_line)
-                            continue
-                        fields = source_line.rstrip().split('\t')
-                        fin_fields = fin_line.rstrip().split('\t')
-                        if self.exportpos:
-                            try:
-                                fields[4] = fin_fields[1] # XPOS: DON'T OVERWRITE PARSER OUTPUT
-                            except IndexError:
-                                print(source_line)
-                                print(fin_line)
-                                print(self.linemap)
-                                print(maptuple)
-                                raise
-                        if self.exportlemma:
-                            fields[2] = fin_fields[2] # LEMMA
-                            fields[9] += '|lemmascore=' + str(fin_fields[3]) # score
-                        fout.write('\t'.join(fields) + '\n')
-                    while source_line != '': # continue until end of source file.
-                        source_line = source_file.readline()
-                        if source_line: fout.write(source_line)
+        
+        def jobs(fin, source_file):
+            linemap = iter(self.linemap)
+            position = next(linemap, (-1, -1))[0]
+            chunks = self.read_chunks(source_file)
+            chunk = next(chunks, None)
+            while chunk:
+                next_chunk = next(chunks, None)
+                end = next_chunk[1] if next_chunk else float('inf')
+                # Output lines which belong to this chunk
+                fin_lines = []
+                while position > -1 and position < end:
+                    fin_lines.append(fin.readline())
+                    position = next(linemap, (-1, -1))[0]
+                yield chunk[0], self.source_encoding, fin_lines, self.exportpos, self.exportlemma
+                chunk = next_chunk
+        
+        with open_file(infile, encoding='utf-8') as fin:
+            with open_file(self.source_file, 'rb') as source_file:
+                with open_file(outfile, 'w', encoding='utf-8') as fout:
+                    for text in self.map_chunks(conllu_to_source, jobs(fin, source_file)):
+                        fout.write(text)
                         
+def split_lines(text):
+    # Like str.splitlines(keepends=True), but only splits at \n.
+    lines = [x + '\n' for x in text.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]: lines.pop()
+    return lines
+    
+def conllu_from_source(data, encoding, xpos, first_line):
+    # Converts a chunk of CoNLL-U sentences. Returns the text and the
+    # source line number of each converted line.
+    out, positions = [], []
+    for i, line in enumerate(split_lines(data.decode(encoding)), first_line):
+        fields = line.rstrip().split('\t')
+        if len(fields) == 10 or line == '\n': # only write these lines
+            if len(fields) == 10: # line contains data
+                out.append(fields[1]) # write word
+                if fields[3] not in ['_', ''] and fields[4] not in ['_', '']:
+                    if fields[3] not in ['_', ''] and not xpos: #upos tag
+                        out.append('\t' + fields[3])
+                    else: # xpos tag
+                        out.append('\t' + fields[4])
+                    if fields[2] not in ['_', '']: # lemma; only write if also pos
+                        out.append('\t' + fields[2])
+            # write line end and record the source line
+            out.append('\n')
+            positions.append(i)
+    return ''.join(out), positions
+    
+def conllu_to_source(data, encoding, fin_lines, exportpos, exportlemma):
+    # Writes lemmas (and pos tags) back into a chunk of CoNLL-U sentences.
+    out = []
+    fin_lines = iter(fin_lines)
+    for source_line in split_lines(data.decode(encoding)):
+        body = source_line.rstrip()
+        if source_line == '\n' or body.count('\t') == 9:
+            fin_line = next(fin_lines)
+            if fin_line == '\n' or source_line == '\n': # write empty line and skip the rest
+                out.append(source_line)
+                continue
+            out.append(patch_conllu_line(body, fin_line.rstrip().split('\t'), exportpos, exportlemma))
+        else:
+            out.append(source_line)
+    return ''.join(out)
+    
+def patch_conllu_line(line, fin_fields, exportpos=False, exportlemma=True):
+    # Replaces LEMMA and XPOS and appends the score to MISC by splicing
+    # at the tab positions; the other columns are copied untouched.
+    tabs = [-1]
+    for i in range(4):
+        tabs.append(line.index('\t', tabs[-1] + 1))
+    # tabs[2]...tabs[3] is LEMMA, tabs[4]...next tab is XPOS
+    pieces = [line[:tabs[2] + 1]]
+    pieces.append(fin_fields[2] if exportlemma else line[tabs[2] + 1:tabs[3]]) # LEMMA
+    pieces.append(line[tabs[3]:tabs[4] + 1])
+    xpos_end = line.index('\t', tabs[4] + 1)
+    if exportpos:
+        try:
+            pieces.append(fin_fields[1]) # XPOS: DON'T OVERWRITE PARSER OUTPUT
+        except IndexError:
+            print(line)
+            print(fin_fields)
+            raise
+    else:
+        pieces.append(line[tabs[4] + 1:xpos_end])
+    pieces.append(line[xpos_end:])
+    if exportlemma:
+        pieces.append('|lemmascore=' + str(fin_fields[3])) # score
+    pieces.append('\n')
+    return ''.join(pieces)
+
 class TeiConverter(Converter):
     """
-    Converts <w> tokenized TEI files. Will only recognize single-line
-    words.
+    Converts <w> tokenized TEI files. The document is parsed once by a
+    single streaming parser; the linemap records the byte offset of each
+    <w> start tag, so <w> elements may span several lines. to_source
+    copies the source bytes and splices new start tags in at these
+    offsets.
     """
+    
+    SIDECAR_ATTRIBUTES = ['xml_encoding']
+    CHUNK = 1 << 16
+    
+    def __init__(self, source_file, source_encoding='utf-8'):
+        Converter.__init__(self, source_file, source_encoding)
+        self.xml_encoding = 'utf-8'
 
     def from_source(self, outfile):
-        with open(self.source_file, newline='', encoding=self.source_encoding) as fin, open(outfile, 'w', encoding='utf-8') as fout:
-            counter = 0
-            for i, line in enumerate(fin):
-                m = re.search(r'<w[ >].*</w>', line)
-                if not m: continue
-                # Initialize a parser and parse the line
-                parser = MyParser()
-                parser.xmlparser.Parse(m.group(0))
-                fout.write(parser.form)
-                if parser.pos: fout.write('\t' + parser.pos)
-                if parser.lemma: fout.write('\t' + parser.lemma)
-                # write line end and increment counter
-                fout.write('\n')
-                self.linemap.append((i, counter))
-                counter += 1
+        counter = 0
+        
+        def write_w(offset, attributes, form):
+            nonlocal counter
+            form = ' '.join(form.split()) # multi-line <w>: collapse whitespace
+            if not form: return # ignore empty <w/> elements
+            fout.write(form)
+            if attributes.get('pos'): fout.write('\t' + attributes['pos'])
+            if attributes.get('lemma'): fout.write('\t' + attributes['lemma'])
+            # write line end and increment counter
+            fout.write('\n')
+            self.linemap.append((offset, counter))
+            counter += 1
+        
+        with open_file(self.source_file, 'rb') as fin, open_file(outfile, 'w', encoding='utf-8') as fout:
+            parser = TeiParser(write_w)
+            parser.xmlparser.ParseFile(fin)
+            self.xml_encoding = parser.xml_encoding
                 
     def to_source(self, infile, outfile):
-        with open(infile, encoding='utf-8') as fin, open(self.source_file, encoding=self.source_encoding) as source_file, open(outfile, 'w', encoding='utf-8') as fout:
-            i = -1
-            parser = ToSourceParser()
-            for maptuple in self.linemap:
-                fin_line = fin.readline()
-                source_line = source_file.readline()
-                parser.w_attributes = {}
-                parser.xmlparser.Parse(source_line)
-                i += 1
-                while i < maptuple[0]: # get right source line
-                    fout.write(source_line)
-                    source_line = source_file.readline()
-                    parser.xmlparser.Parse(source_line)
-                    i += 1
-                fin_fields = fin_line.rstrip().split('\t')
-                if self.exportlemma:
-                    parser.w_attributes['lemma'] = fin_fields[2]
-                    parser.w_attributes['lemma-score'] = fin_fields[3]
-                if self.exportpos:
-                    key = 'pos_ofl' if 'pos' in parser.w_attributes else 'pos'
-                    parser.w_attributes[key] = fin_fields[1]
-                # Write the new <w> start element
-                s = '<w id="{}"'.format(parser.w_attributes.pop('id'))
-                # There almost certainly will be things to write, but we need to check
-                # to make sure that the XML is valid.
-                if parser.w_attributes: s += ' ' + ' '.join(['{}="{}"'.format(key, xmlent(value)) for key, value in parser.w_attributes.items()])
-                s += '>'
-                # Find the location of <w> element in the source line
-                m = re.search(r'<w [^>]+>', source_line)
-                # Write new line
-                fout.write(source_line[:m.start()] + s + source_line[m.end():])
-            while source_line != '': # continue until end of source file.
-                source_line = source_file.readline()
-                if source_line: fout.write(source_line)
+        with open_file(infile, encoding='utf-8') as fin, open_file(self.source_file, 'rb') as source_file, open_file(outfile, 'wb') as fout:
+            # buf holds the source bytes from position base; everything
+            # before buf[p] has already been written.
+            buf, base, p = b'', 0, 0
+            for offset, counter in self.linemap:
+                fin_fields = fin.readline().rstrip().split('\t')
+                # Copy the source up to the <w> start tag
+                while offset - base >= len(buf):
+                    fout.write(buf[p:])
+                    base, p = base + len(buf), 0
+                    buf = source_file.read(self.CHUNK)
+                    if not buf: raise SourceDataError('<w> offset beyond end of ' + self.source_file)
+                fout.write(buf[p:offset - base])
+                p = offset - base
+                # Find the end of the start tag, which may cross a chunk
+                m = START_TAG_RE.match(buf, p)
+                while not m:
+                    more = source_file.read(self.CHUNK)
+                    if not more: raise SourceDataError('No <w> start tag at offset ' + str(offset))
+                    buf, base, p = buf[p:] + more, base + p, 0
+                    m = START_TAG_RE.match(buf, p)
+                fout.write(self.splice_start_tag(m.group(0), fin_fields))
+                p = m.end()
+            fout.write(buf[p:])
+            shutil.copyfileobj(source_file, fout) # rest of the source file
             
-class MyParser(): # BaseClass
+    def splice_start_tag(self, tag, fin_fields):
+        # Rewrites the attributes of a <w> start tag (bytes), leaving
+        # all other attributes exactly as they were.
+        tag = tag.decode(self.xml_encoding)
+        attributes = {}
+        for m in ATTRIBUTE_RE.finditer(tag):
+            attributes[m.group(1)] = m.group(2)
+        if self.exportlemma:
+            attributes['lemma'] = '"' + xmlent(fin_fields[2]) + '"'
+            attributes['lemma-score'] = '"' + xmlent(fin_fields[3]) + '"'
+        if self.exportpos:
+            key = 'pos_ofl' if 'pos' in attributes else 'pos'
+            attributes[key] = '"' + xmlent(fin_fields[1]) + '"'
+        s = '<w'
+        if attributes: s += ' ' + ' '.join(['{}={}'.format(key, value) for key, value in attributes.items()])
+        s += '/>' if tag.endswith('/>') else '>'
+        return s.encode(self.xml_encoding, errors='xmlcharrefreplace')
+
+START_TAG_RE = re.compile(rb'''<w(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*/?>''')
+ATTRIBUTE_RE = re.compile(r'''([^\s=/>]+)\s*=\s*("[^"]*"|'[^']*')''')
+
+class TeiParser():
+    # Streaming parser which passes (byte offset, attributes, form) to
+    # the callback for each <w> element.
     
-    def __init__(self):
+    def __init__(self, callback):
         self.xmlparser = xml.parsers.expat.ParserCreate()
         self.xmlparser.CharacterDataHandler = self.character_data_handler
         self.xmlparser.StartElementHandler = self.start_element_handler
-        self.pos = ''
-        self.lemma = ''
+        self.xmlparser.EndElementHandler = self.end_element_handler
+        self.xmlparser.XmlDeclHandler = self.xml_decl_handler
+        self.xmlparser.buffer_text = True
+        self.callback = callback
+        self.xml_encoding = 'utf-8'
+        self.depth = 0 # depth within the current <w>
+        self.offset = -1
         self.form = ''
         self.w_attributes = {}
         
+    def xml_decl_handler(self, version, encoding, standalone):
+        if encoding: self.xml_encoding = encoding
+        
     def start_element_handler(self, name, attributes):
-        if name == 'w':
+        if self.depth:
+            self.depth += 1
+        elif name == 'w':
+            self.depth = 1
+            self.offset = self.xmlparser.CurrentByteIndex
             self.w_attributes = attributes
-            try:
-                self.pos = attributes['pos']
-            except KeyError:
-                pass
-            try:
-                self.lemma = attributes['lemma']
-            except KeyError:
-                pass
-    
-    def character_data_handler(self, data):
-        self.form += data
-        
-class ToSourceParser(MyParser):
-    # Disable building self.form when ToSource
+            self.form = ''
+            
+    def end_element_handler(self, name):
+        if self.depth:
+            self.depth -= 1
+            if not self.depth:
+                self.callback(self.offset, self.w_attributes, self.form)
     
     def character_data_handler(self, data):
-        pass
+        if self.depth: self.form += data
     
         
 def get_converter(source_file):
-    ext = os.path.splitext(source_file)[1]
+    ext = os.path.splitext(strip_compression(source_file))[1]
     if ext in ['', '.txt', '.tsv']:
         return Converter(source_file)
     if ext in ['.csv']:
@@ -271,15 +511,39 @@ def get_converter(source_file):
     else:
         raise UnknownFileType('This type of file is not supported.')
         
-def unpickle_converter(source_file):
-    with open(source_file + '.convert', 'rb') as f:
-        converter = pickle.load(f)
+CONVERTERS = {
+    x.__name__: x for x in [Converter, CsvConverter, ConlluConverter, TeiConverter]
+}
+
+def read_sidecar_meta(f):
+    header = f.read(SIDECAR_HEADER.size)
+    if len(header) != SIDECAR_HEADER.size:
+        raise SidecarError('Not a sidecar file.')
+    magic, version, length = SIDECAR_HEADER.unpack(header)
+    if magic != SIDECAR_MAGIC:
+        raise SidecarError('Not a sidecar file.')
+    if version != SIDECAR_VERSION:
+        raise SidecarError('Unsupported sidecar version ' + str(version))
+    meta = json.loads(f.read(length).decode('utf-8'))
+    if meta['byteorder'] != sys.byteorder:
+        raise SidecarError('Sidecar was written on a machine with a different byte order.')
+    return meta
+
+def load_converter(source_file, sidecar=''):
+    # Recreates the converter of a source file from its sidecar.
+    sidecar = sidecar or source_file + '.convert'
+    with open(sidecar, 'rb') as f:
+        meta = read_sidecar_meta(f)
+    converter = CONVERTERS[meta['class']](source_file, meta['source_encoding'])
+    for key, value in meta['options'].items():
+        setattr(converter, key, value)
+    converter.read_sidecar(sidecar)
     return converter
 
-def convert_from_source(infile, outfile='out.txt', conllu_xpos=False):
+def convert_from_source(infile, outfile='out.txt', conllu_xpos=False, sidecar=''):
     converter = get_converter(infile)
     if conllu_xpos: converter.xpos = True # won't matter if not a conllu file
-    converter.from_source(outfile)
+    converter.convert(outfile, sidecar)
     return converter
     
 def xmlent(s):
@@ -297,11 +561,10 @@ def xmlent(s):
 def main(infile, outfile='out.txt', lemmafile=''):
     
     if lemmafile:
-        converter = unpickle_converter(infile)
+        converter = load_converter(infile)
         converter.to_source(lemmafile, outfile)
     else:
-        converter = convert_from_source(infile, outfile)
-        converter.pickle()
+        convert_from_source(infile, outfile, sidecar=infile + '.convert')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -1,111 +1,294 @@
 #!/usr/bin/python3
 
 
-import argparse, csv, os, os.path
+import argparse, csv, gzip, json, os, os.path, sys
+from array import array
+from collections import Counter
+from lib.parallel import run_jobs
+from lib.compression import OPENERS, compression, open_file, strip_compression
 
 opj = os.path.join
 
-def main(autodir, golddir, outfile='out.txt', datafile=''):
+DATAFILE_FIELDS = [
+    'text', 'word', 'pos_auto', 'pos_gold', 'lemma_auto',
+    'lemma_gold', 'lemma_score', 'lemma_correct', 'pos_correct'
+]
+
+COLUMN_TYPES = {'lemma_correct': 'bool', 'pos_correct': 'bool'} # default 'str'
+IDS_TYPECODE = 'I' # uint32 on all supported platforms ('L' is 8 bytes on 64-bit Linux)
+
+class ColumnWriter():
+    # Append-only columnar datafile: a directory with one file per column.
+    # String columns are dictionary encoded: <column>.dict holds every
+    # distinct value once, one per line (with \\ and newlines escaped),
+    # and <column>.ids the uint32 index of each row's value. Boolean
+    # columns are stored as one byte per row in <column>.bool. Rows are
+    # buffered and appended in batches; with compress, every column file
+    # is a gzip stream. columns.json describes the columns.
+    
+    BATCH = 65536
+    
+    def __init__(self, datadir, fields, compress=False):
+        if not os.path.exists(datadir): os.makedirs(datadir)
+        self.datadir = datadir
+        self.fields = fields
+        self.compress = compress
+        self.nrows = 0
+        self.values = {x: {} for x in fields if COLUMN_TYPES.get(x, 'str') == 'str'}
+        self.buffers, self.files = {}, {}
+        for field in fields:
+            ext = '.bool' if COLUMN_TYPES.get(field) == 'bool' else '.ids'
+            self.buffers[field] = array('B' if ext == '.bool' else IDS_TYPECODE)
+            self.files[field] = self.open(field + ext)
+            if ext == '.ids': self.files[field + '.dict'] = self.open(field + '.dict')
+    
+    def open(self, fname):
+        fname = os.path.join(self.datadir, fname)
+        return gzip.open(fname + '.gz', 'wb') if self.compress else open(fname, 'wb')
+        
+    def writerow(self, d):
+        for field, buf in self.buffers.items():
+            value = d[field]
+            if field in self.values:
+                ids = self.values[field]
+                if not value in ids:
+                    ids[value] = len(ids)
+                    self.files[field + '.dict'].write(
+                        (value.replace('\\', '\\\\').replace('\n', '\\n') + '\n').encode('utf-8')
+                    )
+                buf.append(ids[value])
+            else:
+                buf.append(1 if value else 0)
+        self.nrows += 1
+        if self.nrows % self.BATCH == 0: self.flush()
+        
+    def writerows(self, rows):
+        for d in rows: self.writerow(d)
+        
+    def flush(self):
+        for field, buf in self.buffers.items():
+            self.files[field].write(buf.tobytes())
+            del buf[:]
+            
+    def close(self):
+        self.flush()
+        for f in self.files.values(): f.close()
+        with open(os.path.join(self.datadir, 'columns.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'nrows': self.nrows, 'compressed': self.compress,
+                'byteorder': sys.byteorder, 'itemsize': array(IDS_TYPECODE).itemsize,
+                'columns': [[x, COLUMN_TYPES.get(x, 'str')] for x in self.fields]
+            }, f, indent=1)
+            
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *args):
+        self.close()
+        
+class CsvWriter(csv.DictWriter):
+    # Row-wise datafile, optionally gzipped.
     
-    fnames = os.listdir(autodir)
-    evals = []
+    def __init__(self, datafile, fields, compress=False):
+        if compress:
+            self.f = gzip.open(datafile + '.gz', 'wt', encoding='utf-8', newline='')
+        else:
+            self.f = open(datafile, 'w', encoding='utf-8', newline='')
+        csv.DictWriter.__init__(self, self.f, fieldnames=fields)
+        self.writeheader()
+        
+    def close(self):
+        self.f.close()
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *args):
+        self.close()
+        
+class NullWriter():
     
-    # Parse_files and build evals
-    for fname in fnames:
-        textname = fname[:-4]
-        with open(opj(autodir, fname), encoding='utf-8', newline='') as fauto:
-            with open(opj(golddir, fname), encoding='utf-8', newline='') as fgold:
-                gold_reader = csv.DictReader(fgold, restval='')
-                auto_reader = csv.DictReader(fauto, restval='')
-                gold_lemma = 'lemma_gold' if 'lemma_gold' in gold_reader.fieldnames else 'lemma'
-                auto_lemma = 'lemma_ofl' if 'lemma_ofl' in auto_reader.fieldnames else 'lemma'
-                gold_pos = 'pos_gold' if 'pos_gold' in gold_reader.fieldnames else 'pos'
-                auto_pos = 'pos_ofl' if 'pos_ofl' in auto_reader.fieldnames else 'pos'
-                for auto_row in auto_reader:
-                    gold_row = gold_reader.__next__()
-                    try: 
-                        d = {
-                            'text': textname, 
-                            'word': gold_row['word'],
-                            'pos_auto': auto_row[auto_pos],
-                            'pos_gold': gold_row[gold_pos],
-                            'lemma_auto': auto_row[auto_lemma],
-                            'lemma_gold': gold_row[gold_lemma],
-                            'lemma_score': auto_row['lemma_score'],
-                            'lemma_correct': auto_row[auto_lemma] == gold_row[gold_lemma],
-                            'pos_correct': auto_row[auto_pos] == gold_row[gold_pos]
-                        }
-                    except KeyError:
-                        print('KeyError in file ' + textname)
-                        print(auto_row)
-                        print(gold_row)
-                        raise
-                    evals.append(d)
-        # Dump datafile if necessary
-        if datafile:
-            with open(datafile, 'w', encoding='utf-8', newline='') as f:
-                writer = csv.DictWriter(
-                    f, fieldnames=[
-                        'text', 'word', 'pos_auto', 'pos_gold', 'lemma_auto',
-                        'lemma_gold', 'lemma_score', 'lemma_correct', 'pos_correct'
-                    ]
-                )
-                writer.writeheader()
-                writer.writerows(evals)
-        # Print summary
-        with open(outfile, 'w', encoding='utf-8') as f:
-            f.write('Lemmas correct (tokens)\n')
-            f.write('=======================\n\n')
-            f.write('Condition            Correct  Total Percent\n')
-            # 1. Overall
-            template = '{:<20} {:>7} {:>6} {:>#7.2f}\n'
-            correct = [x['lemma_correct'] for x in evals].count(True)
-            f.write(template.format('Total', correct, len(evals), (correct / len(evals)) * 100))
-            # By text
-            for text in list(set([x['text'] for x in evals])):
-                l = list(filter(lambda x: x['text'] == text, evals))
-                correct = [x['lemma_correct'] for x in l].count(True)
-                total = len(l)
-                f.write(template.format('Text ' + text, correct, len(l), (correct / len(l)) * 100))
-            # By PoS tag
-            for pos in list(set([x['pos_gold'] for x in evals])):
-                l = list(filter(lambda x: x['pos_gold'] == pos, evals))
-                correct = [x['lemma_correct'] for x in l].count(True)
-                f.write(template.format('POS ' + pos, correct, len(l), (correct / len(l)) * 100))
-            # By score
-            for score in list(set([x['lemma_score'] for x in evals])):
-                l = list(filter(lambda x: x['lemma_score'] == score, evals))
-                correct = [x['lemma_correct'] for x in l].count(True)
-                f.write(template.format('Score ' + str(score), correct, len(l), (correct / len(l)) * 100))
-            f.write('\nCommon errors\n')
-            f.write('=============\n')
-            # Get types
-            types = list(set(zip(
-                [x['pos_auto'] for x in evals],
-                [x['lemma_auto'] for x in evals]
-            )))
-            wrong = [0] * len(types)
-            total = [0] * len(types)
-            gold = [set() for i in range(len(types))]
-            # Calculate type errors
-            for d in evals:
-                thetype = (d['pos_auto'], d['lemma_auto'])
-                ix = types.index(thetype)
-                total[ix] += 1
-                if not d['lemma_correct']:
-                    wrong[ix] += 1
-                    gold[ix].add(d['lemma_gold'])
-            # Print results
-            types_eval = list(zip(types, wrong, total, gold))
-            types_eval.sort(key=lambda x: x[1] / x[2], reverse=True)
-            f.write('pos_auto lemma_auto   correct total percent gold_lemmas\n')
-            template = '{:<8} {:<12} {:>7} {:>6} {:>#7.2f} {}\n'
-            for tup, wrong, total, gold in types_eval:
-                if wrong > 0:
-                    f.write(template.format(
-                        tup[0], tup[1], wrong, total, (wrong / total) * 100,
-                        '|'.join(list(gold))
-                    ))
+    def writerow(self, d): pass
+    def writerows(self, rows): pass
+    def __enter__(self): return self
+    def __exit__(self, *args): pass
+        
+def open_datafile(datafile, dataformat='csv', compress=False):
+    if not datafile: return NullWriter()
+    if dataformat == 'columnar': return ColumnWriter(datafile, DATAFILE_FIELDS, compress)
+    return CsvWriter(datafile, DATAFILE_FIELDS, compress)
+    
+def read_columns(datadir):
+    # Generator over the rows (as dicts) of a columnar datafile.
+    with open(os.path.join(datadir, 'columns.json'), encoding='utf-8') as f:
+        meta = json.load(f)
+    def read(fname):
+        fname = os.path.join(datadir, fname)
+        if meta['compressed']:
+            with gzip.open(fname + '.gz', 'rb') as f: return f.read()
+        with open(fname, 'rb') as f: return f.read()
+    columns = []
+    for field, coltype in meta['columns']:
+        if coltype == 'bool':
+            columns.append([x == 1 for x in read(field + '.bool')])
+        else:
+            values = read(field + '.dict').decode('utf-8').split('\n')[:-1]
+            values = [x.replace('\\n', '\n').replace('\\\\', '\\') for x in values]
+            # Typecode of the same width as the writer's (older datafiles
+            # used 'L', 8 bytes on 64-bit Linux)
+            ids = array([x for x in 'HILQ' if array(x).itemsize == meta['itemsize']][0])
+            ids.frombytes(read(field + '.ids'))
+            if meta['byteorder'] != sys.byteorder: ids.byteswap()
+            columns.append([values[x] for x in ids])
+    for row in zip(*columns):
+        yield dict(zip([x[0] for x in meta['columns']], row))
+
+class Aggregates():
+    # Running counts for the summary, grouped in a single pass.
+
+    def __init__(self):
+        self.total = Counter() # key = (condition, value)
+        self.correct = Counter()
+        self.types = {} # key = (pos_auto, lemma_auto), value = [wrong, total, set of gold lemmas]
+
+    def add(self, d):
+        for key in [('Total', ''), ('Text', d['text']), ('POS', d['pos_gold']), ('Score', d['lemma_score'])]:
+            self.total[key] += 1
+            if d['lemma_correct']: self.correct[key] += 1
+        thetype = (d['pos_auto'], d['lemma_auto'])
+        if not thetype in self.types:
+            self.types[thetype] = [0, 0, set()]
+        l = self.types[thetype]
+        l[1] += 1
+        if not d['lemma_correct']:
+            l[0] += 1
+            l[2].add(d['lemma_gold'])
+
+    def merge(self, other):
+        self.total.update(other.total)
+        self.correct.update(other.correct)
+        for thetype, (wrong, total, gold) in other.types.items():
+            if thetype in self.types:
+                l = self.types[thetype]
+                l[0] += wrong
+                l[1] += total
+                l[2] |= gold
+            else:
+                self.types[thetype] = [wrong, total, set(gold)]
+
+def score_key(score):
+    # Sorts scores numerically where possible
+    try:
+        return (0, float(score), '')
+    except ValueError:
+        return (1, 0, score)
+
+def read_pair(autofile, goldfile, textname):
+    # Generator over the token comparisons of one auto / gold file pair.
+    with open_file(autofile, encoding='utf-8', newline='') as fauto:
+        with open_file(goldfile, encoding='utf-8', newline='') as fgold:
+            gold_reader = csv.DictReader(fgold, restval='')
+            auto_reader = csv.DictReader(fauto, restval='')
+            gold_lemma = 'lemma_gold' if 'lemma_gold' in gold_reader.fieldnames else 'lemma'
+            auto_lemma = 'lemma_ofl' if 'lemma_ofl' in auto_reader.fieldnames else 'lemma'
+            gold_pos = 'pos_gold' if 'pos_gold' in gold_reader.fieldnames else 'pos'
+            auto_pos = 'pos_ofl' if 'pos_ofl' in auto_reader.fieldnames else 'pos'
+            for auto_row in auto_reader:
+                gold_row = gold_reader.__next__()
+                try:
+                    d = {
+                        'text': textname,
+                        'word': gold_row['word'],
+                        'pos_auto': auto_row[auto_pos],
+                        'pos_gold': gold_row[gold_pos],
+                        'lemma_auto': auto_row[auto_lemma],
+                        'lemma_gold': gold_row[gold_lemma],
+                        'lemma_score': auto_row['lemma_score'],
+                        'lemma_correct': auto_row[auto_lemma] == gold_row[gold_lemma],
+                        'pos_correct': auto_row[auto_pos] == gold_row[gold_pos]
+                    }
+                except KeyError:
+                    print('KeyError in file ' + textname)
+                    print(auto_row)
+                    print(gold_row)
+                    raise
+                yield d
+
+def evaluate_pair(autofile, goldfile, textname, keep_rows=False):
+    # Worker function. Returns the aggregates for one file pair and, if
+    # keep_rows, its rows for the datafile.
+    aggregates, rows = Aggregates(), []
+    for d in read_pair(autofile, goldfile, textname):
+        aggregates.add(d)
+        if keep_rows: rows.append(d)
+    return aggregates, rows
+
+def write_summary(aggregates, outfile):
+    with open_file(outfile, 'w', encoding='utf-8') as f:
+        f.write('Lemmas correct (tokens)\n')
+        f.write('=======================\n\n')
+        f.write('Condition            Correct  Total Percent\n')
+        template = '{:<20} {:>7} {:>6} {:>#7.2f}\n'
+        # 1. Overall, then by text, by PoS tag and by score
+        keys = [('Total', '')]
+        for condition, sort_key in [('Text', None), ('POS', None), ('Score', score_key)]:
+            values = [x[1] for x in aggregates.total if x[0] == condition]
+            values.sort(key=sort_key)
+            keys.extend([(condition, x) for x in values])
+        for key in keys:
+            total = aggregates.total[key]
+            if not total: continue
+            correct = aggregates.correct[key]
+            f.write(template.format((key[0] + ' ' + key[1]).rstrip(), correct, total, (correct / total) * 100))
+        f.write('\nCommon errors\n')
+        f.write('=============\n')
+        # Print results
+        types_eval = [(thetype,) + tuple(l) for thetype, l in aggregates.types.items()]
+        types_eval.sort(key=lambda x: x[0])
+        types_eval.sort(key=lambda x: x[1] / x[2], reverse=True)
+        f.write('pos_auto lemma_auto   correct total percent gold_lemmas\n')
+        template = '{:<8} {:<12} {:>7} {:>6} {:>#7.2f} {}\n'
+        for tup, wrong, total, gold in types_eval:
+            if wrong > 0:
+                f.write(template.format(
+                    tup[0], tup[1], wrong, total, (wrong / total) * 100,
+                    '|'.join(sorted(gold))
+                ))
+
+def gold_file(golddir, fname):
+    # The gold file of an autolemma file: the file with the same name in
+    # golddir, compressed or not.
+    base = strip_compression(fname)
+    for ext in [compression(fname), ''] + list(OPENERS):
+        if os.path.exists(opj(golddir, base + ext)): return opj(golddir, base + ext)
+    return opj(golddir, fname)
+
+def main(autodir, golddir, outfile='out.txt', datafile='', processes=None,
+    streaming=False, dataformat='csv', compress=False):
+
+    fnames = sorted(os.listdir(autodir))
+    aggregates = Aggregates()
+    with open_datafile(datafile, dataformat, compress) as writer:
+        if streaming:
+            # Bounded memory: every comparison goes straight into the
+            # aggregates and the datafile.
+            for fname in fnames:
+                for d in read_pair(opj(autodir, fname), gold_file(golddir, fname), strip_compression(fname)[:-4]):
+                    aggregates.add(d)
+                    writer.writerow(d)
+        else:
+            # Parse files in parallel and merge the aggregates in file order
+            jobs = [
+                (evaluate_pair, (opj(autodir, fname), gold_file(golddir, fname), strip_compression(fname)[:-4], bool(datafile)))
+                for fname in fnames
+            ]
+            for fname, (result, error) in zip(fnames, run_jobs(jobs, processes)):
+                if error:
+                    print('Error evaluating ' + fname)
+                    raise error
+                aggregates.merge(result[0])
+                writer.writerows(result[1])
+    write_summary(aggregates, outfile)
 
 if __name__ == '__main__':
     script_path = os.path.dirname(__file__)
@@ -119,6 +302,15 @@ if __name__ == '__main__':
     parser.add_argument('golddir', type=str, help='Directory with gold files.')
     parser.add_argument('--outfile', help='Output file.', type=str, default='out.txt')
     parser.add_argument('--datafile', help='Dataset file for R.', type=str, default='')
+    parser.add_argument('--processes', type=int, default=None,
+        help='Number of file pairs read in parallel (default: number of CPUs).')
+    parser.add_argument('--streaming', action='store_true',
+        help='Read files one at a time without keeping tokens in memory.')
+    parser.add_argument('--dataformat', type=str, default='csv', choices=['csv', 'columnar'],
+        help=\
+        'Format of the datafile: csv, or columnar (a directory with one ' + \
+        'compact file per column).')
+    parser.add_argument('--compress', action='store_true', help='Gzip the datafile.')
     kwargs = vars(parser.parse_args())
     #print(kwargs)
     main(**kwargs)
@@ -14,6 +14,8 @@ class SourceDataError(Error):
     pass
 
 import argparse, os.path, tempfile
+from lib.compression import open_file
+from lib.lexicon import Lexicon
 
 opj = os.path.join
 
@@ -224,109 +226,122 @@ def score_lemmas(poss, goldlemmas=[], autolemmas=[], lookup_lemmas=[], lookup_po
         score = -2
     return lemma, score
 
+def get_pos(x):
+    # pos tag from the columns of a line
+    try:
+        return x[1]
+    except IndexError:
+        return ''
+
+def get_pos_lemma(x):
+    # (pos, lemma) from the columns of a tagger output line; the lemma is
+    # empty if the tagger doesn't know it.
+    if len(x) == 3 and x[2] != unknown_lemma:
+        return (x[1], x[2])
+    elif len(x) >= 2:
+        return (x[1], '')
+    return ('', '')
+
+def choose_pos(autopostags, goldpostag=''):
+    # Disambiguates the pos tags of one token.
+    autotag = vote(autopostags)
+    # Ambiguous gold pos tag which doesn't agree with autotag,
+    # Use ambiguous gold tag.
+    if goldpostag and not autotag in goldpostag.split('|'):
+        return goldpostag
+    return autotag
+
+def choose_autolemmas(autoposlemmas, pos):
+    # Disambiguates the automatic lemmas of one token, given its
+    # (pos, lemma) tuples from each source and the disambiguated pos.
+    autolemmas = []
+    for autopos, autolemma in autoposlemmas:
+        # Use pos disambiguation for multiple autolemmas
+        # but keep all that match the pos.
+        # If pos disambiguation fails, keep all autolemmas.
+        if autopos == pos and autolemma:
+            autolemmas.append(autolemma)
+            # This may lead to duplicate autolemmas, but this
+            # is not an issue. The number of autolemmas never
+            # counts for anything.
+            # But it does count that the best model is passed
+            # first.
+    # If disambiguation fails to produce anything, copy all 
+    # autolemmas anyway. It's better to keep them in the mix.
+    if not autolemmas: autolemmas = [x[1] for x in autoposlemmas if x[1] != '']
+    return autolemmas
+
+def score_token(poss, goldlemmas=[], autolemmas=[], lookups=[], attested_lemmas=None, ignore_numbers=False):
+    # Scores one token. lookups is a list of (pos, lemma) tuples from the
+    # lexicons. Returns (lemma, score).
+    if ignore_numbers:
+        # strip digits from gold lemmas too
+        goldlemmas = [x[:-1] if x and x[-1].isdigit() else x for x in goldlemmas]
+    lookup_poss, lookup_lemmas = [], []
+    if lookups:
+        # Eliminate duplicate analyses
+        x, y = list(zip(*set(lookups)))
+        lookup_poss, lookup_lemmas = list(x), list(y)
+    lemma, score = score_lemmas(poss, goldlemmas, autolemmas, lookup_lemmas, lookup_poss, attested_lemmas)
+    if attested_lemmas and not '|' in lemma and not lemma in attested_lemmas and score != 10:
+        # This autolemma is not in the lexicon. Give it a score of -10.
+        # Unless it's already a gold lemma and has a score of 10.
+        score = -10
+    return lemma, score
+
 def disambiguate_autoposlemma(autoposlemmas, posfile, outfile='out.txt', ignore_numbers=False):
     # Open the files
-    def get_pos_lemma(line):
-        l = line.rstrip().split('\t')
-        if len(l) == 3 and l[2] != unknown_lemma:
-            return (l[1], l[2])
-        elif len(l) >= 2:
-            return (l[1], '')
-        return ('', '')
-        
-    autoposlemma_fs = [open(x, 'r', encoding='utf-8') for x in autoposlemmas]
-    pos_f = open(posfile, 'r', encoding='utf-8')
-    with open(outfile, 'w', encoding='utf-8') as fout:
+    autoposlemma_fs = [open_file(x, 'r', encoding='utf-8') for x in autoposlemmas]
+    pos_f = open_file(posfile, 'r', encoding='utf-8')
+    with open_file(outfile, 'w', encoding='utf-8') as fout:
         for line in autoposlemma_fs[0]:
             form = line.rstrip().split('\t')[0]
             lines = [line]
             lines += [f.readline() for f in autoposlemma_fs[1:]]
-            pos_line = pos_f.readline()
-            try:
-                pos = pos_line.rstrip().split('\t')[1]
-            except IndexError:
-                pos = ''
+            pos = get_pos(pos_f.readline().rstrip().split('\t'))
             # Make a list of (autopos, autolemma) tuples
-            autoposlemmas = [get_pos_lemma(x) for x in lines]
-            #lemma = vote([x[1] for x in autoposlemmas], ignore_numbers=ignore_numbers)
-            autolemmas = []
-            for autopos, autolemma in autoposlemmas:
-                # Use pos disambiguation for multiple autolemmas
-                # but keep all that match the pos.
-                # If pos disambiguation fails, keep all autolemmas.
-                if autopos == pos and autolemma:
-                    autolemmas.append(autolemma)
-                    # This may lead to duplicate autolemmas, but this
-                    # is not an issue. The number of autolemmas never
-                    # counts for anything.
-                    # But it does count that the best model is passed
-                    # first.
-            # If disambiguation fails to produce anything, copy all 
-            # autolemmas anyway. It's better to keep them in the mix.
-            if not autolemmas: autolemmas = [x[1] for x in autoposlemmas if x[1] != '']
-            try:
-                fout.write(form + '\t' + pos + '\t' + '|'.join(autolemmas) + '\n')
-            except:
-                print(form)
-                print(line)
-                print(lemma)
-                print(autoposlemmas)
-                raise
+            autoposlemmas = [get_pos_lemma(x.rstrip().split('\t')) for x in lines]
+            autolemmas = choose_autolemmas(autoposlemmas, pos)
+            fout.write(form + '\t' + pos + '\t' + '|'.join(autolemmas) + '\n')
             
     for f in autoposlemma_fs: f.close()
     pos_f.close()
 
 def disambiguate_pos(autoposs, goldposs=[], outfile='out.txt'):
-    def get_pos(line):
-        try:
-            return line.rstrip().split('\t')[1]
-        except IndexError:
-            return ''
-    
-    goldpos_f = open(goldposs[0], 'r', encoding='utf-8') if goldposs else None
+    goldpos_f = open_file(goldposs[0], 'r', encoding='utf-8') if goldposs else None
     # Open the autopos files
-    autopos_fs = [open(x, 'r', encoding='utf-8') for x in autoposs]
+    autopos_fs = [open_file(x, 'r', encoding='utf-8') for x in autoposs]
     # Iterate over first autopos file (always provided)
-    with open(outfile, 'w', encoding='utf-8') as fout:
+    with open_file(outfile, 'w', encoding='utf-8') as fout:
         #print(outfile + ' opened')
         for line in autopos_fs[0]:
             form = line.rstrip().split('\t')[0]
             lines = [line]
             lines += [f.readline() for f in autopos_fs[1:]]
-            autopostags = [get_pos(x) for x in lines]
-            try:
-                goldpostag = goldpos_f.readline().rstrip().split('\t')[1] if goldpos_f else ''
-            except IndexError:
-                goldpostag = ''
-            autotag = vote(autopostags)
-            # Case 1. Unambiguous gold pos
-            if not goldpostag and not '|' in goldpostag:
-                tag = goldpostag
-            # Case 2. Ambiguous gold pos tag which doesn't agree with autotag,
-            # Use ambiguous gold tag.
-            if goldpostag and not autotag in goldpostag.split('|'):
-                tag = goldpostag
-            else:
-                tag = autotag
+            autopostags = [get_pos(x.rstrip().split('\t')) for x in lines]
+            goldpostag = get_pos(goldpos_f.readline().rstrip().split('\t')) if goldpos_f else ''
+            tag = choose_pos(autopostags, goldpostag)
             fout.write(form + '\t' + tag + '\n')
     if goldpos_f: goldpos_f.close()
     for autopos_f in autopos_fs: autopos_f.close()
     
-def load_lexicons(lexicons, ignore_numbers=False):
+def attested(lexicons, ignore_numbers=False):
+    # Set of the lemmas of lib.lexicon.Lexicon objects, as resolved
+    # with their overlays (lemmas an overlay replaces or deletes aren't
+    # attested).
     aset = set([])
     for lexicon in lexicons:
-        with open(lexicon, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    x = line.split('\t')[0]
-                except IndexError:
-                    continue
-                if not x: print(line)
-                if ignore_numbers and x[-1].isdigit():
-                    x = x[:-1] # remove number
-                aset.add(x)
-    #print(list(aset)[:100])
+        for x in lexicon.lemmas():
+            if ignore_numbers and x and x[-1].isdigit():
+                x = x[:-1] # remove number
+            aset.add(x)
     return aset
+
+def load_lexicons(lexicons, ignore_numbers=False, overlays=[]):
+    # Lemmas of the lexicon files; overlays are applied to the first.
+    return attested(
+        [Lexicon(fname, overlays if i == 0 else []) for i, fname in enumerate(lexicons)], ignore_numbers
+    )
     
 def main(
     goldpos='', goldposlemma='', lookupposlemma=[],
@@ -357,7 +372,7 @@ def main(
             )
             posfile = opj(tmpdir, 'pos.txt')
         else:
-            posfile = (goldpos + goldposlemma)[0]
+            posfile = goldposs[0]
         
         # Step 4. Combine automatic lemmatization into a single form - pos -
         # lemma file
@@ -374,11 +389,11 @@ def main(
             attested_lemmas = None
             
         # Step 5. Open the files and begin iteration
-        autolemma_f = open(autolemmafile, 'r', encoding='utf-8') if autolemmafile else None
-        goldposlemma_f = open(goldposlemma, 'r', encoding='utf-8') if goldposlemma else None
-        lookupposlemma_fs = [open(x, 'r', encoding='utf-8') for x in lookupposlemma]
-        with open(posfile, 'r', encoding='utf-8') as fin:
-            with open(outfile, 'w', encoding='utf-8') as fout:
+        autolemma_f = open_file(autolemmafile, 'r', encoding='utf-8') if autolemmafile else None
+        goldposlemma_f = open_file(goldposlemma, 'r', encoding='utf-8') if goldposlemma else None
+        lookupposlemma_fs = [open_file(x, 'r', encoding='utf-8') for x in lookupposlemma]
+        with open_file(posfile, 'r', encoding='utf-8') as fin:
+            with open_file(outfile, 'w', encoding='utf-8') as fout:
                 for line in fin:
                     line_list = line.rstrip().split('\t') # Read the line
                     form = line_list[0] # Get the form
@@ -401,34 +416,18 @@ def main(
                             goldlemmas = gpl_line.split('\t')[2].split('|')
                         except IndexError:
                             pass
-                        if ignore_numbers:
-                            # strip digits from gold lemmas too
-                            goldlemmas = [x[:-1] if x and x[-1].isdigit() else x for x in goldlemmas]
-                    lookup_poss, lookup_lemmas = [], []
-                    if lookupposlemma_fs:
-                        lookup_poss, lookup_lemmas = [], []
-                        for lookupposlemma_f in lookupposlemma_fs:
-                            lpl_line = lookupposlemma_f.readline().rstrip().split('\t')
-                            i = 1
-                            while i < len(lpl_line):
-                                lookup_poss.append(lpl_line[i])
-                                lookup_lemmas.append(lpl_line[i + 1])
-                                i += 2
-                        if lookup_poss:
-                            # If nothing is found, the following commands
-                            # which eliminate all duplicate values will
-                            # fail at the unzip stage to x, y.
-                            x, y = list(zip(*set(zip(lookup_poss, lookup_lemmas))))
-                            lookup_poss, lookup_lemmas = list(x), list(y)
+                    lookups = []
+                    for lookupposlemma_f in lookupposlemma_fs:
+                        lpl_line = lookupposlemma_f.readline().rstrip().split('\t')
+                        i = 1
+                        while i < len(lpl_line):
+                            lookups.append((lpl_line[i], lpl_line[i + 1]))
+                            i += 2
                     # Finished reading the input files now check for empty line
                     if form == '':
                         fout.write('\n') # just write empty line
                     else:
-                        lemma, score = score_lemmas(poss, goldlemmas, autolemmas, lookup_lemmas, lookup_poss, attested_lemmas)
-                        if attested_lemmas and not '|' in lemma and not lemma in attested_lemmas and score != 10:
-                            # This autolemma is not in the lexicon. Give it a score of -10.
-                            # Unless it's already a gold lemma and has a score of 10.
-                            score = -10
+                        lemma, score = score_token(poss, goldlemmas, autolemmas, lookups, attested_lemmas, ignore_numbers)
                         fout.write('\t'.join([form, '|'.join(poss), lemma, str(score)]) + '\n')
 
 if __name__ == '__main__':
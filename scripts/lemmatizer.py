@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+
+#######################################################################
+# In-memory lemmatizer.                                               #
+# Runs the workflow of old-french-lemmatizer.py (tagging, lexicon     #
+# lookup, standardization of pos tags to UD, lemma comparison and     #
+# post-processing) on sentences held in memory. Lexicons, pos maps    #
+# and tagger backends are loaded once, when the Lemmatizer is         #
+# created, so no files or temporary directories are needed for each   #
+# request (except by tagger backends which work on files).            #
+#                                                                     #
+#   lemmatizer = Lemmatizer(lexicons, overlays)                       #
+#   lemmatizer.lemmatize(['li', 'chevaliers', 'vint'])                #
+#                                                                     #
+# returns a list of Token(form, pos, lemma, score) records. See       #
+# scripts/lemmacompare.py for the meaning of the scores.              #
+#                                                                     #
+# Forms, tags and lemmas are interned in a Vocab (lib/vocab.py) and   #
+# passed between the stages as ids; they are only decoded for the     #
+# output. Lookups, scores and lemma corrections are cached by id, so  #
+# each distinct token is only scored once.                            #
+#                                                                     #
+# Without taggers, the lemma and score of a token only depend on its  #
+# form and gold pos tag. For these lexicon-only jobs the lemmatizer   #
+# can load a decision table (Lemmatizer(..., table=True)) giving the  #
+# (lemma, score) of every lexicon form for each UD tag, so a token is #
+# scored by a single probe. The table is compiled once and cached     #
+# next to the first lexicon (.lext), like compiled lexicons (.lexc).  #
+#######################################################################
+
+import collections, hashlib, os.path, pickle
+import scripts.lemmacompare
+import scripts.ofrpostprocess
+import scripts.standardizepos
+from lib.lexicon import Lexicon, save_cache, source_stamp
+from lib.normalizers import Normalizer, sniff_lexicon
+from lib.vocab import Vocab
+
+Token = collections.namedtuple('Token', ['form', 'pos', 'lemma', 'score'])
+
+CACHE = 1 << 20 # entries in a cache of results before it is cleared
+
+TABLE_EXT = '.lext'
+TABLE_VERSION = 1
+TABLE_TAGS = sorted(set(scripts.lemmacompare.udpos_simplified)) + [''] # columns of the decision table
+TABLE_COLUMNS = {tag: i for i, tag in enumerate(TABLE_TAGS)}
+
+def lacks_gold(x):
+    # True if a token (form, pos, lemma, given as a tuple or the columns
+    # of a line) has no usable gold annotation, i.e. no gold lemma or no
+    # single gold pos tag.
+    return len(x) < 3 or not x[1] or '|' in x[1] or not x[2]
+
+class Lemmatizer():
+
+    def __init__(self, lexicons=[], overlays=[], backends=[], inputanno='gold',
+        ignore_numbers=True, mapsdir=scripts.standardizepos.DEFAULT_MAPSDIR, table=False):
+        # backends are Tagger objects (see scripts/taggers.py), best first.
+        # overlays are applied to the first lexicon. inputanno says how
+        # annotated input tokens are treated: 'gold', 'auto' or 'ignore'.
+        # table loads the decision table, which is only used by jobs
+        # without taggers.
+        self.sources = list(lexicons) + list(overlays)
+        self.maps = scripts.standardizepos.load_maps(mapsdir)
+        self.normalizer = Normalizer(pnc_in_tok=False)
+        self.lexicons = [] # (Lexicon, Normalizer, pos map) tuples
+        for i, fname in enumerate(lexicons):
+            lexicon = Lexicon(fname, overlays if i == 0 else [])
+            normalizer = Normalizer(pnc_in_tok=False, **sniff_lexicon(' '.join(lexicon.forms())))
+            tags = set([pos for form in lexicon.forms() for lemma, pos in lexicon.lookup(form)])
+            self.lexicons.append((lexicon, normalizer, self.select_map(tags)))
+        self.attested_lemmas = scripts.lemmacompare.attested(
+            [x[0] for x in self.lexicons], ignore_numbers
+        ) if lexicons else None
+        self.backends = list(backends)
+        self.tagger_maps = {} # key = index of the backend
+        self.inputanno = inputanno
+        self.ignore_numbers = ignore_numbers
+        self.vocab = Vocab()
+        self.empty = self.vocab.encode(()) # id of no analyses / lemmas
+        self.lookups = {} # key = form id, value = id of the analyses
+        self.scores = {} # key = score_ids() arguments, value = its result
+        self.corrections = {} # key = (form, pos, lemma) ids, value = apply_rules() result
+        self.table = {} # key = form, value = (lemma, score) for each of TABLE_TAGS
+        if table and lexicons: self.load_table()
+
+    def select_map(self, tags):
+        # Map from a tagset to UD; {} if there is none, in which case the
+        # tags are assumed to be UD already.
+        return scripts.standardizepos.select_map(tags, self.maps)[1]
+
+    def standardize(self, tag, themap):
+        # Tags missing from the map are deleted, as by standardizepos.py
+        return themap.get(tag, '') if themap else tag
+
+    def normalize(self, form):
+        # Normalizes a form as the lemmatizer normalizes its input files;
+        # numbers are left alone.
+        if form[0] == '.' or form[-1] == '.': return form
+        return self.normalizer.normalize_tok(form)
+
+    def lookup(self, form):
+        # Returns the (pos, lemma) analyses of a normalized form in all
+        # lexicons, with UD pos tags, as given by lemma-lookup.py.
+        return self.vocab.decode(self.lookup_id(self.vocab.encode(form)))
+
+    def lookup_id(self, form):
+        # As lookup(), from the id of the form to the id of the tuple of
+        # analyses.
+        try:
+            return self.lookups[form]
+        except KeyError:
+            pass
+        self.lookups[form] = self.vocab.encode(self.analyses(self.vocab.decode(form)))
+        return self.lookups[form]
+
+    def analyses(self, form):
+        # As lookup(), uncached.
+        tok = form.strip()
+        analyses = []
+        for lexicon, normalizer, themap in self.lexicons:
+            x = normalizer.normalize_tok(tok)
+            found = lexicon.lookup(x, self.ignore_numbers) or lexicon.lookup(x.lower(), self.ignore_numbers)
+            analyses.extend([(self.standardize(pos, themap), lemma) for lemma, pos in found])
+        return tuple(analyses)
+
+    def table_config(self):
+        # The configuration the decision table is built for.
+        return ([os.path.abspath(x) for x in self.sources], self.maps, self.ignore_numbers, TABLE_TAGS)
+
+    def table_stamp(self):
+        # What the decision table depends on, besides the code.
+        return (self.table_config(), [source_stamp(x) for x in self.sources])
+
+    def table_file(self):
+        # Cache file of the decision table, next to the first lexicon:
+        # one per configuration, so that runs with different overlays
+        # don't rebuild each other's table.
+        key = hashlib.sha1(repr(self.table_config()).encode('utf-8')).hexdigest()[:12]
+        return self.sources[0] + '.' + key + TABLE_EXT
+
+    def load_table(self, cache=True):
+        # Loads the decision table, (re)compiling it if the cache is
+        # missing or out of date.
+        cachefile = self.table_file()
+        stamp = self.table_stamp()
+        if cache and os.path.exists(cachefile):
+            try:
+                with open(cachefile, 'rb') as f:
+                    d = pickle.load(f)
+                if d['version'] == TABLE_VERSION and d['source'] == stamp:
+                    self.table = d['table']
+                    return
+            except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+                pass # recompile
+        self.table = self.build_table()
+        if not cache: return
+        save_cache(cachefile, {'version': TABLE_VERSION, 'source': stamp, 'table': self.table})
+
+    def build_table(self):
+        # Scores every lexicon form with each of TABLE_TAGS as gold pos
+        # tag, as score_ids() does without taggers. Forms with the same
+        # analyses share their row.
+        table, rows = {}, {} # rows: key = analyses, value = row
+        for lexicon, normalizer, themap in self.lexicons:
+            for form in lexicon.forms():
+                if form in table: continue
+                analyses = self.analyses(form)
+                if not analyses in rows:
+                    rows[analyses] = tuple([scripts.lemmacompare.score_token(
+                        [tag] if tag else [], [], [], list(analyses), self.attested_lemmas, self.ignore_numbers
+                    ) for tag in TABLE_TAGS])
+                table[form] = rows[analyses]
+        return table
+
+    def decide(self, form, pos=''):
+        # Lemma and score of a normalized form with gold pos tag pos (or
+        # none) and no gold lemma, in a job without taggers: a single probe
+        # of the decision table if it has the form and the tag.
+        try:
+            return self.table[form][TABLE_COLUMNS[pos]]
+        except KeyError:
+            pass
+        encode = self.vocab.encode
+        pos, lemma, score = self.score_ids(encode(pos), self.empty, (), (), self.lookup_id(encode(form)))
+        return self.vocab.decode(lemma), score
+
+    def tag(self, sentences):
+        # Runs the backends on sentences (lists of normalized forms).
+        # Returns a list of (backend, tagged sentences) for the backends
+        # that succeeded. Tagged sentences are lists of the ids of (pos,
+        # lemma) with UD pos tags; the lemma is '' if the tagger gives
+        # none. The tagset of each backend is detected on its first batch.
+        outputs = []
+        for i, backend in enumerate(self.backends):
+            try:
+                tagged = list(backend.tag_sentences(sentences))
+            except Exception as e:
+                if not backend.optional: raise
+                print('Warning: ' + backend.name + ' tagger failed: ' + repr(e))
+                continue
+            if not i in self.tagger_maps:
+                self.tagger_maps[i] = self.select_map(set([x[1] for sentence in tagged for x in sentence]))
+            themap = self.tagger_maps[i]
+            encode = self.vocab.encode
+            outputs.append((backend, [
+                [
+                    tuple([encode(y) for y in scripts.lemmacompare.get_pos_lemma(
+                        [x[0], self.standardize(x[1], themap)] + list(x[2:])
+                    )]) for x in sentence
+                ] for sentence in tagged
+            ]))
+        return outputs
+
+    def score(self, form, goldpos='', goldlemmas=[], autopos=[], autoposlemma=[], lookups=[]):
+        # Scores one token, as lemmacompare.py does. autopos are the pos
+        # tags from sources without lemmas, autoposlemma the (pos, lemma)
+        # tuples from the others, best first; lookups are the token's
+        # lexicon analyses. Returns a Token.
+        encode, decode = self.vocab.encode, self.vocab.decode
+        pos, lemma, score = self.score_ids(
+            encode(goldpos), encode(tuple(goldlemmas)), tuple([encode(x) for x in autopos]),
+            tuple([(encode(x), encode(y)) for x, y in autoposlemma]), encode(tuple(lookups))
+        )
+        return Token(form, decode(pos), decode(lemma), score)
+
+    def score_ids(self, goldpos, goldlemmas, autopos, autoposlemma, lookups):
+        # As score(), on ids: goldpos is the id of the gold tag, goldlemmas
+        # and lookups the ids of tuples of gold lemmas and analyses,
+        # autopos a tuple of tag ids and autoposlemma a tuple of (tag id,
+        # lemma id). Returns (pos id, lemma id, score).
+        key = (goldpos, goldlemmas, autopos, autoposlemma, lookups)
+        try:
+            return self.scores[key]
+        except KeyError:
+            pass
+        decode = self.vocab.decode
+        if autopos or autoposlemma:
+            pos = scripts.lemmacompare.choose_pos(
+                [decode(x) for x in autopos] + [decode(x) for x, y in autoposlemma], decode(goldpos)
+            )
+        else:
+            pos = decode(goldpos)
+        autolemmas = scripts.lemmacompare.choose_autolemmas(
+            [(decode(x), decode(y)) for x, y in autoposlemma], pos
+        ) if autoposlemma else []
+        lemma, score = scripts.lemmacompare.score_token(
+            pos.split('|') if pos else [], list(decode(goldlemmas)), autolemmas,
+            list(decode(lookups)), self.attested_lemmas, self.ignore_numbers
+        )
+        if len(self.scores) >= CACHE: self.scores.clear()
+        self.scores[key] = (self.vocab.encode(pos), self.vocab.encode(lemma), score)
+        return self.scores[key]
+
+    def apply_rules(self, form, pos, lemma):
+        # ofrpostprocess.apply_rules, cached.
+        key = (self.vocab.encode(form), self.vocab.encode(pos), self.vocab.encode(lemma))
+        try:
+            return self.corrections[key]
+        except KeyError:
+            pass
+        if len(self.corrections) >= CACHE: self.corrections.clear()
+        self.corrections[key] = scripts.ofrpostprocess.apply_rules(form, pos, lemma)
+        return self.corrections[key]
+
+    def postprocess(self, tokens, last=None):
+        # Applies the corrections of ofrpostprocess.py to a sentence;
+        # corrected lemmas get a score of 11. last is the last token of
+        # the previous sentence.
+        processed = []
+        for token in tokens:
+            lemma = scripts.ofrpostprocess.correct_lemma(token.form, token.pos, token.lemma, last, self.apply_rules)
+            if lemma is not None:
+                token = token._replace(lemma=lemma, score=11)
+            processed.append(token)
+            last = token
+        return processed
+
+    def lemmatize_batch(self, sentences):
+        # sentences is an iterable of lists of tokens. A token is a form or
+        # a (form, pos) or (form, pos, lemma) tuple with input annotation
+        # (UD pos tags), treated according to inputanno. Sentences in which
+        # every token has gold annotation are not tagged.
+        # Returns a list of lists of Tokens with the forms as given.
+        encode, decode = self.vocab.encode, self.vocab.decode
+        sentences = [[(x,) if isinstance(x, str) else tuple(x) for x in sentence] for sentence in sentences]
+        forms = [[encode(self.normalize(x[0].strip())) for x in sentence] for sentence in sentences]
+        ixs = [
+            i for i, sentence in enumerate(sentences) if sentence and \
+            not (self.inputanno == 'gold' and not [x for x in sentence if lacks_gold(x)])
+        ]
+        outputs = self.tag([[decode(x) for x in forms[i]] for i in ixs]) if self.backends and ixs else []
+        tagged = {i: k for k, i in enumerate(ixs)} # sentence index > index in outputs
+        blank = encode('')
+        results, last = [], None
+        for i, sentence in enumerate(sentences):
+            tokens = []
+            for j, x in enumerate(sentence):
+                goldpos, goldlemmas, autopos, autoposlemma = blank, self.empty, [], []
+                if self.inputanno == 'gold':
+                    goldpos = encode(scripts.lemmacompare.get_pos(x))
+                    if len(x) > 2 and x[2]: goldlemmas = encode(tuple(x[2].split('|')))
+                elif self.inputanno == 'auto' and len(x) == 2:
+                    autopos.append(encode(x[1]))
+                elif self.inputanno == 'auto' and len(x) > 2:
+                    autoposlemma.append(tuple([encode(y) for y in scripts.lemmacompare.get_pos_lemma(x)]))
+                if i in tagged:
+                    for backend, output in outputs:
+                        pos, lemma = output[tagged[i]][j]
+                        if backend.lemmas:
+                            autoposlemma.append((pos, lemma))
+                        else:
+                            autopos.append(pos)
+                if not autopos and not autoposlemma and goldlemmas == self.empty:
+                    lemma, score = self.decide(decode(forms[i][j]), decode(goldpos))
+                    tokens.append(Token(x[0], decode(goldpos), lemma, score))
+                    continue
+                # Gold lemmas are never checked against the lexicons
+                lookups = self.empty if goldlemmas != self.empty else self.lookup_id(forms[i][j])
+                pos, lemma, score = self.score_ids(goldpos, goldlemmas, tuple(autopos), tuple(autoposlemma), lookups)
+                tokens.append(Token(x[0], decode(pos), decode(lemma), score))
+            tokens = self.postprocess(tokens, last)
+            if tokens: last = tokens[-1]
+            results.append(tokens)
+        return results
+
+    def lemmatize(self, tokens):
+        # Lemmatizes a single sentence. Returns a list of Tokens.
+        return self.lemmatize_batch([tokens])[0]
@@ -2,46 +2,104 @@
 
 #######################################################################
 # Converts an XML lexicon downloaded from the ATILF website into a    #
-# csv table.                                                          #
-# Requires "saxonb-xslt" to be on the system path                     #
-# Try apt install saxonb                                              #
+# csv table (lemma TAB pos TAB form|form|...).                        #
+# The XML is read in chunks and parsed incrementally with expat, so   #
+# memory use doesn't depend on the size of the lexicon. The output is #
+# the same as that of the former lgerm-xml2tsv.xsl stylesheet: one    #
+# line per formSet, with the first orthography of the lemmatizedForm, #
+# its first grammaticalCategory and the first orthography of each     #
+# inflectedForm.                                                      #
 #######################################################################
 
-import argparse, os.path, sys, subprocess, tempfile, re
-    
-def main(infile, outfile):
-    path = os.path.dirname(os.path.realpath(__file__))
-    # Step 1. Convert to utf-8
-    # 1a. Open temp dir
-    with tempfile.TemporaryDirectory() as tmpdir:
-    #tmpdir = '/home/tmr'
-        tmp = open(os.path.join(tmpdir, 'tmp.xml'), 'w', encoding='utf-8', errors='replace')
-        # 1b. Open xml file
-        f = open(infile, 'r', encoding='iso-8859-1', errors='replace')
-        for line in f:
-            x = xmlentcheck(line)
-            tmp.write(x)
-        f.close()
-        tmp.close()
-        # Write call to saxonb parser
-        args = ['saxonb-xslt', os.path.join(tmpdir, 'tmp.xml'), os.path.join(path, 'lgerm-xml2tsv.xsl')]
-        with open(os.path.join(tmpdir, 'tmp.tsv'), 'wb') as f:
-            subprocess.run(args, stdout=f) # XSLT parser prints to stout
-        # Capitalize all lemmas which are given as nom propre or nom de lieu
-        with open(os.path.join(tmpdir, 'tmp.tsv'), 'r', encoding='utf-8') as fin:
-            with open(outfile, 'w', encoding='utf-8') as fout:
-                for line in fin:
-                    if line.count('nom propre\t') or line.count('nom de lieu\t'):
-                        line = line[0].upper() + line[1:]
-                    fout.write(line)
-
-def xmlentcheck(s):
-    # Replaces ampersands with &amp; (bug in source XML)
-    s = s.replace('&', '&amp;')
-    for char in s:
-        if (ord(char) > 31 and ord(char) < 65534) or ord(char) in [9, 10, 13]: continue
-        s = s.replace(char, '?') # replace characters disallowed in XML
-    return s
+import argparse, xml.parsers.expat
+from lib.lexicon import load_base
+from lib.compression import open_file
+
+CHUNK = 1 << 20 # characters read at a time
+
+# Ampersands are not escaped in the source XML; characters disallowed in
+# XML are replaced with '?'. The source is read as ISO-8859-1, so no
+# character is above 255.
+XMLENTS = {ord('&'): '&amp;'}
+XMLENTS.update({x: '?' for x in range(32) if not x in [9, 10, 13]})
+
+class LgermParser():
+
+    def __init__(self, fout):
+        self.fout = fout
+        self.parser = xml.parsers.expat.ParserCreate(encoding='UTF-8')
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.char_data
+        self.parser.buffer_text = True
+        self.stack = [] # names of the open elements
+        self.lemmas, self.forms = [], [] # of the current formSet
+        self.fields = {} # orthography and category of the current lemmatizedForm
+        self.orthography = None # of the current inflectedForm
+        self.capture = None # depth of the element whose text is being read
+        self.text = [] # its first text node
+        self.complete = False # True once a child element follows the text
+
+    def parse(self, infile):
+        # Source files are ISO-8859-1; the translated text is passed to
+        # expat as str, i.e. as UTF-8.
+        with open_file(infile, 'r', encoding='iso-8859-1', errors='replace') as f:
+            while True:
+                s = f.read(CHUNK)
+                self.parser.Parse(s.translate(XMLENTS), not s)
+                if not s: break
+
+    def start_element(self, name, attrs):
+        parents = self.stack[-2:]
+        if self.capture is not None:
+            # Only the first text node counts, as in xsl:value-of
+            if self.text: self.complete = True
+            self.stack.append(name)
+            return
+        if name == 'formSet':
+            self.lemmas, self.forms = [], []
+        elif parents[-1:] == ['formSet'] and name == 'lemmatizedForm':
+            self.fields = {'orthography': None, 'grammaticalCategory': None}
+        elif parents[-1:] == ['formSet'] and name == 'inflectedForm':
+            self.orthography = None
+        elif parents == ['formSet', 'lemmatizedForm'] and self.fields.get(name, '') is None:
+            self.capture, self.text, self.complete = len(self.stack), [], False
+        elif parents == ['formSet', 'inflectedForm'] and name == 'orthography' and self.orthography is None:
+            self.capture, self.text, self.complete = len(self.stack), [], False
+        self.stack.append(name)
+
+    def end_element(self, name):
+        self.stack.pop()
+        if self.capture is not None:
+            if self.capture == len(self.stack):
+                if self.stack[-1] == 'lemmatizedForm':
+                    self.fields[name] = ''.join(self.text)
+                else:
+                    self.orthography = ''.join(self.text)
+                self.capture = None
+            return
+        if name == 'lemmatizedForm' and self.stack[-1:] == ['formSet']:
+            self.lemmas.append(
+                (self.fields['orthography'] or '') + '\t' + (self.fields['grammaticalCategory'] or '')
+            )
+        elif name == 'inflectedForm' and self.stack[-1:] == ['formSet']:
+            self.forms.append(self.orthography or '')
+        elif name == 'formSet':
+            line = ''.join(self.lemmas) + '\t' + '|'.join(self.forms) + '\n'
+            # Capitalize all lemmas which are given as nom propre or nom de lieu
+            if line.count('nom propre\t') or line.count('nom de lieu\t'):
+                line = line[0].upper() + line[1:]
+            self.fout.write(line)
+
+    def char_data(self, data):
+        if self.capture == len(self.stack) - 1 and not self.complete:
+            self.text.append(data)
+
+def main(infile, outfile, compile_lexicon=False):
+    with open_file(outfile, 'w', encoding='utf-8') as fout:
+        LgermParser(fout).parse(infile)
+    if compile_lexicon:
+        load_base(outfile)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -51,5 +109,7 @@ if __name__ == '__main__':
         )
     parser.add_argument('infile', help='Input XML file to load or import.')
     parser.add_argument('outfile', help='Output CSV file to save or export.')
+    parser.add_argument('--compile', dest='compile_lexicon', action='store_true',
+        help='Also write the compiled lookup table used by the lemmatizer.')
     args = vars(parser.parse_args())
-    main(args.pop('infile'), args.pop('outfile'))
+    main(**args)
@@ -5,7 +5,9 @@
 # the BFM norm and                                                    #
 #######################################################################
 
-import re
+import bisect, os.path, re
+from collections import Counter
+from lib.compression import open_file
 
 correct_lemmas = [
     # preposition + det forms with wrong lemma form
@@ -75,31 +77,123 @@ correct_lemmas = [
     ('ú', 'PRON', '.*', 'où'),
 ]
 
-def main(infile, outfile):
-    unks = []
-    with open(infile, 'r', encoding='utf-8') as fin:
-        with open(outfile, 'w', encoding='utf-8') as fout:
+class UnknownLemmas():
+    # Report of the lemmas scored -10 (i.e. guessed by the tagger and not
+    # found in any lexicon). Counts are kept per lemma, per input file
+    # and per form, with the first few contexts each lemma occurs in.
+    # path_lines is Concatenater.path_lines: (path, last line index) for
+    # each concatenated file.
+    
+    EXAMPLES = 3 # contexts kept per lemma
+    CONTEXT = 3 # tokens either side of the form
+    
+    def __init__(self, path_lines=[]):
+        self.counts = Counter()
+        self.file_counts = Counter() # key = (path, lemma)
+        self.form_counts = {} # key = lemma, value = Counter of forms
+        self.examples = {} # key = lemma, value = list of contexts
+        self.paths, self.ends, end = [], [], 0
+        for path, i in path_lines:
+            end += i + 1
+            self.paths.append(path)
+            self.ends.append(end)
+        self.window = [] # forms of the current sentence (at least CONTEXT)
+        self.pending = [] # examples waiting for their right context
+        
+    def add_token(self, line_no, form, lemma, unknown=False):
+        self.window.append(form)
+        if unknown:
+            self.counts[lemma] += 1
+            if self.paths:
+                ix = min(bisect.bisect_right(self.ends, line_no), len(self.paths) - 1)
+                self.file_counts[(self.paths[ix], lemma)] += 1
+            self.form_counts.setdefault(lemma, Counter())[form] += 1
+            examples = self.examples.setdefault(lemma, [])
+            if len(examples) < self.EXAMPLES:
+                examples.append('')
+                self.pending.append((lemma, len(examples) - 1, len(self.window) - 1))
+        # Fill in the examples that have their right context now
+        while self.pending and self.pending[0][2] + self.CONTEXT < len(self.window):
+            self.resolve(*self.pending.pop(0))
+        if not self.pending and len(self.window) > self.CONTEXT:
+            del self.window[:-self.CONTEXT]
+            
+    def end_sentence(self):
+        while self.pending:
+            self.resolve(*self.pending.pop(0))
+        self.window = []
+        
+    def resolve(self, lemma, example, ix):
+        self.examples[lemma][example] = ' '.join(
+            self.window[max(0, ix - self.CONTEXT):ix] + ['[' + self.window[ix] + ']'] + \
+            self.window[ix + 1:ix + 1 + self.CONTEXT]
+        )
+        
+    def top(self, k=None):
+        # List of (frequency, lemma) tuples, most frequent first.
+        return [(freq, lemma) for lemma, freq in self.counts.most_common(k)]
+        
+    def print_top(self, k=None):
+        print('Unknown lemmas')
+        for freq, lemma in self.top(k):
+            print(str(freq) + '\t' + lemma)
+            
+    def write_tsv(self, outfile):
+        # One line per lemma: lemma, frequency, frequency per file,
+        # forms with their frequency and example contexts.
+        with open_file(outfile, 'w', encoding='utf-8') as f:
+            f.write('lemma\tfreq\tfiles\tforms\texamples\n')
+            for freq, lemma in self.top():
+                files = [
+                    os.path.basename(path) + ':' + str(self.file_counts[(path, lemma)])
+                    for path in self.paths if (path, lemma) in self.file_counts
+                ]
+                forms = [
+                    form + ':' + str(n) for form, n in self.form_counts[lemma].most_common()
+                ]
+                f.write('\t'.join([
+                    lemma, str(freq), '|'.join(files), '|'.join(forms),
+                    ' | '.join(self.examples[lemma])
+                ]) + '\n')
+
+def apply_rules(form, pos, lemma):
+    # Returns the lemma as corrected by the correct_lemmas rules, or None
+    # if no rule applies.
+    corrected = None
+    for entry in correct_lemmas:
+        if pos == entry[1] and re.fullmatch(r'(.*\|)?' + entry[2] + r'(\|.*)?', lemma) and re.fullmatch(entry[0], form.lower()):
+            lemma = corrected = entry[3]
+    return corrected
+
+def correct_lemma(form, pos, lemma, last=None, rules=apply_rules):
+    # Returns the corrected lemma of a token, or None if no correction
+    # applies. last is the (form, pos, lemma) of the previous token.
+    # rules is apply_rules or a function giving the same results.
+    corrected = rules(form, pos, lemma)
+    # Check for l'en, where l' is a determiner, should be "on"
+    if last and last[1].endswith('DET') and last[2] == 'le' and pos == 'PRON' and (corrected or lemma) == 'en':
+        corrected = 'on'
+    return corrected
+
+def main(infile, outfile, unknowns=None, rules=apply_rules):
+    # Returns the UnknownLemmas report.
+    if unknowns is None: unknowns = UnknownLemmas()
+    with open_file(infile, 'r', encoding='utf-8') as fin:
+        with open_file(outfile, 'w', encoding='utf-8') as fout:
             last_line = []
-            for line in fin:
+            for line_no, line in enumerate(fin):
                 try:
                     form, pos, lemma, score = line.rstrip().split('\t')
                 except:
                     fout.write(line)
+                    unknowns.end_sentence()
                     continue
-                # Correct certain lemmas
-                for entry in correct_lemmas:
-                    if pos == entry[1] and re.fullmatch(r'(.*\|)?' + entry[2] + r'(\|.*)?', lemma) and re.fullmatch(entry[0], form.lower()):
-                        lemma = entry[3]
-                        score = '11'
-                # Check for l'en, where l' is a determiner, should be "on"
-                if last_line and last_line[1].endswith('DET') and last_line[2] == 'le' and pos == 'PRON' and lemma == 'en':
-                    lemma = 'on'
-                    score = '11'
-                # Add a big fat '?' in front of -10 scored lemmas
-                if str(score) == '-10' and lemma != 'UNKNOWN':
-                    #lemma = '?' + lemma
-                    unks.append(lemma)
-                    #print(lemma)
+                corrected = correct_lemma(form, pos, lemma, last_line, rules)
+                if corrected is not None:
+                    lemma, score = corrected, '11'
+                # Record -10 scored lemmas
+                unknowns.add_token(line_no, form, lemma, str(score) == '-10' and lemma != 'UNKNOWN')
                 fout.write('\t'.join([form, pos, lemma, score]) + '\n')
                 last_line = [form, pos, lemma, score]
-    return unks
+    unknowns.end_sentence()
+    return unknowns
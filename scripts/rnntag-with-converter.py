@@ -19,6 +19,7 @@ from lib.normalizers import Normalizer
 from lib.concat import Concatenater
 import convertfiles
 import rnntag
+from lib.compression import copy_file, open_file, strip_compression
 
 opj = os.path.join
 
@@ -29,8 +30,8 @@ def normalize_infile(infile, outfile):
     # Return max number of columns.
     normalizer = Normalizer(pnc_in_tok=False)
     #normalizer.pnc_in_tok_except.extend(['@', '#']) # Used in MCVF
-    with open(infile, 'r', encoding='utf-8') as fin:
-        with open(outfile, 'w', encoding='utf-8') as fout:
+    with open_file(infile, 'r', encoding='utf-8') as fin:
+        with open_file(outfile, 'w', encoding='utf-8') as fout:
             l = []
             for line in fin:
                 x = line.rstrip().split('\t')
@@ -51,7 +52,7 @@ def main(tmpdir, infiles=[], rnnpath='', lang='', outfile='', outdir='', exportl
     print('Converting and concatenating input files.')
     converters, converted_infiles = [], []
     for infile in infiles:
-        if os.path.splitext(infile)[1] not in ['', '.txt', '.tsv']:
+        if os.path.splitext(strip_compression(infile))[1] not in ['', '.txt', '.tsv']:
             converter = convertfiles.get_converter(infile)
             converter.exportpos = True
             converter.exportlemma = exportlemma
@@ -78,7 +79,7 @@ def main(tmpdir, infiles=[], rnnpath='', lang='', outfile='', outdir='', exportl
     )
     # 2. Reconvert output files
     if outdir or \
-    (outfile and len(infiles) == 1 and os.path.splitext(outfile)[1] == os.path.splitext(infiles[0])[1]):
+    (outfile and len(infiles) == 1 and os.path.splitext(strip_compression(outfile))[1] == os.path.splitext(strip_compression(infiles[0]))[1]):
         # Only reconverts files if an outdir is given, or one one infile
         # was given with an outfile with an identical extension.
         print('Splitting and back-converting output to original format.')
@@ -91,11 +92,11 @@ def main(tmpdir, infiles=[], rnnpath='', lang='', outfile='', outdir='', exportl
                 outfile = ''
             else:
                 outfile = outfile or opj(outdir, os.path.basename(converted_infile))
-                shutil.copy2(opj(tmpdir, 'rnn.txt'), outfile)
+                copy_file(opj(tmpdir, 'rnn.txt'), outfile)
     elif outfile:
-        shutil.copy2(opj(tmpdir, 'rnn.txt'), outfile)
+        copy_file(opj(tmpdir, 'rnn.txt'), outfile)
     else: # Nowhere else to dump the output, print it to stdout.
-        with open(opj(tmpdir, 'rnn.txt'), 'r', encoding='utf-8') as f:
+        with open_file(opj(tmpdir, 'rnn.txt'), 'r', encoding='utf-8') as f:
             for line in f:
                 print(line[:-1])
     
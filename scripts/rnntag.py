@@ -11,8 +11,9 @@
 # + Applies file converters                                           #
 #######################################################################
 
-import argparse, os, os.path, shutil, subprocess, tempfile, sys
+import argparse, concurrent.futures, os, os.path, shutil, subprocess, tempfile, sys
 from lib.concat import Concatenater
+from lib.compression import copy_file, open_file
 
 opj = os.path.join
 
@@ -22,7 +23,7 @@ class Error(Exception):
 class InputDataError(Exception):
     pass
     
-def main(rnnpath, lang, infiles, outdir='', outfile=''):
+def main(rnnpath, lang, infiles, outdir='', outfile='', bucket=False, workers=1, threads=None):
     #tmpdir='/home/tmr/tmp/rnn'
     #if True:
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -42,11 +43,21 @@ def main(rnnpath, lang, infiles, outdir='', outfile=''):
         # Standardize empty lines
         empty_lines = tokenize_sentences(infile_rnn, s_tokenized_infile)
         #print(empty_lines)
-        # Next, call the RNN Tagger with HS's shell script
-        if lang == 'old-french' and os.path.exists(opj(rnnpath, 'Python', 'rnn-annotate.py')):
-            shell_script_of(rnnpath, lang, s_tokenized_infile, s_tokenized_outfile, tmpdir)
+        # Optionally, sort the sentences by length so that the tagger's
+        # batches hold sentences of similar length.
+        tagger_infile, tagger_outfile = s_tokenized_infile, s_tokenized_outfile
+        if bucket:
+            tagger_infile, tagger_outfile = opj(tmpdir, 'bucketed.txt'), opj(tmpdir, 'bucketed_out.txt')
+            order = bucket_sentences(s_tokenized_infile, tagger_infile)
+        # Next, call the RNN Tagger with HS's shell script, in one or more
+        # worker processes
+        env = thread_env(threads)
+        if workers > 1:
+            run_workers(rnnpath, lang, tagger_infile, tagger_outfile, tmpdir, workers, env)
         else:
-            shell_script_standard(rnnpath, lang, s_tokenized_infile, s_tokenized_outfile, tmpdir)
+            run_tagger(rnnpath, lang, tagger_infile, tagger_outfile, tmpdir, env)
+        if bucket:
+            restore_order(tagger_outfile, s_tokenized_outfile, order)
         #if has_empty_lines: # Original file was s-tokenized.
         #    shutil.move(s_tokenized_outfile, outfile)
         #else:
@@ -55,9 +66,9 @@ def main(rnnpath, lang, infiles, outdir='', outfile=''):
         if outdir:
             concatenater.split(outfile_rnn, outdir=outdir)
         elif outfile:
-            shutil.copy2(outfile_rnn, outfile)
+            copy_file(outfile_rnn, outfile)
         else: # Nowhere else to dump the output, print it to stdout.
-            with open(outfile_rnn, 'r', encoding='utf-8') as f:
+            with open_file(outfile_rnn, 'r', encoding='utf-8') as f:
                 for line in f:
                     print(line[:-1])
 
@@ -102,6 +113,53 @@ def tokenize_sentences(infile, outfile):
             l.append(-1)
     return l
         
+def sentence_offsets(f, lengths=None):
+    # Returns a list of (byte offset, number of lines) for the sentences
+    # of a binary file, each ended by an empty line. If lengths is given,
+    # sentences are read as that many lines plus the empty line instead.
+    l = []
+    if lengths is not None:
+        for n in lengths:
+            l.append((f.tell(), n))
+            for i in range(n + 1): f.readline()
+        return l
+    offset, n = 0, 0
+    for line in iter(f.readline, b''):
+        if line.strip():
+            n += 1
+        else:
+            l.append((offset, n))
+            offset, n = f.tell(), 0
+    if n: l.append((offset, n))
+    return l
+
+def bucket_sentences(infile, outfile):
+    # Writes the sentences of an s-tokenized file sorted by length
+    # (stable, so equally long sentences keep their order). Returns the
+    # (original index, number of lines) of each sentence written, in
+    # order, for restore_order.
+    with open(infile, 'rb') as fin:
+        offsets = sentence_offsets(fin)
+        order = sorted(range(len(offsets)), key=lambda i: offsets[i][1])
+        with open(outfile, 'wb') as fout:
+            for i in order:
+                fin.seek(offsets[i][0])
+                for j in range(offsets[i][1] + 1): fout.write(fin.readline())
+    return [(i, offsets[i][1]) for i in order]
+
+def restore_order(infile, outfile, order):
+    # Writes the tagged sentences of a bucketed file back in their
+    # original order. Tagger output is line-aligned with its input, so
+    # sentences are located by their number of lines.
+    with open(infile, 'rb') as fin:
+        offsets = sentence_offsets(fin, [x[1] for x in order])
+        positions = [0] * len(order) # original index > position in infile
+        for position, (i, n) in enumerate(order): positions[i] = position
+        with open(outfile, 'wb') as fout:
+            for position in positions:
+                fin.seek(offsets[position][0])
+                for j in range(offsets[position][1] + 1): fout.write(fin.readline())
+
 def remove_empty_lines(infile, outfile, empty_lines=[]):
     # Removes blank lines from file
     print('Restoring empty lines')
@@ -113,7 +171,62 @@ def remove_empty_lines(infile, outfile, empty_lines=[]):
                 if add >= 0: # if add >= 0, write the line
                     fout.write(line)
     
-def shell_script_standard(rnnpath, lang, infile, outfile, tmpdir='/home/tmr/tmp'):
+def thread_env(threads=None):
+    # Environment for the tagger processes, limiting the number of
+    # threads used by torch (OpenMP) and MKL.
+    env = dict(os.environ)
+    if threads:
+        for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS']:
+            env[var] = str(threads)
+    return env
+
+def run_tagger(rnnpath, lang, infile, outfile, tmpdir, env=None):
+    if lang == 'old-french' and os.path.exists(opj(rnnpath, 'Python', 'rnn-annotate.py')):
+        shell_script_of(rnnpath, lang, infile, outfile, tmpdir, env)
+    else:
+        shell_script_standard(rnnpath, lang, infile, outfile, tmpdir, env)
+
+def shard_sentences(infile, outfiles):
+    # Splits an s-tokenized file at sentence boundaries into contiguous
+    # shards with about the same number of lines each.
+    with open(infile, 'rb') as f:
+        total = sum(1 for line in f)
+    with open(infile, 'rb') as fin:
+        i, n, fout = 0, 0, open(outfiles[0], 'wb')
+        for line in fin:
+            fout.write(line)
+            n += 1
+            if not line.strip() and n >= total * (i + 1) / len(outfiles) and i < len(outfiles) - 1:
+                fout.close()
+                i += 1
+                fout = open(outfiles[i], 'wb')
+        fout.close()
+        for outfile in outfiles[i + 1:]: open(outfile, 'wb').close()
+
+def run_workers(rnnpath, lang, infile, outfile, tmpdir, workers, env=None):
+    # Tags the shards of infile in parallel, each in its own temporary
+    # directory, and concatenates the output in order.
+    shard_dirs = [opj(tmpdir, 'worker' + str(i)) for i in range(workers)]
+    for shard_dir in shard_dirs: os.mkdir(shard_dir)
+    shard_infiles = [opj(x, 'in.txt') for x in shard_dirs]
+    shard_outfiles = [opj(x, 'out.txt') for x in shard_dirs]
+    shard_sentences(infile, shard_infiles)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for shard_infile, shard_outfile, shard_dir in zip(shard_infiles, shard_outfiles, shard_dirs):
+            if os.path.getsize(shard_infile) == 0:
+                open(shard_outfile, 'wb').close()
+                continue
+            futures.append(executor.submit(
+                run_tagger, rnnpath, lang, shard_infile, shard_outfile, shard_dir, env
+            ))
+        for future in futures: future.result() # raises any exception
+    with open(outfile, 'wb') as fout:
+        for shard_outfile in shard_outfiles:
+            with open(shard_outfile, 'rb') as fin:
+                shutil.copyfileobj(fin, fout)
+
+def shell_script_standard(rnnpath, lang, infile, outfile, tmpdir='/home/tmr/tmp', env=None):
     
     TAGGER = opj('.', 'PyRNN', 'rnn-annotate.py')
     RNNPAR = opj('.', 'lib', 'PyRNN', lang)
@@ -121,27 +234,29 @@ def shell_script_standard(rnnpath, lang, infile, outfile, tmpdir='/home/tmr/tmp'
     NMTPAR = opj('.', 'lib', 'PyNMT', lang)
     _shell_script(
         rnnpath, lang, infile, outfile, tmpdir,
-        TAGGER, RNNPAR, LEMMATIZER, NMTPAR
+        TAGGER, RNNPAR, LEMMATIZER, NMTPAR, env
     )
     
-def shell_script_of(rnnpath, lang, infile, outfile, tmpdir='/home/tmr/tmp'):
+def shell_script_of(rnnpath, lang, infile, outfile, tmpdir='/home/tmr/tmp', env=None):
     TAGGER = opj('.', 'Python', 'rnn-annotate.py')
     RNNPAR = opj('.', 'lib', 'tagger')
     LEMMATIZER = opj('.', 'Python', 'nmt-translate.py')
     NMTPAR = opj('.', 'lib', 'lemmatizer')
     _shell_script(
         rnnpath, lang, infile, outfile, tmpdir,
-        TAGGER, RNNPAR, LEMMATIZER, NMTPAR
+        TAGGER, RNNPAR, LEMMATIZER, NMTPAR, env
     )
     
 def _shell_script(
     rnnpath, lang, infile, outfile, tmpdir,
-    TAGGER, RNNPAR, LEMMATIZER, NMTPAR
+    TAGGER, RNNPAR, LEMMATIZER, NMTPAR, env=None
 ):
     # Python reimplementation of Helmut Schmidt's shell script,
     # without the tokenization stage.
-    cwd = os.getcwd()
-    os.chdir(rnnpath)
+    # Every step runs with rnnpath as its working directory (instead of
+    # changing this process's directory), so several can run at once.
+    infile, tmpdir = os.path.abspath(infile), os.path.abspath(tmpdir)
+    outfile = os.path.abspath(outfile)
     
     # Step 1. Run the POS tagger
     l = [
@@ -155,19 +270,19 @@ def _shell_script(
     with open(opj(tmpdir, 'tmp.tagged'), 'w') as f:
         #print('With GPU')
         #print(l)
-        process = subprocess.run(l, stdout=f)
+        process = subprocess.run(l, stdout=f, cwd=rnnpath, env=env)
     if process.returncode > 1 or os.path.getsize(opj(tmpdir, 'tmp.tagged')) == 0:
         with open(opj(tmpdir, 'tmp.tagged'), 'w') as f:
             print('Alright, without the GPU then...')
             l.extend(['--gpu', '-1']) #Try GPU -1
-            subprocess.run(l, stdout=f)
+            subprocess.run(l, stdout=f, cwd=rnnpath, env=env)
     # Step 2. Reformat using perl script
     l = [
         'perl', opj('.', 'scripts', 'reformat.pl'), # REFORMAT
         opj(tmpdir, 'tmp.tagged')
     ]
     with open(opj(tmpdir, 'tmp.reformatted'), 'w') as f:
-        subprocess.run(l, stdout=f)
+        subprocess.run(l, stdout=f, cwd=rnnpath, env=env)
     # Step 3. Run the lemmatizer
     l = [
         sys.executable, # gives the venv python executable
@@ -179,7 +294,7 @@ def _shell_script(
     ]
     #print(l)
     with open(opj(tmpdir, 'tmp.lemmas'), 'w') as f:
-        process = subprocess.run(l, stdout=f)
+        process = subprocess.run(l, stdout=f, cwd=rnnpath, env=env)
         
     # Step 4. Lemma lookup
     l = [
@@ -189,10 +304,8 @@ def _shell_script(
         opj(tmpdir, 'tmp.tagged')
     ]
     with open(outfile, 'w') as f:
-        subprocess.run(l, stdout=f)
+        subprocess.run(l, stdout=f, cwd=rnnpath, env=env)
     
-    # Change back to cwd
-    os.chdir(cwd)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -206,8 +319,15 @@ if __name__ == '__main__':
     parser.add_argument('--infiles', nargs='+', help='Input files, one token per line.')
     parser.add_argument('--outdir', help='Output directory.', type=str, default='')
     parser.add_argument('--outfile', help='Output file.', type=str, default='')
+    parser.add_argument('--bucket', action='store_true', help=\
+        'Tag sentences sorted by length, then restore their order.')
+    parser.add_argument('--workers', type=int, default=1, help=\
+        'Number of tagger processes, each tagging a shard of the input.')
+    parser.add_argument('--threads', type=int, default=None, help=\
+        'Number of threads per tagger process (OMP_NUM_THREADS / MKL_NUM_THREADS).')
     args = vars(parser.parse_args())
     main(
         args.pop('rnnpath'), args.pop('lang'), args.pop('infiles'), 
-        args.pop('outdir'), args.pop('outfile')
+        args.pop('outdir'), args.pop('outfile'), args.pop('bucket'),
+        args.pop('workers'), args.pop('threads')
     )
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+#######################################################################
+# Measures the accuracy / throughput trade-off of the lemmatizer's    #
+# --selective mode: lemmatizes gold CSV files with and without it,    #
+# ignoring the gold annotation, times both runs and evaluates the     #
+# output against the gold files with evaluate.py.                     #
+#######################################################################
+
+import argparse, os, os.path, subprocess, tempfile, time
+from evaluate import Aggregates, evaluate_pair
+from lib.compression import open_file
+
+opj = os.path.join
+
+def run(infiles, outdir, rnnpath='', ttpath='', lexicons=None, selective=False):
+    # Returns the wall-clock time of one lemmatizer run.
+    args = [
+        opj(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'old-french-lemmatizer.py')
+    ] + infiles + ['--outdir', outdir, '--inputanno', 'ignore']
+    if rnnpath: args.extend(['--rnnpath', rnnpath])
+    if ttpath: args.extend(['--ttpath', ttpath])
+    if lexicons is not None: args.extend(['--lexicons'] + lexicons)
+    if selective: args.append('--selective')
+    start = time.perf_counter()
+    subprocess.run(args, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+def main(golddir, outfile='selective-report.txt', rnnpath='', ttpath='', lexicons=None):
+    fnames = sorted([x for x in os.listdir(golddir) if x.endswith('.csv')])
+    infiles = [opj(golddir, fname) for fname in fnames]
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for mode, selective in [('full', False), ('selective', True)]:
+            outdir = opj(tmpdir, mode)
+            seconds = run(infiles, outdir, rnnpath, ttpath, lexicons, selective)
+            aggregates = Aggregates()
+            for fname in fnames:
+                aggregates.merge(evaluate_pair(opj(outdir, fname), opj(golddir, fname), fname[:-4])[0])
+            results.append((mode, seconds, aggregates))
+    with open_file(outfile, 'w', encoding='utf-8') as f:
+        f.write('Mode         Seconds   Tokens Tokens/s Correct Percent\n')
+        template = '{:<10} {:>9.1f} {:>8} {:>8.0f} {:>7} {:>#7.2f}\n'
+        for mode, seconds, aggregates in results:
+            total, correct = aggregates.total[('Total', '')], aggregates.correct[('Total', '')]
+            f.write(template.format(
+                mode, seconds, total, total / seconds, correct,
+                (correct / total) * 100 if total else 0
+            ))
+        full, selective = results[0], results[1]
+        f.write('\nSpeed-up: {:.2f}x\n'.format(full[1] / selective[1]))
+        # Tokens filled in from the lexicon alone are scored 2
+        total, correct = selective[2].total[('Score', '2')], selective[2].correct[('Score', '2')]
+        if total:
+            f.write('Score 2 (selective): {} of {} correct ({:.2f}%)\n'.format(
+                correct, total, (correct / total) * 100
+            ))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description = \
+        'Compares lemmatizer runs with and without --selective on gold CSV files.'
+    )
+    parser.add_argument('golddir', type=str, help='Directory with gold CSV files.')
+    parser.add_argument('--outfile', help='Report file.', type=str, default='selective-report.txt')
+    parser.add_argument('--rnnpath', type=str, default='', help='Path to directory containing the RNN tagger.')
+    parser.add_argument('--ttpath', type=str, default='', help='Path to directory containing the TreeTagger.')
+    parser.add_argument('--lexicons', nargs='*', help='Lexicon files (default: those of the lemmatizer)')
+    kwargs = vars(parser.parse_args())
+    main(**kwargs)
@@ -11,26 +11,37 @@ class MapNotFound(Error):
     pass
 
 import argparse, os, os.path, shutil
+from lib.compression import open_file
 
 MAPSDIR='maps'
 opj = os.path.join
+DEFAULT_MAPSDIR = opj(os.path.dirname(__file__), '..', MAPSDIR)
 
-def get_map(filepos, mapsdir=MAPSDIR):
-    mapspaths = os.listdir(mapsdir)
-    for mapspath in mapspaths:
+def load_maps(mapsdir=MAPSDIR):
+    # Returns a list of (file name, map) for the .tsv files in mapsdir,
+    # in the order in which they are tried.
+    maps = []
+    for mapspath in os.listdir(mapsdir):
         if mapspath[-4:] != '.tsv': continue # Ignore non .tsv files
-        amap = parse_map(opj(mapsdir, mapspath))
+        maps.append((mapspath, parse_map(opj(mapsdir, mapspath))))
+    return maps
+
+def select_map(filepos, maps):
+    # Returns the (file name, map) of the first map which recognizes the
+    # tags in filepos, or ('', {}).
+    for mapspath, amap in maps:
         # Allow 10% unrecognized tags discrepancy between the tagsets
         if len(filepos - set(amap.keys())) < len(filepos) / 10:
-            print('Using ' + mapspath)
-            return amap
-        #else:
-        #    print(mapspath)
-        #    print(filepos - set(amap.keys()))
-    return {}
+            return mapspath, amap
+    return '', {}
+
+def get_map(filepos, mapsdir=MAPSDIR):
+    mapspath, amap = select_map(filepos, load_maps(mapsdir))
+    if amap: print('Using ' + mapspath)
+    return amap
     
 def parse_map(infile):
-    with open(infile, 'r') as f:
+    with open_file(infile, 'r') as f:
         d = {}
         for line in f:
             x = line.rstrip().split('\t')
@@ -41,7 +52,7 @@ def parse_map(infile):
 def main(infile, outfile='out.txt'):
     # First, read the pos tags in the file
     filepos = set()
-    with open(infile, 'r') as f:
+    with open_file(infile, 'r') as f:
         for line in f:
             cols = line.rstrip().split('\t')
             try:
@@ -49,14 +60,13 @@ def main(infile, outfile='out.txt'):
             except IndexError:
                 pass
     # Next, get the map
-    mapsdir = opj(os.path.dirname(__file__), '..', MAPSDIR)
-    themap = get_map(filepos, mapsdir)
+    themap = get_map(filepos, DEFAULT_MAPSDIR)
     if not themap:
         raise MapNotFound('No map found for this tagset.')
     # Finally, translate the tags and write the outfile
     #print(themap)
-    with open(infile, 'r') as fin:
-        with open(outfile, 'w') as fout:
+    with open_file(infile, 'r') as fin:
+        with open_file(outfile, 'w') as fout:
             for line in fin:
                 cols = line.rstrip().split('\t')
                 i = 1
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+
+#######################################################################
+# Tagger backends.                                                    #
+# Every backend takes sentences (lists of forms) and returns them     #
+# tagged as (form, pos, lemma) tuples. Backends built around external #
+# programs work on files instead: one token per line, sentences       #
+# separated by empty lines, with output that is line-aligned with the #
+# input. The Tagger base class derives each interface from the other, #
+# so a backend only needs to implement one of them.                   #
+#                                                                     #
+# Registered backends:                                                #
+#   rnn         RNN Tagger (scripts/rnntag.py)                        #
+#   treetagger  TreeTagger (scripts/treetag.py); pos tags only        #
+#   lexicon     deterministic stand-in: the first analysis of each    #
+#               form in the lexicons, with a configurable latency,    #
+#               for benchmarking the pipeline without a real tagger   #
+#######################################################################
+
+import collections, os.path, tempfile, time
+import scripts.rnntag
+import scripts.treetag
+from lib.lexicon import Lexicon
+from lib.compression import open_file
+
+opj = os.path.join
+
+class Error(Exception):
+    pass
+
+class BackendNotFound(Error):
+    pass
+
+UNKNOWN_LEMMA = '<unknown>' # as output by the RNN Tagger
+
+BACKENDS = {}
+
+def register(name):
+    # Class decorator adding a backend to the registry.
+    def decorator(cls):
+        cls.name = name
+        BACKENDS[name] = cls
+        return cls
+    return decorator
+
+def get_backend(name, **options):
+    try:
+        return BACKENDS[name](**options)
+    except KeyError:
+        raise BackendNotFound('No tagger backend called ' + name)
+
+def read_sentences(f, gaps=None):
+    # Generator over the sentences (lists of forms) of a one token per
+    # line file. If gaps is a deque, the number of empty lines before
+    # each sentence is appended to it, and the number at the end of the
+    # file last.
+    sentence, empty = [], 0
+    for line in f:
+        form = line.rstrip('\n')
+        if form:
+            if not sentence and gaps is not None: gaps.append(empty)
+            sentence.append(form)
+            empty = 0
+        else:
+            if sentence: yield sentence
+            sentence, empty = [], empty + 1
+    if sentence: yield sentence
+    if gaps is not None: gaps.append(empty)
+
+class Tagger():
+    # Base class. Subclasses override tag_sentences or tag_file.
+
+    lemmas = True # output has a lemma column
+    optional = False # if True, a failure is reported and the output skipped
+
+    def tag_sentences(self, sentences):
+        # Generator: takes an iterable of lists of forms and yields lists
+        # of (form, pos, lemma) tuples. Default: through tag_file.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            infile, outfile = opj(tmpdir, 'in.txt'), opj(tmpdir, 'out.txt')
+            with open(infile, 'w', encoding='utf-8') as f:
+                for sentence in sentences:
+                    f.write(''.join([form + '\n' for form in sentence]) + '\n')
+            self.tag_file(infile, outfile)
+            with open(outfile, 'r', encoding='utf-8') as f:
+                tagged = []
+                for line in f:
+                    x = line.rstrip('\n').split('\t')
+                    if x[0]:
+                        tagged.append(tuple((x + ['', ''])[:3]))
+                    elif tagged:
+                        yield tagged
+                        tagged = []
+                if tagged: yield tagged
+
+    def tag_file(self, infile, outfile):
+        # Default: streams the sentences of infile through tag_sentences.
+        gaps = collections.deque()
+        with open_file(infile, 'r', encoding='utf-8') as fin:
+            with open_file(outfile, 'w', encoding='utf-8') as fout:
+                for tagged in self.tag_sentences(read_sentences(fin, gaps)):
+                    fout.write('\n' * gaps.popleft())
+                    for form, pos, lemma in tagged:
+                        fout.write(form + '\t' + pos + ('\t' + lemma if self.lemmas else '') + '\n')
+                fout.write('\n' * gaps.popleft())
+
+@register('rnn')
+class RnnTagger(Tagger):
+
+    def __init__(self, rnnpath, lang='old-french', bucket=False, workers=1, threads=None):
+        self.rnnpath, self.lang = rnnpath, lang
+        self.bucket, self.workers, self.threads = bucket, workers, threads
+
+    def tag_file(self, infile, outfile):
+        scripts.rnntag.main(
+            self.rnnpath, self.lang, [infile], outfile=outfile,
+            bucket=self.bucket, workers=self.workers, threads=self.threads
+        )
+
+@register('treetagger')
+class TreeTagger(Tagger):
+
+    lemmas = False
+    optional = True
+
+    def __init__(self, ttpath, lang='', parpath='', timeout=scripts.treetag.TIMEOUT):
+        self.ttpath, self.lang, self.parpath = ttpath, lang, parpath
+        self.timeout = timeout
+
+    def tag_file(self, infile, outfile):
+        scripts.treetag.main(
+            self.ttpath, [infile], lang=self.lang, parpath=self.parpath,
+            outfile=outfile, timeout=self.timeout
+        )
+
+@register('lexicon')
+class LexiconTagger(Tagger):
+    # Tags each form with its first analysis in the first lexicon that
+    # contains it (or its lower case form), like a tagger that never
+    # looks at the context; unknown forms get pos X and no lemma.
+    # Sleeps for latency seconds per sentence and token_latency seconds
+    # per token to simulate the cost of a real tagger.
+
+    def __init__(self, lexicons=[], overlays=[], latency=0.0, token_latency=0.0):
+        self.lexicons = [Lexicon(lexicon, overlays if i == 0 else []) for i, lexicon in enumerate(lexicons)]
+        self.latency, self.token_latency = latency, token_latency
+
+    def analyse(self, form):
+        for lexicon in self.lexicons:
+            for x in [form, form.lower()]:
+                analyses = lexicon.lookup(x, ignore_numbers=True)
+                if analyses: return analyses[0][1], analyses[0][0]
+        return 'X', UNKNOWN_LEMMA
+
+    def tag_sentences(self, sentences):
+        for sentence in sentences:
+            delay = self.latency + self.token_latency * len(sentence)
+            if delay: time.sleep(delay)
+            yield [(form,) + self.analyse(form) for form in sentence]
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+
+#######################################################################
+# Wrapper to call the TreeTagger (Linux version)                      #
+# Key features:                                                       #
+# + Replaces the bash script                                          #
+# + Write output to a file, not stdout.                               #
+# + Designed for TreeTagger 3.2.5.                                    #
+# + Streams tokens to the tagger's stdin and reads its stdout at the  #
+#   same time (asyncio), so no temporary files are needed. Empty      #
+#   lines are not sent to the tagger but re-inserted as the output is #
+#   written.                                                          #
+# + A tagger which produces no output for --timeout seconds (or dies) #
+#   is restarted with the tokens it hasn't tagged yet. The end of its #
+#   stderr is reported if it fails for good.                          #
+#######################################################################
+
+import asyncio, collections, os, os.path, subprocess, tempfile
+from lib.concat import Concatenater
+from lib.compression import open_file
+
+opj = os.path.join
+
+class Error(Exception):
+    pass
+
+class InputDataError(Exception):
+    pass
+
+class TaggerFailed(Error):
+    pass
+
+TIMEOUT = 60 # seconds without output before the tagger is restarted
+RESTARTS = 2
+DRAIN = 1000 # tokens written to the pipe between waits for it to drain
+STDERR_LINES = 10 # last lines of the tagger's stderr kept for the error message
+
+def tagger_args(ttpath, lang='', parpath=''):
+    # Sanity check: must either give a language or a parpath
+    if not lang and not parpath:
+        raise InputDataError('Must specify either a language or a .par file to use.')
+    tagger = opj(ttpath, 'bin', 'tree-tagger')
+    parfile = parpath or opj(ttpath, 'lib', lang + '.par')
+    return [tagger, '-token', parfile]
+
+class TreeTaggerDriver():
+
+    def __init__(self, args, timeout=TIMEOUT, restarts=RESTARTS):
+        self.args = args
+        self.timeout = timeout
+        self.restarts = restarts
+
+    def tag_file(self, infile, outfile):
+        # Output is line-aligned with infile.
+        asyncio.run(self._tag_file(infile, outfile))
+
+    async def _tag_file(self, infile, outfile):
+        # pending holds (number of preceding empty lines, form) for each
+        # token sent to the tagger and not yet tagged.
+        self.pending = collections.deque()
+        self.empty = 0 # empty lines read since the last token
+        self.exhausted = False # all input read
+        self.stderr = collections.deque(maxlen=STDERR_LINES) # of the last process
+        with open_file(infile, 'r', encoding='utf-8') as fin:
+            with open_file(outfile, 'w', encoding='utf-8') as fout:
+                for attempt in range(self.restarts + 1):
+                    if await self.run(fin, fout): break
+                    print('Warning: restarting the TreeTagger ({} tokens pending).'.format(len(self.pending)))
+                else:
+                    raise TaggerFailed('The TreeTagger failed {} times. Last messages:\n{}'.format(
+                        self.restarts + 1, '\n'.join(self.stderr) or '(none)'
+                    ))
+                fout.write('\n' * self.empty)
+
+    async def run(self, fin, fout):
+        # One tagger process. Returns True once all input is tagged,
+        # False if the process timed out or exited too early.
+        process = await asyncio.create_subprocess_exec(
+            *self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        self.stderr.clear()
+        feeder = asyncio.ensure_future(self.feed(process, fin, list(self.pending)))
+        reader = asyncio.ensure_future(self.read_stderr(process))
+        try:
+            while True:
+                line = await asyncio.wait_for(process.stdout.readline(), self.timeout)
+                if not line: break
+                if not self.pending: continue # output for nothing we sent
+                empty, form = self.pending.popleft()
+                fout.write('\n' * empty + line.decode('utf-8'))
+            await feeder
+        except asyncio.TimeoutError:
+            pass
+        if process.returncode is None: process.kill()
+        feeder.cancel()
+        await process.wait()
+        await reader
+        return self.exhausted and not self.pending
+
+    async def read_stderr(self, process):
+        # Keeps the last lines of the tagger's messages (progress and
+        # errors), reading them as they come so that the pipe can't fill.
+        async for line in process.stderr:
+            line = line.decode('utf-8', errors='replace').strip()
+            if line: self.stderr.append(line)
+
+    async def feed(self, process, fin, resend):
+        # Writes the tokens left over by a previous process, then the
+        # rest of the input.
+        try:
+            for i, (empty, form) in enumerate(resend):
+                if process.stdin.is_closing(): return # the tagger died
+                process.stdin.write((form + '\n').encode('utf-8'))
+                if i % DRAIN == 0: await process.stdin.drain()
+            i = 0
+            for line in fin:
+                form = line.rstrip('\n')
+                if not form:
+                    self.empty += 1
+                    continue
+                self.pending.append((self.empty, form))
+                self.empty = 0
+                if process.stdin.is_closing(): return # form is resent on restart
+                process.stdin.write((form + '\n').encode('utf-8'))
+                i += 1
+                if i % DRAIN == 0: await process.stdin.drain()
+            self.exhausted = True
+            await process.stdin.drain()
+            process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the tagger died; run() restarts it
+
+def main(ttpath, infiles, lang='', parpath='', outdir='', outfile='', timeout=TIMEOUT):
+    driver = TreeTaggerDriver(tagger_args(ttpath, lang, parpath), timeout)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Several input files (or output to outdir) must be concatenated
+        concatenater = Concatenater()
+        if len(infiles) == 1 and not outdir:
+            infile_tt = infiles[0]
+        else:
+            infile_tt = opj(tmpdir, 'base.txt')
+            concatenater.concatenate(infiles, infile_tt)
+        outfile_tt = outfile if outfile and not outdir else opj(tmpdir, 'out.txt')
+        driver.tag_file(infile_tt, outfile_tt)
+        if outdir:
+            concatenater.split(outfile_tt, outdir=outdir)
+        elif not outfile: # Nowhere else to dump the output, print it to stdout.
+            with open_file(outfile_tt, 'r', encoding='utf-8') as f:
+                for line in f:
+                    print(line[:-1])